@@ -1,8 +1,13 @@
 import json
+import os
 from sqlalchemy import create_engine
 import pandas as pd
 import logging
 import sys
+sys.path.insert(0, '../..')
+from src.drug_combs.tables_io import write_parquet_part
+
+DEFAULT_CHUNK_SIZE = 50000
 
 '''
 Number of studies by year from AACT
@@ -25,14 +30,85 @@ class AACTFetcher(object):
         connection = engine.connect()
         return connection
 
-    def fetch_data_frame(self):
+    def fetch_data_frame(self, updated_since=None):
+        """
+        :param updated_since: if given, only studies whose last update was posted on or after this date are fetched
+        """
         logging.info("Fetching dataframe from remote")
-        return pd.read_sql(self.get_query(), self.db_connection)
+        return pd.read_sql(self.get_query(updated_since), self.db_connection,
+                           params=self.get_query_params(updated_since))
+
+    def fetch_data_frame_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE, updated_since=None):
+        """
+        Streams the query results with a server-side cursor instead of loading them at once
+        :param chunk_size: number of rows fetched per chunk
+        :param updated_since: if given, only studies whose last update was posted on or after this date are fetched
+        :return: generator of DataFrames, rows of a design group are never split between chunks
+        """
+        logging.info(f"Streaming dataframe from remote in chunks of {chunk_size}")
+        streaming_connection = self.db_connection.execution_options(stream_results=True)
+        streamed_query = f"SELECT * FROM ({self.get_query(updated_since).strip().rstrip(';')}) streamed_studies " \
+                         f"ORDER BY nct_id, design_group_id"
+        chunks = pd.read_sql(streamed_query, streaming_connection, chunksize=chunk_size,
+                             params=self.get_query_params(updated_since))
+        return align_chunks_on_key(chunks, 'design_group_id')
+
+    def fetch_changed_nct_ids(self, updated_since):
+        """
+        Changes to the design groups and interventions of a study are posted as updates of the study, so its
+        last update date covers them as well
+        The watermark is a date, studies updated later on the watermark's date are posted after it was taken, so the
+        watermark's date is included (its studies that were already synced are replaced by the same rows)
+        :param updated_since: watermark date
+        :return: set of nct_ids of all the studies updated on or after the watermark, combinations or not
+        """
+        changed_studies_df = pd.read_sql(
+            "SELECT nct_id FROM studies WHERE last_update_posted_date >= %(updated_since)s", self.db_connection,
+            params=self.get_query_params(updated_since))
+        return set(changed_studies_df['nct_id'])
+
+    def fetch_latest_update_date(self):
+        """
+        :return: the latest study update date in the snapshot, as an ISO formatted string (used as a watermark), None
+        if there are no studies
+        """
+        latest_update_df = pd.read_sql("SELECT MAX(last_update_posted_date) latest_update FROM studies",
+                                       self.db_connection)
+        latest_update = latest_update_df['latest_update'].iloc[0]
+        if latest_update is None or pd.isna(latest_update):
+            return None
+        return str(latest_update)
 
-    def get_query(self):
+    @staticmethod
+    def get_query_params(updated_since):
+        if updated_since is None:
+            return None
+        return {'updated_since': updated_since}
+
+    def fetch_to_parquet(self, output_dir, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Writes every streamed chunk as a part of a partitioned parquet directory as soon as it arrives
+        :return: total number of fetched rows
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        total_rows = 0
+        for part_idx, chunk in enumerate(self.fetch_data_frame_chunks(chunk_size)):
+            part_path = write_parquet_part(chunk, output_dir, part_idx)
+            total_rows += len(chunk)
+            print(f'Saved {len(chunk)} rows to {part_path}')
+        return total_rows
+
+    def get_query(self, updated_since=None):
+        """
+        :param updated_since: if given, the query is restricted to studies whose last update was posted on or after
+        the `updated_since` query parameter
+        """
         logging.log(logging.DEBUG, "query requested")
+        updated_studies_filter = ''
+        if updated_since is not None:
+            updated_studies_filter = 'and studies.last_update_posted_date >= %(updated_since)s'
 
-        return '''
+        return f'''
         SELECT relevant_studies.*,
        collected_conditions.mesh_terms,
        collected_conditions.downcase_mesh_terms,
@@ -76,6 +152,7 @@ FROM (SELECT studies.nct_id
                           GROUP BY nct_id
       ) as collected_refs on collected_refs.nct_id = studies.nct_id
       where intervention_type = 'Drug'
+        {updated_studies_filter}
         and dg.id in (SELECT dg.id
                       FROM studies
                                LEFT JOIN design_groups dg on studies.nct_id = dg.nct_id
@@ -109,6 +186,43 @@ FROM (SELECT studies.nct_id
     def close_connection(self):
         self.db_connection.close()
 
+def align_chunks_on_key(chunks, key):
+    """
+    Holds back the rows of the last key value of every chunk and prepends them to the next chunk, so rows sharing
+    a key value always end up in the same chunk
+    :param chunks: DataFrames ordered by key
+    :return: generator of DataFrames
+    """
+    held_back = None
+    for chunk in chunks:
+        if held_back is not None:
+            chunk = pd.concat([held_back, chunk], ignore_index=True)
+        if chunk.empty:
+            continue
+        is_last_key = chunk[key] == chunk[key].iloc[-1]
+        held_back = chunk[is_last_key]
+        if not is_last_key.all():
+            yield chunk[~is_last_key]
+    if held_back is not None and not held_back.empty:
+        yield held_back
+
+
+def read_watermark(path):
+    """
+    :param path: path to the watermark json file of the last sync
+    :return: the watermark date, None if there was no previous sync
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as watermark_file:
+        return json.load(watermark_file)['last_update_posted_date']
+
+
+def write_watermark(path, last_update_posted_date):
+    with open(path, 'w') as watermark_file:
+        json.dump({'last_update_posted_date': last_update_posted_date}, watermark_file)
+
+
 def read_creds_from_file(path):
     try:
         credentials_file = open(path)
@@ -121,14 +235,20 @@ def read_creds_from_file(path):
 
 if __name__ == '__main__':
     argv = sys.argv
-    if len(argv) != 3:
-        sys.exit("Usage: aact_fetcher.py <aact_credentials_file.json> <output_path.csv>")
+    if len(argv) not in (3, 4):
+        sys.exit("Usage: aact_fetcher.py <aact_credentials_file.json> <output_path.csv|output_dir> [chunk_size]")
 
     creds = read_creds_from_file(argv[1])
     aact_fetcher = AACTFetcher(creds['url'], creds['username'], creds['password'])
-    df = aact_fetcher.fetch_data_frame()
-    print(f'Fetched total of: {len(df)} rows')
     output_path = argv[2]
-    df.to_csv(output_path, index=False)
+    if output_path.endswith('.csv'):
+        df = aact_fetcher.fetch_data_frame()
+        print(f'Fetched total of: {len(df)} rows')
+        df.to_csv(output_path, index=False)
+    else:
+        chunk_size = int(argv[3]) if len(argv) == 4 else DEFAULT_CHUNK_SIZE
+        total_rows = aact_fetcher.fetch_to_parquet(output_path, chunk_size)
+        print(f'Fetched total of: {total_rows} rows')
+    aact_fetcher.close_connection()
     print(f'Saved successfully the fetched dataframe to {output_path}')
     # pip install psycopg2-binary
@@ -1,17 +1,28 @@
 import argparse
-import numpy as np
+import os
+import shutil
+from glob import glob
 import pandas as pd
 from tqdm import tqdm
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sys
 sys.path.insert(0, '../..')
 from src.drug_identfiers_resolver.identifiers_resolver import WikiDataIdsResolver, DrugIdentifiersResolver, \
-    APIBasedIdentifiersResolver
+    APIBasedIdentifiersResolver, DRUGBANK_CACHE_PATH
+from src.drug_identfiers_resolver.cache_snapshot import build_snapshot, merge_deltas
+from src.drug_identfiers_resolver.async_identifiers_resolver import AsyncDrugIdentifiersResolver
+from src.drug_identfiers_resolver.local_identifiers_index import LocalIdentifiersIndex
+from src.drug_identfiers_resolver.resolver_cache import dump_cache_stats
+from src.drug_combs.tables_io import read_table, write_parquet, parse_list_cell, read_parquet_parts, \
+    write_parquet_part
+from src.drug_combs.instrumentation import get_metrics
 import warnings
 
 warnings.filterwarnings("ignore")
 tqdm.pandas()
 
+WIKIDATA_CACHE_PATH = "wikidata_disk_cache"
+
 
 class DataframeDrugIdentifiersAdder(object):
     def __init__(self, identifiers_resolver, array_like=True, as_str_array=False):
@@ -19,22 +30,13 @@ class DataframeDrugIdentifiersAdder(object):
         self.array_like = array_like
         self.as_str_array = as_str_array
 
-    def _parallelize_dataframe(self, df, src_col, dest_col, n_cores):
-        # logging.info(f"Parallel editing df from in_col: {src_col} to {dest_col}")
-        self.source_col, self.dest_col = src_col, dest_col
-        df_split = np.array_split(df, n_cores)
-        pool = Pool(n_cores)
-        mapper = self.add_identifiers_mapper  # self._map_split(src_col, dest_col, self.identifiers_resolver)
-        print("Start mapping")
-        df = pd.concat(pool.map(mapper, df_split))
-        # df = mapper(df)
-        pool.close()
-        pool.join()
-        return df
-
-    def add_identifiers_column(self, df, source_col, dest_col, n_cores=10):
-        return self._parallelize_dataframe(df, source_col,
-                                           dest_col, n_cores)
+    def add_identifiers_column(self, df, source_col, dest_col, n_workers=10):
+        """
+        :param n_workers: number of threads resolving names concurrently, resolution is network bound so the threads
+        share the resolver (and its in-memory caches) instead of copying it to worker processes
+        """
+        self.source_col, self.dest_col, self.n_workers = source_col, dest_col, n_workers
+        return self.add_identifiers_mapper(df)
 
     def add_identifiers_mapper(self, df):
         """
@@ -44,51 +46,149 @@ class DataframeDrugIdentifiersAdder(object):
         :return: df with the column
         """
         if self.as_str_array:
-            df[self.dest_col] = df[self.source_col].progress_apply(
-                lambda x: self.identifiers_resolver.resolve_array(eval(x)))
+            names_arrays = df[self.source_col].apply(parse_list_cell)
         elif self.array_like:
-            df[self.dest_col] = df[self.source_col].progress_apply(
-                lambda x: self.identifiers_resolver.resolve_array(x))
+            names_arrays = df[self.source_col]
         elif not self.array_like:
-            df[self.dest_col] = df[self.source_col].progress_apply(
-                lambda x: self.identifiers_resolver.resolve_array([x]))
+            names_arrays = df[self.source_col].apply(lambda x: [x])
         elif self.array_like == '/':
-            df[self.dest_col] = df[self.source_col].progress_apply(
-                lambda x: self.identifiers_resolver.resolve_array(x.split("/")))
+            names_arrays = df[self.source_col].apply(lambda x: x.split("/"))
         else:
             exit("Unsupported transformation")
+        # the same names arrays repeat in many rows, each distinct one is resolved once
+        keys = [self._names_array_key(names) for names in names_arrays]
+        distinct_names_arrays = {}
+        for key, names in zip(keys, names_arrays):
+            distinct_names_arrays.setdefault(key, names)
+        print(f"Resolving {len(distinct_names_arrays)} distinct names arrays of {len(keys)} rows "
+              f"(dedup ratio {len(keys) / max(len(distinct_names_arrays), 1):.1f})")
+        get_metrics().add_counts('identifiers_dedup', rows=len(keys), distinct_names_arrays=len(distinct_names_arrays))
+        if hasattr(self.identifiers_resolver, 'resolve_arrays'):
+            # batch resolvers keep many names in flight at once instead of resolving one by one
+            results = self.identifiers_resolver.resolve_arrays(distinct_names_arrays.values())
+        else:
+            results = self._resolve_in_threads(list(distinct_names_arrays.values()))
+        key_to_result = dict(zip(distinct_names_arrays.keys(), results))
+        df[self.dest_col] = pd.Series([key_to_result[key] for key in keys], index=df.index, dtype=object)
         return df
 
+    def _resolve_in_threads(self, names_arrays):
+        """
+        :return: resolve_array of every names array, in the order of names_arrays
+        """
+        results = [None] * len(names_arrays)
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = {executor.submit(self.identifiers_resolver.resolve_array, names): idx
+                       for idx, names in enumerate(names_arrays)}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                results[futures[future]] = future.result()
+        return results
+
+    @staticmethod
+    def _names_array_key(names):
+        return tuple(names) if isinstance(names, list) else names
+
+
+def add_identifiers_to_parts(drug_identifiers_adder, input_dir, output_dir, source_col, dest_col, n_workers) -> int:
+    """
+    Adds the identifiers column to a directory of parquet parts a part at a time, names repeated across parts are
+    answered by the resolvers' caches
+    :param output_dir: directory to write the parts with the identifiers column to, replaced only once all the parts
+    are written
+    :return: number of rows written
+    """
+    tmp_dir = f'{output_dir}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    rows = 0
+    for part_idx, part_df in enumerate(read_parquet_parts(input_dir)):
+        with get_metrics().stage('add_identifiers', len(part_df)) as stage_record:
+            part_df = drug_identifiers_adder.add_identifiers_column(part_df, source_col, dest_col, n_workers)
+            stage_record.rows_out = len(part_df)
+        write_parquet_part(part_df, tmp_dir, part_idx)
+        rows += len(part_df)
+    if os.path.isfile(output_dir):
+        os.remove(output_dir)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+    return rows
+
+
+def add_resolvers_metrics(wikidata_ids_resolver, api_identifiers_resolver) -> dict:
+    """
+    Adds the resolvers' cache stats and the number of requests sent to PubChem to the run's metrics
+    :return: dictionary of source to the resolver's cache
+    """
+    resolver_caches = {'wikidata': wikidata_ids_resolver.cache, 'drugbank': api_identifiers_resolver.cache}
+    get_metrics().add_section('resolver_caches', {source: cache.stats.to_dict()
+                                                  for source, cache in resolver_caches.items()})
+    get_metrics().add_counts('pubchem', requests=api_identifiers_resolver.pubchem_client.requests_sent)
+    return resolver_caches
+
 
 def main(args):
     is_csv = args.input_path.endswith(".csv")
     is_xlsx = args.input_path.endswith(".xlsx")
-    if is_csv:
-        df = pd.read_csv(args.input_path)
-    elif is_xlsx:
-        df = pd.read_excel(args.input_path)
-    else:
+    # a parquet file, or a directory of parquet parts
+    is_parquet = args.input_path.endswith(".parquet") or os.path.isdir(args.input_path)
+    # parts are resolved and written one at a time, so memory is bounded by the part size
+    is_parquet_parts = os.path.isdir(args.input_path) and bool(glob(os.path.join(args.input_path, 'part-*.parquet')))
+    if not (is_csv or is_xlsx or is_parquet):
         exit("Unsupported file format")
+    if args.cache_snapshot_dir:
+        # workers read the caches from shared memory-mapped snapshots instead of contending on SQLite
+        for cache_path in [WIKIDATA_CACHE_PATH, DRUGBANK_CACHE_PATH]:
+            print(f"Snapshot of {cache_path} has {build_snapshot(cache_path, args.cache_snapshot_dir)} entries")
     wikidata_ids_resolver = WikiDataIdsResolver("../drug_combs/input_data/qid_to_drugbank.json",
                                                 "../drug_combs/input_data/qid_to_pubchem.json",
-                                                cache_file_path="wikidata_disk_cache")
-    resolver = DrugIdentifiersResolver(wikidata_ids_resolver, APIBasedIdentifiersResolver())
+                                                cache_file_path=WIKIDATA_CACHE_PATH,
+                                                negative_ttl=args.negative_ttl, snapshot_dir=args.cache_snapshot_dir)
+    api_identifiers_resolver = APIBasedIdentifiersResolver(negative_ttl=args.negative_ttl,
+                                                           snapshot_dir=args.cache_snapshot_dir)
+    local_identifiers_index = LocalIdentifiersIndex.load(args.local_index) if args.local_index else None
+    if args.async_resolution:
+        resolver = AsyncDrugIdentifiersResolver(wikidata_ids_resolver, api_identifiers_resolver,
+                                                max_connections_per_host=args.connections_per_host,
+                                                local_identifiers_index=local_identifiers_index)
+    else:
+        resolver = DrugIdentifiersResolver(wikidata_ids_resolver, api_identifiers_resolver, local_identifiers_index)
     drug_identifiers_adder = DataframeDrugIdentifiersAdder(resolver, args.aslist, args.as_str_array)
+    # a single event loop already keeps all the names in flight, no need for worker threads
+    workers = 1 if args.async_resolution else args.workers
     print("Start resolving")
     try:
-        df = drug_identifiers_adder.add_identifiers_column(df, args.input_column, args.result_column)#, args.processes)
-        print(f"Resolved all: {len(df)} results")
-        if is_csv:
-            df.to_csv(args.output_path)
+        if is_parquet_parts:
+            rows = add_identifiers_to_parts(drug_identifiers_adder, args.input_path, args.output_path,
+                                            args.input_column, args.result_column, workers)
+            print(f"Resolved all: {rows} results")
         else:
-            df.to_excel(args.output_path)
+            df = read_table(args.input_path)
+            with get_metrics().stage('add_identifiers', len(df)) as stage_record:
+                df = drug_identifiers_adder.add_identifiers_column(df, args.input_column, args.result_column, workers)
+                stage_record.rows_out = len(df)
+            print(f"Resolved all: {len(df)} results")
+            if is_csv:
+                df.to_csv(args.output_path)
+            elif is_parquet:
+                write_parquet(df, args.output_path)
+            else:
+                df.to_excel(args.output_path)
         print(f"Saved results to {args.output_path}")
+        resolver_caches = add_resolvers_metrics(wikidata_ids_resolver, api_identifiers_resolver)
+        if args.cache_stats_path:
+            dump_cache_stats(args.cache_stats_path, resolver_caches)
     except Exception as e:
         print(f"Failed in resolving: {e}")
+        # a failed run must fail its build stage, rather than pass on partial results
+        sys.exit(1)
+    finally:
+        if args.cache_snapshot_dir:
+            for cache_path in [WIKIDATA_CACHE_PATH, DRUGBANK_CACHE_PATH]:
+                print(f"Merged {merge_deltas(cache_path, args.cache_snapshot_dir)} new entries into {cache_path}")
 
 if __name__ == '__main__':
     argument_parser = argparse.ArgumentParser()
-    argument_parser.add_argument("input_path", type=str, help="Path to input csv/xlsx file")
+    argument_parser.add_argument("input_path", type=str, help="Path to input csv/xlsx/parquet file")
     argument_parser.add_argument("input_column", type=str, help="The column in the file that contains the names")
     argument_parser.add_argument("result_column", type=str,
                                  help="The column in the CSV that should contain the identifiers")
@@ -96,8 +196,28 @@ if __name__ == '__main__':
                                  default=False)
     argument_parser.add_argument("--as_str_array", type=bool, help="Whether the input column is list of drugs or single drug",
                                  default=False)
-    argument_parser.add_argument("--processes", default=10, type=bool, help="number of processes to use")
+    argument_parser.add_argument("--workers", "--processes", dest="workers", default=10, type=int,
+                                 help="number of threads resolving names concurrently")
+    argument_parser.add_argument("--async_resolution", action="store_true",
+                                 help="Resolve all the names concurrently with asyncio over pooled connections")
+    argument_parser.add_argument("--connections_per_host", default=8, type=int,
+                                 help="Max concurrent connections to a single host in async resolution")
+    argument_parser.add_argument("--local_index", default=None, type=str,
+                                 help="Local identifiers index (built by local_identifiers_index.py) to resolve names "
+                                      "from before going to the network")
+    argument_parser.add_argument("--negative_ttl", default=7 * 24 * 60 * 60, type=int,
+                                 help="Seconds a failed lookup is cached before it is retried")
+    argument_parser.add_argument("--cache_stats_path", default=None, type=str,
+                                 help="Path to save the resolvers' cache hit/miss and latency stats to (json)")
+    argument_parser.add_argument("--cache_snapshot_dir", default=None, type=str,
+                                 help="Read the resolvers' caches from snapshots built in this directory, new results "
+                                      "are merged back into the caches at the end of the run")
+    argument_parser.add_argument("--metrics_path", default=None, type=str,
+                                 help="path to write the run's per-stage metrics to (json)")
     argument_parser.add_argument("output_path", type=str, help="The path to save the result csv")
     args = argument_parser.parse_args()
-    main(args)
+    with get_metrics().stage('total'):
+        main(args)
+    if args.metrics_path is not None:
+        get_metrics().write(args.metrics_path)
 
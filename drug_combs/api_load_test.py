@@ -0,0 +1,91 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+import numpy as np
+
+
+async def get_query_params(session, base_url, sample_size):
+    """
+    :return: query parameters of ids and names of combinations sampled from the first pages of the API
+    """
+    params = []
+    async with session.get(f'{base_url}/combinations', params={'limit': sample_size}) as response:
+        response.raise_for_status()
+        combinations = (await response.json())['results']
+    for combination in combinations:
+        drugbank_ids = [identifier for identifier in combination['drugbank_identifiers'] if identifier != '-1']
+        pubchem_ids = [identifier for identifier in combination['pubchem_identifiers'] if identifier != '-1']
+        if drugbank_ids:
+            params.append({'drugbank_id': drugbank_ids[0]})
+            params.append([('drugbank_id', identifier) for identifier in drugbank_ids[:2]])
+        if pubchem_ids:
+            params.append({'pubchem_id': pubchem_ids[0], 'source': combination['source']})
+    if not params:
+        params.append({})
+    return params
+
+
+async def run_load_test(base_url, n_requests, concurrency, sample_size, revalidate_ratio, seed=0):
+    """
+    Sends n_requests queries sampled from the release, concurrency at a time. revalidate_ratio of the requests of an
+    already seen query are sent with its ETag (If-None-Match), as a browser's cache would.
+    :return: dictionary of the latencies' percentiles, the throughput and the response statuses
+    """
+    random.seed(seed)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        query_params = await get_query_params(session, base_url, sample_size)
+        etags, latencies, statuses = {}, [], {}
+        queue = asyncio.Queue()
+        for _ in range(n_requests):
+            queue.put_nowait(random.randrange(len(query_params)))
+
+        async def worker():
+            while not queue.empty():
+                query_idx = queue.get_nowait()
+                headers = {}
+                if query_idx in etags and random.random() < revalidate_ratio:
+                    headers['If-None-Match'] = etags[query_idx]
+                start = time.perf_counter()
+                async with session.get(f'{base_url}/combinations', params=query_params[query_idx],
+                                       headers=headers) as response:
+                    await response.read()
+                    latencies.append(time.perf_counter() - start)
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                    if 'ETag' in response.headers:
+                        etags[query_idx] = response.headers['ETag']
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        total_seconds = time.perf_counter() - start
+        async with session.get(f'{base_url}/stats') as response:
+            server_stats = await response.json()
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'requests': len(latencies), 'concurrency': concurrency, 'distinct_queries': len(query_params),
+            'total_seconds': total_seconds, 'requests_per_second': len(latencies) / total_seconds,
+            'latency_p50_ms': p50 * 1000, 'latency_p95_ms': p95 * 1000, 'latency_p99_ms': p99 * 1000,
+            'latency_max_ms': max(latencies) * 1000, 'statuses': statuses, 'server': server_stats}
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Measures the latency and throughput of combinations_api.py")
+    argument_parser.add_argument("--url", default='http://127.0.0.1:8080', type=str, help="the API's base url")
+    argument_parser.add_argument("--requests", default=10000, type=int, help="number of requests to send")
+    argument_parser.add_argument("--concurrency", default=50, type=int, help="number of requests in flight")
+    argument_parser.add_argument("--sample_size", default=500, type=int,
+                                 help="number of combinations the queries' ids are sampled from")
+    argument_parser.add_argument("--revalidate_ratio", default=0.5, type=float,
+                                 help="ratio of repeated queries sent with their ETag")
+    argument_parser.add_argument("--output_path", default=None, type=str, help="path to write the results to (json)")
+    args = argument_parser.parse_args()
+    results = asyncio.run(run_load_test(args.url, args.requests, args.concurrency, args.sample_size,
+                                        args.revalidate_ratio))
+    print(json.dumps(results, indent=2))
+    if args.output_path is not None:
+        with open(args.output_path, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
@@ -0,0 +1,283 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import types
+
+import pandas as pd
+import sys
+
+sys.path.insert(0, '../..')
+import src.drug_combs.clinical_trials_combinations as clinical_trials_combinations
+from src.drug_combs.clinical_trials_combinations import AACTDataPreProcessor
+from src.drug_combs.add_identifier_to_df import DataframeDrugIdentifiersAdder
+from src.drug_combs.schema_transforming import ClinicalTrialsSchemaTransformer
+from src.drug_combs.orange_book import OrangeBookParser, add_drugs_identifiers, PRODUCTS_COLUMNS, PATENT_COLUMNS, \
+    EXCLUSIVITY_COLUMNS
+from src.drug_combs import create_unnormalized_combs_db
+from src.drug_identfiers_resolver.identifiers_resolver import MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID, PLACEBO_CODE
+
+INPUT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input_data')
+DOSAGE_NOISE = ['{} 100 mg', 'Oral {}', '{} (tablet)', '{} 0.5%', 'Comparator: {}', '{} 10 mg/kg', '{}']
+
+
+class StubIdentifiersResolver(object):
+    """
+    Resolves names of the synthetic vocabulary, sleeping `latency` seconds per call as a network resolver would
+    """
+
+    def __init__(self, name_to_drugbank_id, latency=0.0):
+        self.name_to_drugbank_id = name_to_drugbank_id
+        self.latency = latency
+
+    def resolve_array(self, names) -> tuple:
+        if names == '':
+            return '', ''
+        if names is None:
+            return MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID
+        if self.latency:
+            time.sleep(self.latency)
+        for name in names:
+            name = str(name)
+            if "placebo" in name.lower():
+                return PLACEBO_CODE, PLACEBO_CODE
+            drugbank_id = self.name_to_drugbank_id.get(name.lower())
+            if drugbank_id is not None:
+                return drugbank_id, f'CID{drugbank_id[2:]}'
+        return MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID
+
+
+class FakeEntity(object):
+    def __init__(self, text, cuis):
+        self.text = text
+        self._ = types.SimpleNamespace(kb_ents=[(cui, 1.0) for cui in cuis])
+
+    def __str__(self):
+        return self.text
+
+
+class FakeLanguageModel(object):
+    """
+    Recognizes the names of the synthetic vocabulary as a single entity (and names joined with '+' as several), in
+    place of the scispacy model and the UMLS linker
+    """
+
+    def __init__(self, name_to_cui):
+        self.name_to_cui = name_to_cui
+
+    def pipe(self, texts, batch_size=1, n_process=1):
+        for text in texts:
+            entities = []
+            for part in text.split('+'):
+                cui = self.name_to_cui.get(part.strip().lower())
+                if cui is not None:
+                    entities.append(FakeEntity(part.strip(), [cui]))
+            yield types.SimpleNamespace(ents=entities)
+
+
+def load_vocabulary(vocabulary_size):
+    """
+    :return: list of (drugbank_id, drug name) of real drugbank drugs
+    """
+    drug_names_df = pd.read_csv(os.path.join(INPUT_DATA_DIR, 'drugbank_drug_names.csv')).head(vocabulary_size)
+    return list(zip(drug_names_df['drugBank_id'], drug_names_df['Drug name']))
+
+
+def install_fake_language_model(vocabulary):
+    name_to_cui = {name.lower(): f'C{idx:07d}' for idx, (_, name) in enumerate(vocabulary)}
+    kb = types.SimpleNamespace(cui_to_entity={
+        cui: types.SimpleNamespace(canonical_name=name, aliases=[name.lower()], types=['T109'])
+        for (_, name), cui in zip(vocabulary, name_to_cui.values())})
+    clinical_trials_combinations._nlp = FakeLanguageModel(name_to_cui)
+    clinical_trials_combinations._linker = types.SimpleNamespace(kb=kb)
+
+
+def generate_aact_df(n_studies, vocabulary, rng) -> pd.DataFrame:
+    """
+    :return: DataFrame with the columns of AACTFetcher.get_query, 1-3 design groups per study and 1-4 drugs per group
+    """
+    names = [name for _, name in vocabulary]
+    rows = []
+    design_group_id = 0
+    for study_idx in range(n_studies):
+        nct_id = f'NCT{study_idx:08d}'
+        conditions = rng.sample(['Diabetes Mellitus', 'Hypertension', 'Breast Cancer', 'Asthma', 'HIV'],
+                                rng.randint(1, 3))
+        mesh_terms = [condition.split()[0] for condition in conditions]
+        refs = [[rng.choice(['result', 'background']), f'Citation {study_idx}-{idx}'] for idx in
+                range(rng.randint(0, 3))]
+        for _ in range(rng.randint(1, 3)):
+            design_group_id += 1
+            for intervention_idx in range(rng.randint(1, 4)):
+                if rng.random() < 0.1:
+                    name = 'Placebo'
+                elif rng.random() < 0.05:
+                    name = f'{rng.choice(names)} + {rng.choice(names)}'
+                else:
+                    name = rng.choice(DOSAGE_NOISE).format(rng.choice(names))
+                other_names = [rng.choice(names) for _ in range(rng.randint(0, 2))]
+                rows.append({'nct_id': nct_id, 'study_start_date': datetime.date(2000 + study_idx % 20, 1, 1),
+                             'completion_date': None, 'enrollment': rng.randint(10, 1000), 'enrollment_type': 'Actual',
+                             'number_of_arms': 2, 'number_of_groups': None, 'why_stopped': None, 'phase': 'Phase 2',
+                             'overall_status': 'Completed', 'last_known_status': None,
+                             'is_fda_regulated_drug': True, 'design_group_id': design_group_id,
+                             'interventions_id': design_group_id * 10 + intervention_idx,
+                             'group_type': 'Experimental', 'title': f'Arm {design_group_id}',
+                             'intervention_names': name, 'interventions_with_other_names': [name, other_names],
+                             'intervention_description': '', 'refs': refs or None, 'mesh_terms': mesh_terms,
+                             'downcase_mesh_terms': [term.lower() for term in mesh_terms],
+                             'condition_names': conditions,
+                             'condition_downcase_names': [condition.lower() for condition in conditions]})
+    return pd.DataFrame(rows)
+
+
+def write_orange_book_files(orange_book_dir, n_products, vocabulary, rng):
+    """
+    Writes '~' separated products, patent and exclusivity files, about half of the products are combinations
+    """
+    names = [name.upper() for _, name in vocabulary]
+    products, patents, exclusivities = [], [], []
+    for product_idx in range(n_products):
+        appl_no, product_no = f'{product_idx // 3:06d}', f'{product_idx % 3 + 1:03d}'
+        ingredients = '; '.join(rng.sample(names, rng.choice([1, 1, 2, 3])))
+        products.append([ingredients, 'TABLET;ORAL', f'TRADE{product_idx}', 'APPLICANT', '10MG', 'N', appl_no,
+                         product_no, 'AB', 'Jan 1, 2000', 'Yes', 'No', 'RX', 'APPLICANT INC'])
+        for patent_idx in range(rng.randint(0, 4)):
+            patents.append(['N', appl_no, product_no, f'{product_idx}{patent_idx}', 'Apr 28, 2030', 'Y', '', 'U-1',
+                            '', 'Jan 1, 2010'])
+        if rng.random() < 0.2:
+            exclusivities.append(['N', appl_no, product_no, 'ODE-1', 'Apr 4, 2031'])
+    for file_name, columns, rows in [('products.txt', PRODUCTS_COLUMNS, products),
+                                     ('patent.txt', PATENT_COLUMNS, patents),
+                                     ('exclusivity.txt', EXCLUSIVITY_COLUMNS, exclusivities)]:
+        with open(os.path.join(orange_book_dir, file_name), 'w') as orange_book_file:
+            orange_book_file.write('~'.join(columns) + '\n')
+            orange_book_file.writelines('~'.join(row) + '\n' for row in rows)
+
+
+def write_patents_table(path, vocabulary, n_patents, rng):
+    rows = []
+    for patent_idx in range(n_patents):
+        drugs = rng.sample(vocabulary, 2)
+        rows.append({'drugs_names': json.dumps([name for _, name in drugs]),
+                     'drugbank_identifiers': json.dumps([drugbank_id for drugbank_id, _ in drugs]),
+                     'pubchem_identifiers': json.dumps([MISSING_PUBCHEM_ID for _ in drugs]),
+                     'Patent ID': f'US{patent_idx}'})
+    pd.DataFrame(rows).to_csv(path, index=False)
+
+
+def count_rows(output):
+    """
+    :param output: a stage's output, a DataFrame or a dict of tables
+    """
+    if isinstance(output, dict):
+        return sum(len(table) for table in output.values())
+    return len(output) if output is not None else None
+
+
+def timed(results, scale, stage, function, rows_in):
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    output = function()
+    result = {'scale': scale, 'stage': stage, 'wall_seconds': time.perf_counter() - start_wall,
+              'cpu_seconds': time.process_time() - start_cpu, 'rows_in': rows_in,
+              'rows_out': count_rows(output)}
+    print(f"{stage} (scale {scale}): {result['wall_seconds']:.2f}s")
+    results.append(result)
+    return output
+
+
+def run_scale(scale, args, vocabulary, work_dir):
+    """
+    Runs every stage on synthetic inputs of `scale` studies (and as many orange book products)
+    :return: list of the stages' results
+    """
+    rng = random.Random(args.seed)
+    results = []
+    scale_dir = os.path.join(work_dir, str(scale))
+    orange_book_dir = os.path.join(scale_dir, 'orange_book')
+    tables_dir = os.path.join(scale_dir, 'tables')
+    for directory in [orange_book_dir, tables_dir]:
+        os.makedirs(directory)
+    resolver = StubIdentifiersResolver({name.lower(): drugbank_id for drugbank_id, name in vocabulary},
+                                       args.resolver_latency)
+
+    raw_df = generate_aact_df(scale, vocabulary, rng)
+    preprocessor = AACTDataPreProcessor(None, ner_cache_path=os.path.join(scale_dir, 'ner_cache'))
+    combs_df = timed(results, scale, 'aact_preprocess', lambda: preprocessor.preprocess(raw_df), len(raw_df))
+    adder = DataframeDrugIdentifiersAdder(resolver)
+    combs_df = timed(results, scale, 'add_identifiers',
+                     lambda: adder.add_identifiers_column(combs_df, 'selected_name', 'identifiers_entity',
+                                                          args.workers), len(combs_df))
+    transformer = ClinicalTrialsSchemaTransformer(os.path.join(INPUT_DATA_DIR, 'drugbank_nutraceuticals.xlsx'))
+    dbid_to_compound_size_df = pd.read_csv(os.path.join(INPUT_DATA_DIR, 'dbid_to_compound.csv'))
+    normalized_tables = timed(results, scale, 'schema_transform',
+                              lambda: transformer.transform_normalized(combs_df, dbid_to_compound_size_df),
+                              len(combs_df))
+
+    write_orange_book_files(orange_book_dir, scale, vocabulary, rng)
+    orange_book_df = timed(results, scale, 'orange_book_parse', OrangeBookParser(orange_book_dir).get_combs, scale)
+    orange_book_adder = DataframeDrugIdentifiersAdder(resolver, False)
+    orange_book_df = timed(results, scale, 'orange_book_identifiers',
+                           lambda: add_drugs_identifiers(orange_book_df, orange_book_adder), len(orange_book_df))
+
+    normalized_tables['design_group_df'].to_csv(os.path.join(tables_dir, 'design_group_df.csv'), index=False)
+    orange_book_df.to_csv(os.path.join(tables_dir, 'orangebook_combs_df.csv'), index=False)
+    write_patents_table(os.path.join(tables_dir, 'transformed_patents_drug.csv'), vocabulary, scale, rng)
+    unnormalized_args = argparse.Namespace(input_dir=tables_dir, output_path=tables_dir,
+                                           drug_names_path=os.path.join(INPUT_DATA_DIR, 'drugbank_drug_names.csv'))
+    timed(results, scale, 'create_unnormalized_combs_db', lambda: create_unnormalized_combs_db.main(unnormalized_args),
+          len(normalized_tables['design_group_df']) + len(orange_book_df) + scale)
+    return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def main(args):
+    vocabulary = load_vocabulary(args.vocabulary_size)
+    install_fake_language_model(vocabulary)
+    report = {'git_commit': get_git_commit(), 'started_at': datetime.datetime.now().isoformat(),
+              'python': platform.python_version(), 'platform': platform.platform(), 'pandas': pd.__version__,
+              'args': vars(args), 'results': []}
+    output_path = os.path.abspath(args.output_path or
+                                  f"data/benchmarks/benchmark_{report['git_commit']}_"
+                                  f"{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # stages write side files (e.g. errors.csv) to the working directory
+        os.chdir(work_dir)
+        try:
+            for scale in args.scales:
+                report['results'].extend(run_scale(scale, args, vocabulary, work_dir))
+        finally:
+            os.chdir(cwd)
+    with open(output_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Saved benchmark results to {output_path}")
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(
+        description="Times every pipeline stage on synthetic inputs, with stub resolvers and a fake language model")
+    argument_parser.add_argument("--scales", nargs='+', type=int, default=[1000, 10000],
+                                 help="numbers of synthetic AACT studies (and orange book products) to run on")
+    argument_parser.add_argument("--resolver_latency", type=float, default=0.0,
+                                 help="seconds each stub resolver call sleeps, as a network call")
+    argument_parser.add_argument("--workers", type=int, default=10, help="threads resolving identifiers")
+    argument_parser.add_argument("--vocabulary_size", type=int, default=2000,
+                                 help="number of drugbank drug names the synthetic inputs are drawn from")
+    argument_parser.add_argument("--seed", type=int, default=0)
+    argument_parser.add_argument("--output_path", type=str, default=None,
+                                 help="path of the json results (default data/benchmarks/benchmark_<commit>_<time>.json)")
+    args = argument_parser.parse_args()
+    main(args)
@@ -0,0 +1,394 @@
+import argparse
+import ast
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from glob import glob
+
+sys.path.insert(0, '../..')
+
+from src.drug_combs.instrumentation import merge_metrics
+
+DRUG_COMBS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(DRUG_COMBS_DIR)
+# the repository is imported as the 'src' package (see the sys.path inserts of the scripts)
+REPO_PACKAGE = 'src'
+HASH_BLOCK_SIZE = 1 << 20
+STATE_DIR = 'data/build_state'
+LOCAL_INDEX_PATH = 'data/local_identifiers_index.tsv.gz'
+NORMALIZED_TABLES = ['trials_df.csv', 'design_group_df.csv', 'conditions_df.csv', 'mesh_terms_df.csv',
+                     'references_df.csv']
+RELEASE_FORMATS = ('sqlite', 'parquet')
+RELEASE_SQLITE_NAME = 'cdcdb.sqlite'
+RELEASE_PARQUET_DIR_NAME = 'parquet'
+
+
+def get_code_files(script_path):
+    """
+    :return: the script and every module of the repository it imports (recursively), sorted
+    """
+    code_files, to_visit = set(), [os.path.abspath(script_path)]
+    while to_visit:
+        path = to_visit.pop()
+        if path in code_files or not os.path.exists(path):
+            continue
+        code_files.add(path)
+        with open(path) as code_file:
+            tree = ast.parse(code_file.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.module:
+                modules = [node.module]
+            elif isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            else:
+                continue
+            for module in modules:
+                if module.split('.')[0] == REPO_PACKAGE:
+                    to_visit.append(os.path.join(REPO_DIR, *module.split('.')[1:]) + '.py')
+    return sorted(code_files)
+
+
+def hash_path(path, digest):
+    """
+    Adds the content of a file, or of every file under a directory, to the digest. Missing paths are hashed as such,
+    so a stage is re-run once an optional input shows up.
+    """
+    if not os.path.exists(path):
+        digest.update(f'missing:{path}\n'.encode('utf-8'))
+        return
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        files = [path]
+    for file_path in files:
+        digest.update(f'file:{os.path.relpath(file_path, os.path.dirname(path))}\n'.encode('utf-8'))
+        with open(file_path, 'rb') as hashed_file:
+            for block in iter(lambda: hashed_file.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+
+
+class BuildStage(object):
+    def __init__(self, name, command=None, function=None, inputs=(), outputs=(), dependencies=(), code=(), key='',
+                 always_run=False):
+        """
+        :param command: script and arguments, run with the current python from the drug_combs directory
+        :param function: called (with no arguments) after the command, or instead of it
+        :param inputs: files or directories the stage reads, a stage is re-run when their content changes
+        :param outputs: files or directories the stage writes, a stage is re-run when one of them is missing
+        :param dependencies: names of the stages that must finish before this one starts
+        :param code: additional code files of the stage (the command's script and its imports are found as is)
+        :param key: any other value the output depends on, e.g. the version date of a stage reading a live database
+        :param always_run: never skipped, e.g. publishing
+        """
+        self.name = name
+        self.command = list(command) if command is not None else None
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.dependencies = list(dependencies)
+        self.code = list(code)
+        self.key = key
+        self.always_run = always_run
+
+    def fingerprint(self):
+        """
+        :return: hash of the stage's command, code and inputs
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps([self.name, self.command, self.key]).encode('utf-8'))
+        code_files = list(self.code)
+        if self.command is not None and self.command[0].endswith('.py'):
+            code_files += get_code_files(self.command[0])
+        if self.function is not None:
+            code_files += get_code_files(os.path.abspath(__file__))
+        for path in sorted(set(code_files)) + self.inputs:
+            hash_path(path, digest)
+        return digest.hexdigest()
+
+    def run(self):
+        if self.command is not None:
+            subprocess.run([sys.executable] + self.command, check=True)
+        if self.function is not None:
+            self.function()
+
+
+class BuildRunner(object):
+    """
+    Runs the stages of a build as a dependency graph: every stage starts once its dependencies finished, so independent
+    branches run in parallel. A stage whose fingerprint (command, code and inputs) did not change since its last
+    successful run, and whose outputs exist, is skipped - so re-running a failed build only runs the stages from the
+    failure on.
+    """
+
+    def __init__(self, stages, state_path, max_parallel_stages=3, forced_stages=()):
+        """
+        :param state_path: json of the fingerprints of the stages' last successful runs
+        :param forced_stages: names of stages to run even if their outputs are valid
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            unknown_dependencies = [name for name in stage.dependencies if name not in self.stages]
+            if unknown_dependencies:
+                raise ValueError(f"Stage {stage.name} depends on unknown stages {unknown_dependencies}")
+        cycle_stages = self._get_cycle_stages()
+        if cycle_stages:
+            raise ValueError(f"Stages {cycle_stages} depend on each other")
+        self.state_path = state_path
+        self.max_parallel_stages = max_parallel_stages
+        self.forced_stages = set(forced_stages)
+        self.state = {}
+        self.state_lock = threading.Lock()
+        if os.path.exists(state_path):
+            with open(state_path) as state_file:
+                self.state = json.load(state_file)
+
+    def _get_cycle_stages(self):
+        """
+        :return: names of the stages that can never run since they (indirectly) depend on themselves
+        """
+        ordered = set()
+        remaining = dict(self.stages)
+        while True:
+            ready = [name for name, stage in remaining.items() if set(stage.dependencies) <= ordered]
+            if not ready:
+                return sorted(remaining)
+            for name in ready:
+                ordered.add(name)
+                del remaining[name]
+
+    def _save_state(self):
+        state_dir = os.path.dirname(self.state_path)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(self.state, state_file, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def _is_valid(self, stage, fingerprint):
+        return not stage.always_run and stage.name not in self.forced_stages and \
+            self.state.get(stage.name) == fingerprint and all(os.path.exists(path) for path in stage.outputs)
+
+    def _run_stage(self, stage):
+        """
+        :return: True if the stage ran, False if its outputs were still valid
+        """
+        # fingerprinted when the stage starts, after its dependencies wrote its inputs
+        fingerprint = stage.fingerprint()
+        if self._is_valid(stage, fingerprint):
+            print(f'Skipping {stage.name}, its outputs are up to date')
+            return False
+        print(f'Running {stage.name}')
+        start = time.perf_counter()
+        stage.run()
+        print(f'Finished {stage.name} in {time.perf_counter() - start:.1f}s')
+        with self.state_lock:
+            self.state[stage.name] = fingerprint
+            self._save_state()
+        return True
+
+    def run(self):
+        """
+        :return: True if all the stages succeeded. After a failure the running stages are waited for and no new ones
+        are started.
+        """
+        pending, running, done = dict(self.stages), {}, set()
+        failed = False
+        with ThreadPoolExecutor(max_workers=self.max_parallel_stages) as executor:
+            while pending or running:
+                if not failed:
+                    for name, stage in list(pending.items()):
+                        if len(running) < self.max_parallel_stages and set(stage.dependencies) <= done:
+                            running[executor.submit(self._run_stage, stage)] = name
+                            del pending[name]
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                    except Exception as e:
+                        print(f'Failed {name}: {e}')
+                        failed = True
+        if pending and failed:
+            print(f'Not run: {", ".join(pending)}')
+        elif pending:
+            print(f'Not run, their dependencies never finished: {", ".join(pending)}')
+            return False
+        return not failed
+
+
+def copy_directory_files(source_dir, dest_dir):
+    for path in glob(os.path.join(source_dir, '*')):
+        shutil.copy(path, dest_dir)
+
+
+def zip_directory(directory, zip_path):
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as version_zip:
+        for root, _, names in sorted(os.walk(directory)):
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                if os.path.abspath(path) != os.path.abspath(zip_path):
+                    version_zip.write(path, os.path.relpath(path, directory))
+
+
+def get_stages(version, version_dir, metrics_dir, sync_dir='data/aact_sync', release_dir='../../..',
+               release_formats=RELEASE_FORMATS, started_at=None):
+    """
+    The stages of a C-DCDB version. AACT's branch (combinations, identifiers, normalization) and the orange book
+    branch run in parallel, both after the local identifiers index so they don't write to the resolvers' disk caches
+    while it is built from them.
+    :param release_formats: formats the tables are exported to besides csv (sqlite and/or parquet)
+    :param started_at: time.time() of the build's start, for its total wall time, now by default
+    """
+    started_at = started_at if started_at is not None else time.time()
+    aact_combs_path = os.path.join(version_dir, 'aact_combs.parquet')
+    aact_with_identifiers_path = os.path.join(version_dir, 'aact_combs__with_identifiers.parquet')
+    orange_book_path = os.path.join(version_dir, 'orangebook_combs_df.csv')
+    patents_paths = [os.path.join(version_dir, os.path.basename(path)) for path in glob('input_data/patents/*')]
+    zip_path = os.path.join(version_dir, f'{version}.zip')
+    unnormalized_paths = [os.path.join(version_dir, 'all_combs_unormalized.csv'),
+                          os.path.join(version_dir, 'web_preview.csv')]
+    release_export_args, release_export_outputs = [], []
+    if 'sqlite' in release_formats:
+        release_export_args += ['--sqlite_path', os.path.join(version_dir, RELEASE_SQLITE_NAME)]
+        release_export_outputs.append(os.path.join(version_dir, RELEASE_SQLITE_NAME))
+    if 'parquet' in release_formats:
+        release_export_args += ['--parquet_dir', os.path.join(version_dir, RELEASE_PARQUET_DIR_NAME)]
+        release_export_outputs.append(os.path.join(version_dir, RELEASE_PARQUET_DIR_NAME))
+    # the version is published once all its tables are written
+    tables_stages = ['create_unnormalized_combs_db'] + (['release_export'] if release_export_args else [])
+
+    def save_aact_sync():
+        # the previous sync is replaced only by a complete copy, so a failed copy doesn't lose it
+        sync_path = os.path.join(sync_dir, 'aact_combs.parquet')
+        tmp_sync_path = f'{sync_path}.tmp'
+        shutil.rmtree(tmp_sync_path, ignore_errors=True)
+        try:
+            shutil.copytree(aact_combs_path, tmp_sync_path)
+        except Exception:
+            # the watermark was already advanced past the kept sync, the next build fetches everything again
+            watermark_path = os.path.join(sync_dir, 'watermark.json')
+            if os.path.exists(watermark_path):
+                os.remove(watermark_path)
+            raise
+        if os.path.isfile(sync_path):
+            os.remove(sync_path)
+        shutil.rmtree(sync_path, ignore_errors=True)
+        os.replace(tmp_sync_path, sync_path)
+
+    def publish():
+        zip_directory(version_dir, zip_path)
+        shutil.copy(zip_path, os.path.join(release_dir, 'versions'))
+        shutil.copy(os.path.join(version_dir, 'web_preview.csv'), os.path.join(release_dir, 'latestVersion'))
+        with open(os.path.join(release_dir, 'latestVersion', 'date.txt'), 'w') as date_file:
+            date_file.write(datetime.datetime.now().strftime('%d %b %Y') + '\n')
+
+    return [
+        # names known from drugbank/wikidata or resolved in previous versions are resolved offline
+        BuildStage('local_identifiers_index',
+                   command=['../drug_identfiers_resolver/local_identifiers_index.py',
+                            '--wikidata_cache', 'wikidata_disk_cache', '--drugbank_cache', 'dbid_disk_cache',
+                            '--metrics_path', os.path.join(metrics_dir, 'local_identifiers_index.json'),
+                            LOCAL_INDEX_PATH],
+                   # the disk caches grow during every run, so they are not fingerprinted (that would invalidate
+                   # everything downstream on a re-run), the index is rebuilt once per version
+                   inputs=['input_data/drugbank_drug_names.csv', 'input_data/qid_to_drugbank.json',
+                           'input_data/qid_to_pubchem.json'],
+                   key=version, outputs=[LOCAL_INDEX_PATH]),
+        # AACT is a live database, its combinations are valid for the version's date
+        BuildStage('clinical_trials_combinations',
+                   command=['clinical_trials_combinations.py', '--chunk_size', '50000',
+                            '--aact_params_file_path', 'input_data/aact_credentials.json',
+                            '--watermark_path', os.path.join(sync_dir, 'watermark.json'),
+                            '--previous_path', os.path.join(sync_dir, 'aact_combs.parquet'),
+                            '--metrics_path', os.path.join(metrics_dir, 'clinical_trials_combinations.json'),
+                            aact_combs_path],
+                   function=save_aact_sync, key=version, outputs=[aact_combs_path]),
+        BuildStage('add_identifier_to_df',
+                   command=['add_identifier_to_df.py', '--as_str_array', 'True', '--async_resolution',
+                            '--local_index', LOCAL_INDEX_PATH, '--cache_stats_path', 'data/resolver_cache_stats.json',
+                            '--metrics_path', os.path.join(metrics_dir, 'add_identifier_to_df.json'),
+                            aact_combs_path, 'selected_name', 'identifiers_entity', aact_with_identifiers_path],
+                   inputs=[aact_combs_path, LOCAL_INDEX_PATH], outputs=[aact_with_identifiers_path],
+                   dependencies=['clinical_trials_combinations', 'local_identifiers_index']),
+        BuildStage('schema_transforming',
+                   command=['schema_transforming.py',
+                            '--metrics_path', os.path.join(metrics_dir, 'schema_transforming.json'),
+                            aact_with_identifiers_path, version_dir, 'input_data/dbid_to_compound.csv'],
+                   inputs=[aact_with_identifiers_path, 'input_data/dbid_to_compound.csv',
+                           'input_data/drugbank_nutraceuticals.xlsx'],
+                   outputs=[os.path.join(version_dir, table) for table in NORMALIZED_TABLES],
+                   dependencies=['add_identifier_to_df']),
+        BuildStage('orange_book',
+                   command=['orange_book.py', '--local_index', LOCAL_INDEX_PATH,
+                            '--metrics_path', os.path.join(metrics_dir, 'orange_book.json'),
+                            'input_data/orange_book', orange_book_path],
+                   inputs=['input_data/orange_book', LOCAL_INDEX_PATH], outputs=[orange_book_path],
+                   dependencies=['local_identifiers_index']),
+        BuildStage('patents', function=lambda: copy_directory_files('input_data/patents', version_dir),
+                   inputs=['input_data/patents'], outputs=patents_paths),
+        BuildStage('create_unnormalized_combs_db',
+                   command=['create_unnormalized_combs_db.py',
+                            '--metrics_path', os.path.join(metrics_dir, 'create_unnormalized_combs_db.json'),
+                            version_dir, version_dir],
+                   inputs=[os.path.join(version_dir, table) for table in NORMALIZED_TABLES] +
+                          [orange_book_path, 'input_data/drugbank_drug_names.csv'] + patents_paths,
+                   outputs=unnormalized_paths, dependencies=['schema_transforming', 'orange_book', 'patents']),
+        BuildStage('release_export',
+                   command=['release_export.py', '--metrics_path', os.path.join(metrics_dir, 'release_export.json')] +
+                           release_export_args + [version_dir],
+                   inputs=[os.path.join(version_dir, table) for table in NORMALIZED_TABLES] + unnormalized_paths[:1],
+                   outputs=release_export_outputs, dependencies=['create_unnormalized_combs_db']),
+        BuildStage('merge_metrics',
+                   function=lambda: merge_metrics(metrics_dir, f'{version_dir}_metrics.json', started_at),
+                   dependencies=tables_stages, always_run=True),
+        BuildStage('publish', function=publish, dependencies=tables_stages, always_run=True),
+    ]
+
+
+def main(args):
+    version_dir = os.path.join('data/final_schema', args.version)
+    metrics_dir = f'{version_dir}_metrics'
+    for directory in [version_dir, metrics_dir, 'data/aact_sync']:
+        os.makedirs(directory, exist_ok=True)
+    print('Creating new version for C-DCDB')
+    print('Current Date', args.version)
+    stages = get_stages(args.version, version_dir, metrics_dir, release_formats=args.release_formats)
+    if not args.release_formats:
+        stages = [stage for stage in stages if stage.name != 'release_export']
+    if args.skip_publish:
+        stages = [stage for stage in stages if stage.name != 'publish']
+    runner = BuildRunner(stages, os.path.join(STATE_DIR, f'{args.version}.json'), args.parallel_stages,
+                         args.force)
+    return runner.run()
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Builds a C-DCDB version, skipping the stages whose outputs "
+                                                          "are up to date")
+    argument_parser.add_argument("--version", default=datetime.datetime.now().strftime('%d.%m.%Y'), type=str,
+                                 help="version name (date), the tables are written to data/final_schema/<version>")
+    argument_parser.add_argument("--parallel_stages", default=3, type=int,
+                                 help="max number of stages run at the same time")
+    argument_parser.add_argument("--force", default=[], nargs='*',
+                                 help="names of stages to run even if their outputs are up to date")
+    argument_parser.add_argument("--release_formats", default=list(RELEASE_FORMATS), nargs='*',
+                                 choices=RELEASE_FORMATS,
+                                 help="indexed formats the tables are exported to besides csv (none for csv only)")
+    argument_parser.add_argument("--skip_publish", action='store_true',
+                                 help="don't copy the zip and the web preview to the versions directories")
+    args = argument_parser.parse_args()
+    os.chdir(DRUG_COMBS_DIR)
+    if not main(args):
+        exit(1)
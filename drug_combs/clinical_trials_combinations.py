@@ -4,30 +4,87 @@ sys.path.insert(0, '../..')
 
 import edlib
 from functools import lru_cache
-from src.drug_combs.aact_fetcher import AACTFetcher
+from src.drug_combs.aact_fetcher import AACTFetcher, DEFAULT_CHUNK_SIZE, read_watermark, write_watermark
+from src.drug_combs.tables_io import read_parquet, read_parquet_parts, read_table, write_table, \
+    write_parquet_part, parse_list_cell
 from src.drug_combs.add_identifier_to_df import DataframeDrugIdentifiersAdder
+from src.drug_combs.drug_names_cleaning import clean_drug_names
+from src.drug_combs.instrumentation import get_metrics
 from src.drug_identfiers_resolver.identifiers_resolver import *
-import re
+import gc
+from glob import glob
+import multiprocessing
+import os
+import numpy as np
 import json
 import argparse
 import warnings
 import diskcache as dc
+from tqdm import tqdm
 
-import spacy
-from scispacy.linking import EntityLinker
+warnings.filterwarnings("ignore")
+SPACY_MODEL = "en_core_sci_lg"
+# only the NER component is used, the linker works on its entities
+TRIMMED_PIPELINE_DISABLED_COMPONENTS = ["tagger", "parser"]
 
-nlp = spacy.load("en_core_sci_lg")
-linker = EntityLinker(resolve_abbreviations=True, name="umls")
+_spacy_model = SPACY_MODEL
+_nlp = None
+_linker = None
+# the preprocessor forked NER workers use, set by the parent just before forking them
+_forked_preprocessor = None
 
-nlp.add_pipe(linker)
 
-warnings.filterwarnings("ignore")
+def configure_language_model(spacy_model):
+    """
+    Sets the model to load on first use, must be called before the model is used
+    :param spacy_model: name of an installed scispacy model, or path to a pipeline saved by save_trimmed_pipeline
+    """
+    global _spacy_model
+    _spacy_model = spacy_model
+
+
+def get_nlp():
+    """
+    The language model and the UMLS linker take tens of seconds and several GB to load, so they are loaded only
+    when entities are extracted (and not on import, e.g. for --help or in processes importing this module)
+    :return: the language model, with the UMLS linker in its pipeline
+    """
+    global _nlp, _linker
+    if _nlp is None:
+        import spacy
+        from scispacy.linking import EntityLinker
+
+        print(f"Loading language model {_spacy_model}")
+        _nlp = spacy.load(_spacy_model)
+        _linker = EntityLinker(resolve_abbreviations=True, name="umls")
+        _nlp.add_pipe(_linker)
+    return _nlp
+
+
+def get_linker():
+    get_nlp()
+    return _linker
+
+
+def save_trimmed_pipeline(output_path, spacy_model=SPACY_MODEL):
+    """
+    Saves the model without the components entity extraction doesn't use, so it loads faster and takes less memory
+    :param output_path: directory to save the pipeline to, to be passed later to configure_language_model
+    """
+    import spacy
+
+    trimmed_nlp = spacy.load(spacy_model, disable=TRIMMED_PIPELINE_DISABLED_COMPONENTS)
+    trimmed_nlp.to_disk(output_path)
+    print(f"Saved {trimmed_nlp.pipe_names} pipeline of {spacy_model} to {output_path}")
+
 DRUG_IDENTIFIERS_COLUMN = "drug_identifiers"
 
 INTERVENTIONS_WITH_OTHER_NAMES_COL = 'interventions_with_other_names'
 
 INTERVENTIONS_NAMES_COL = 'interventions_names'
 INTERVENTIONS_NAMES_CLEANED_COL = 'interventions_names_cleaned'
+MULTIPLE_ENTITIES_ERROR = 'ERROR: contained more than one entity-should drop'
+ERRORS_PATH = "errors.csv"
 
 drugs_TUIs = {
     "T109", "T114", "T116", "T121", "T123", "T125", "T126", "T129", "T195", "T200"
@@ -36,6 +93,15 @@ drugs_TUIs = {
 # not_allowed_TUIs = {"T127", "T197"}
 
 
+def build_drug_alias_index(kb):
+    """
+    :param kb: UMLS knowledge base of the linker
+    :return: dict of CUI to (canonical name, aliases) of the concepts with at least one of the drugs TUIs
+    """
+    return {cui: (entity.canonical_name, tuple(entity.aliases)) for cui, entity in kb.cui_to_entity.items()
+            if not drugs_TUIs.isdisjoint(entity.types)}
+
+
 class DataPreProcessor(object):
     """
     Used to clean the data and add relevant fields like drug identifier
@@ -47,17 +113,30 @@ class DataPreProcessor(object):
     def _process(self, raw_df, pipeline_functions):
         result_df = raw_df
         for processing_function in pipeline_functions:
-            result_df = processing_function(result_df)
+            with get_metrics().stage(processing_function.__name__, len(result_df)) as stage_record:
+                result_df = processing_function(result_df)
+                stage_record.rows_out = len(result_df)
         return result_df
 
 
 class AACTDataPreProcessor(DataPreProcessor):
 
     def __init__(self, drug_identifiers_resolver: DrugIdentifiersResolver, drug_resolving_threads=16,
-                 ner_cache_path='NER-mappings.cache'):
+                 ner_cache_path='NER-mappings.cache', ner_batch_size=256, ner_n_process=1, ner_workers=1):
+        """
+        :param ner_batch_size: number of names the language model processes per batch
+        :param ner_n_process: number of processes the language model uses for the names
+        :param ner_workers: number of forked workers sharing the parent's model, each recognizing shards of names
+        """
         super().__init__()
         self.drug_identifiers_resolver = drug_identifiers_resolver
         self.cache = dc.Cache(ner_cache_path)
+        self.ner_batch_size = ner_batch_size
+        self.ner_n_process = ner_n_process
+        self.ner_workers = ner_workers
+        self._drug_alias_index = None
+        # the NER errors of every chunk are appended to the errors file, the first chunk's overwrite it
+        self.errors_written = False
 
     def preprocess(self, raw_df: pd.DataFrame) -> pd.DataFrame:
         functions_pipe = [
@@ -70,48 +149,19 @@ class AACTDataPreProcessor(DataPreProcessor):
         ]
         return self._process(raw_df, functions_pipe)
 
-    def remove_special_words(self, x):
-        words_to_remove = ["single", "dose", "low", "slow", "soft tissue", "solid", "spray", "stable", "subarachnoid",
-                           "subconjunctival", "subcutaneous", "sublingual", "sublingual", "submucosal", "suppositories",
-                           "sustained-release", "tablet", "tablets", "therapy", "topical", "transdermal",
-                           "transmucosal", "transplacental", "transtracheal", "transtympanic", "treatment", "troches",
-                           "ureteral", "urethral", "usual care", "vaginal", "%", "mg", "kg", "mg/day", "oral",
-                           "suspension", "low dose", "fixed", "combination", "drops"]
-        words = x.split()
-        result = ' '.join([word for word in words if word.lower() not in words_to_remove])
-        return result.strip()
-
-    def clean_drug_name(self, x, regexes):
-        x = str(x)
-        x = self.remove_special_words(x)
-        x = re.sub('"|\'|mg/day|,|•|™|®|(?i)oral\\b|(?i)IV\\b', '', x).strip()
-        x = re.sub('α', 'alfa', x).strip()
-        x = re.sub('[μμμµ]', 'μ', x).strip()
-        x = re.sub('[-+]?\d*\.?\d*%', '', x).strip()
-        x = re.sub('([-+]?\d*\.\d*)', '', x).strip()
-        for regex in regexes:
-            res = regex.findall(x)
-            if res != []:
-                x = res[0]
-        return x.strip()
-
     def clean_drug_names(self, df: pd.DataFrame) -> pd.DataFrame:
-        comparator_regex = re.compile('Comparator: (.*)')
-        remove_mg_kg = re.compile('^(.*?)(?:(?:\/\d)|(?: \d)|(?:,(?:.*)\d)).*?(?:mg|kg|μg|mcg)(?:.*?)$')
-        remove_percentage_from_start = re.compile('[-+]?\d*\.?\d*%(?: )?(.*?)$')
-        remove_dosage_before = re.compile('^\d.*(?:mg|kg|μg|mcg|µg)(.*?)$')
-        remove_par = re.compile('^(.*?)\(.*?\).*$')
-        remove_rect_par = re.compile('^(.*?)\[.*?\].*$')
-        regs = [comparator_regex, remove_mg_kg, remove_percentage_from_start, remove_dosage_before, remove_par,
-                remove_rect_par]
         # logging.info("cleaning drug names")
-        df[INTERVENTIONS_NAMES_CLEANED_COL] = df[INTERVENTIONS_NAMES_COL].progress_apply(
-            lambda names: [self.clean_drug_name(name, regs) for name in names])
+        names_lists = df[INTERVENTIONS_NAMES_COL].tolist()
+        # all the names are cleaned at once (each distinct name once), then split back to the rows' lists
+        cleaned_names = clean_drug_names(pd.Series([name for names in names_lists for name in names],
+                                                   dtype=object)).tolist()
+        bounds = np.cumsum([0] + [len(names) for names in names_lists])
+        df[INTERVENTIONS_NAMES_CLEANED_COL] = [cleaned_names[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
         return df
 
     def flatten_interventions(self, df: pd.DataFrame) -> pd.DataFrame:
         # logging.info("flattening interventions array")
-        df[INTERVENTIONS_NAMES_COL] = df[INTERVENTIONS_WITH_OTHER_NAMES_COL].astype(str).apply(self.flatten_array)
+        df[INTERVENTIONS_NAMES_COL] = df[INTERVENTIONS_WITH_OTHER_NAMES_COL].apply(self.flatten_array)
         return df
 
     def replace_placebo(self, interventions_names):
@@ -134,38 +184,57 @@ class AACTDataPreProcessor(DataPreProcessor):
         return df
 
     def flatten_array(self, arr):
-        arr = eval(arr)
+        arr = parse_list_cell(arr)
         return [arr[0]] + arr[1]
 
     def extract_entities(self, df: pd.DataFrame):
-        selected_name = df[INTERVENTIONS_NAMES_CLEANED_COL].progress_apply(self.extract_entities_from_list)
-        df['selected_name'] = selected_name
-        errors = df[df['selected_name'].apply(
-            lambda x: x == [] or x == 'ERROR: contained more than one entity-should drop')]
-        errors.to_csv("errors.csv")
+        drugs_lists = df[INTERVENTIONS_NAMES_CLEANED_COL]
+        names = pd.unique(drugs_lists[drugs_lists.apply(lambda x: x != ['placebo'])].explode().dropna())
+        names_to_entities = self.get_names_entities(names)
+        df['selected_name'] = drugs_lists.apply(lambda x: self.extract_entities_from_list(x, names_to_entities))
+        errors = df[df['selected_name'].apply(lambda x: x == [] or x == MULTIPLE_ENTITIES_ERROR)]
+        errors.to_csv(ERRORS_PATH, mode='a' if self.errors_written else 'w', header=not self.errors_written)
+        self.errors_written = True
         df = df[~df['design_group_id'].isin(errors['design_group_id'].unique())]
         return df
 
-    @lru_cache(50000)
+    def get_drug_alias_index(self):
+        if self._drug_alias_index is None:
+            self._drug_alias_index = build_drug_alias_index(get_linker().kb)
+        return self._drug_alias_index
+
     def get_most_relevant_name(self, ent):
-        min_alias_val = 9999999
+        candidate_cuis = tuple(kb_ent[0] for kb_ent in ent._.kb_ents)
+        return self.get_most_relevant_name_for(str(ent), candidate_cuis)
+
+    @lru_cache(50000)
+    def get_most_relevant_name_for(self, ent_str, candidate_cuis):
+        """
+        :param ent_str: text of the entity
+        :param candidate_cuis: CUIs the linker found for the entity, in order of relevance
+        :return: canonical name of the drug concept that has the closest alias to the entity (first one on ties),
+        None if none of the candidates is a drug
+        """
+        drug_alias_index = self.get_drug_alias_index()
+        min_alias_val = None
         min_alias = None
-        ent_str = str(ent)
-        all_types = []
-        for x in ent._.kb_ents:
-            entity = linker.kb.cui_to_entity[x[0]]
-            all_types += entity.types
-            contains_at_least_one_require_type = len(drugs_TUIs - set(entity.types)) != len(drugs_TUIs)
-            if contains_at_least_one_require_type:
-                for alias in entity.aliases:
-                    distance = edlib.align(alias, ent_str)['editDistance']
-                    if distance < min_alias_val:
-                        min_alias_val = distance
-                        min_alias = entity.canonical_name
-
-        # contains_unwanted_tui = len(not_allowed_TUIs) != len(not_allowed_TUIs - set(all_types))
-        # if contains_unwanted_tui:
-        #     return None
+        for cui in candidate_cuis:
+            drug_concept = drug_alias_index.get(cui)
+            if drug_concept is None:
+                continue
+            canonical_name, aliases = drug_concept
+            for alias in aliases:
+                if alias == ent_str:
+                    # nothing is closer than an exact match
+                    return canonical_name
+                if min_alias_val is not None and abs(len(alias) - len(ent_str)) >= min_alias_val:
+                    # the edit distance is at least the length difference, so this alias can't be closer
+                    continue
+                max_distance = -1 if min_alias_val is None else min_alias_val - 1
+                distance = edlib.align(alias, ent_str, k=max_distance)['editDistance']
+                if distance != -1:
+                    min_alias_val = distance
+                    min_alias = canonical_name
         return min_alias
 
     def resolve_details(self, list_of_drugs):
@@ -176,31 +245,102 @@ class AACTDataPreProcessor(DataPreProcessor):
                 if syn:
                     umls_concepts = syn[0].ents[0]._.umls_ents
                     for concept in umls_concepts:
-                        resolved_concept = linker.kb.cui_to_entity[concept[0]]
+                        resolved_concept = get_linker().kb.cui_to_entity[concept[0]]
                         syns_res.append(resolved_concept)
             res.append(syns_res)
         return res
 
-    def extract_entities_from_list(self, drugs_list):
+    def get_names_entities(self, names):
+        """
+        Each distinct name is looked up in the cache once, and all the names missing from it are recognized
+        together in batches
+        :param names: distinct drug names
+        :return: dict of name to its entity name, None if no relevant entity, or MULTIPLE_ENTITIES_ERROR
+        """
+        names_to_entities = {}
+        names_to_recognize = []
+        for name in names:
+            entity_name = self.cache.get(name)
+            if entity_name is None:
+                names_to_recognize.append(name)
+            else:
+                names_to_entities[name] = entity_name
+        print(f"{len(names_to_entities)} of {len(names)} distinct names were found in the NER cache")
+        get_metrics().add_counts('ner_cache', hits=len(names_to_entities), misses=len(names_to_recognize))
+        names_to_entities.update(self.recognize_names(names_to_recognize))
+        return names_to_entities
+
+    def recognize_names(self, names):
+        """
+        Runs the names through the language model with nlp.pipe (split between forked workers if ner_workers > 1)
+        and caches the recognized entities
+        :return: dict of name to its entity name, None if no relevant entity, or MULTIPLE_ENTITIES_ERROR
+        """
+        if self.ner_workers > 1 and len(names) > self.ner_batch_size:
+            names_to_entities = self._recognize_names_in_workers(names)
+        else:
+            names_to_entities = dict(tqdm(self._recognize_names(names, self.ner_n_process), total=len(names),
+                                          desc="Recognizing drug names"))
+        # the workers only return their results, the cache has a single writer
+        for name, entity_name in names_to_entities.items():
+            if entity_name is not None and entity_name != MULTIPLE_ENTITIES_ERROR:
+                self.cache[name] = entity_name
+        return names_to_entities
+
+    def _recognize_names(self, names, n_process=1):
+        """
+        :return: generator of (name, entity name, None if no relevant entity, or MULTIPLE_ENTITIES_ERROR)
+        """
+        docs = get_nlp().pipe([str(name) for name in names], batch_size=self.ner_batch_size, n_process=n_process)
+        for name, doc in zip(names, docs):
+            entity_name = None
+            if len(doc.ents) > 1:
+                entity_name = MULTIPLE_ENTITIES_ERROR
+            elif doc.ents:
+                entity_name = self.get_most_relevant_name(doc.ents[0])
+            yield name, entity_name
+
+    def _recognize_names_in_workers(self, names):
+        """
+        The model, the linker's KB and the drug alias index are loaded once here and inherited by the forked
+        workers copy-on-write, instead of each worker loading its own multi-GB copy
+        """
+        global _forked_preprocessor
+        get_nlp()
+        self.get_drug_alias_index()
+        # objects moved to the permanent generation are never touched by the gc, so their pages stay shared
+        gc.freeze()
+        _forked_preprocessor = self
+        shards = [names[idx:idx + self.ner_batch_size] for idx in range(0, len(names), self.ner_batch_size)]
+        names_to_entities = {}
+        try:
+            with multiprocessing.get_context('fork').Pool(self.ner_workers) as pool:
+                with tqdm(total=len(names), desc=f"Recognizing drug names in {self.ner_workers} workers") as pbar:
+                    for shard_results in pool.imap_unordered(_recognize_names_shard, shards):
+                        names_to_entities.update(shard_results)
+                        pbar.update(len(shard_results))
+        finally:
+            _forked_preprocessor = None
+            gc.unfreeze()
+        return names_to_entities
+
+    def extract_entities_from_list(self, drugs_list, names_to_entities):
         if drugs_list == ['placebo']:
             return drugs_list
         res = []
         for x in drugs_list:
-            name = self.cache.get(x)
+            name = names_to_entities[x]
+            if name == MULTIPLE_ENTITIES_ERROR:
+                return MULTIPLE_ENTITIES_ERROR
             if name is not None:
                 res.append(name)
-                continue
-            doc = nlp(str(x))
-            if doc.ents:
-                if len(doc.ents) > 1:
-                    return "ERROR: contained more than one entity-should drop"
-                name = self.get_most_relevant_name(doc.ents[0])
-                if name is not None:
-                    self.cache[x] = name
-                    res.append(name)
         return res
 
 
+def _recognize_names_shard(names):
+    return list(_forked_preprocessor._recognize_names(names))
+
+
 class DatasetCreator(object):
     """
     Used to generate the dataset of all the combinations in clinical trials, from file or from AACT DB.
@@ -208,17 +348,32 @@ class DatasetCreator(object):
 
     def __init__(self, qid_to_drugbank_path='input_data/qid_to_drugbank.json',
                  qid_to_pubchem_path='input_data/qid_to_pubchem.json', wikidata_cache_path='wikidata_cache.csv',
-                 api_cache_path=''):
+                 api_cache_path='', ner_batch_size=256, ner_n_process=1, ner_workers=1):
         self.qid_to_drugbank_path = qid_to_drugbank_path
         self.qid_to_pubchem_path = qid_to_pubchem_path
         self.wiki_cache_path = wikidata_cache_path
         self.api_cache_path = api_cache_path
+        self.ner_batch_size = ner_batch_size
+        self.ner_n_process = ner_n_process
+        self.ner_workers = ner_workers
 
-    def process_df(self, df):
+    def get_preprocessor(self):
         wikidata_ids_resolver = WikiDataIdsResolver(self.qid_to_drugbank_path, self.qid_to_pubchem_path)
         resolver = DrugIdentifiersResolver(wikidata_ids_resolver, APIBasedIdentifiersResolver(self.api_cache_path))
-        aact_preprocessor = AACTDataPreProcessor(resolver)
-        return aact_preprocessor.preprocess(df)
+        return AACTDataPreProcessor(resolver, ner_batch_size=self.ner_batch_size, ner_n_process=self.ner_n_process,
+                                    ner_workers=self.ner_workers)
+
+    def process_df(self, df):
+        return self.get_preprocessor().preprocess(df)
+
+    def process_chunks(self, chunks):
+        """
+        :param chunks: iterable of raw DataFrames, rows of a design group must not be split between chunks
+        :return: generator of processed DataFrames
+        """
+        aact_preprocessor = self.get_preprocessor()
+        for chunk in chunks:
+            yield aact_preprocessor.preprocess(chunk)
 
     def create_updated_dataset(self, aact_url, aact_db_username, aact_db_password):
         aact_fetcher = AACTFetcher(aact_url, aact_db_username, aact_db_password)
@@ -226,12 +381,124 @@ class DatasetCreator(object):
         aact_fetcher.close_connection()
         return self.process_df(up_to_date_df)
 
+    def create_incremental_dataset(self, aact_url, aact_db_username, aact_db_password, previous_df, watermark):
+        """
+        Fetches and processes only the studies updated since the watermark, and merges them into the previously
+        processed dataset: the rows of every updated study are replaced (or removed, if it no longer contains
+        combinations)
+        :param previous_df: processed dataset of the previous sync
+        :param watermark: latest study update date covered by previous_df
+        :return: (merged processed dataset, new watermark)
+        """
+        aact_fetcher = AACTFetcher(aact_url, aact_db_username, aact_db_password)
+        # an empty snapshot keeps the previous watermark
+        new_watermark = aact_fetcher.fetch_latest_update_date() or watermark
+        changed_nct_ids = aact_fetcher.fetch_changed_nct_ids(watermark)
+        changed_df = aact_fetcher.fetch_data_frame(watermark)
+        aact_fetcher.close_connection()
+        print(f"{len(changed_nct_ids)} studies were updated since {watermark}, "
+              f"{changed_df['nct_id'].nunique()} of them contain combinations")
+        unchanged_df = previous_df[~previous_df['nct_id'].isin(changed_nct_ids)]
+        if changed_df.empty:
+            return unchanged_df, new_watermark
+        return pd.concat([unchanged_df, self.process_df(changed_df)], ignore_index=True), new_watermark
+
+    def fetch_watermark(self, aact_url, aact_db_username, aact_db_password):
+        aact_fetcher = AACTFetcher(aact_url, aact_db_username, aact_db_password)
+        watermark = aact_fetcher.fetch_latest_update_date()
+        aact_fetcher.close_connection()
+        return watermark
+
+    def create_updated_dataset_chunks(self, aact_url, aact_db_username, aact_db_password,
+                                      chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Streams AACT and processes it chunk by chunk, so memory is bounded by the chunk size
+        :return: generator of processed DataFrames
+        """
+        aact_fetcher = AACTFetcher(aact_url, aact_db_username, aact_db_password)
+        try:
+            yield from self.process_chunks(aact_fetcher.fetch_data_frame_chunks(chunk_size))
+        finally:
+            aact_fetcher.close_connection()
+
+
+def write_chunks(processed_chunks, output_path):
+    """
+    Writes every processed chunk as soon as it is ready, appended to the output csv, or as a part of the output
+    parquet directory for any other output path
+    :return: total number of written rows
+    """
+    is_csv = output_path.endswith('.csv')
+    if not is_csv:
+        # a single parquet file written by an older run
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+        os.makedirs(output_path, exist_ok=True)
+        for stale_part in glob(os.path.join(output_path, 'part-*.parquet')):
+            os.remove(stale_part)
+    total_rows = 0
+    for chunk_idx, processed_chunk in enumerate(processed_chunks):
+        if is_csv:
+            processed_chunk.to_csv(output_path, index=False, mode='w' if chunk_idx == 0 else 'a',
+                                   header=chunk_idx == 0)
+        else:
+            write_parquet_part(processed_chunk, output_path, chunk_idx)
+        total_rows += len(processed_chunk)
+    return total_rows
+
+
+def write_dataset(processed_df, output_path):
+    """
+    Writes a whole dataset in the same layout as write_chunks, a parquet output is always a directory of parts
+    """
+    if output_path.endswith('.parquet'):
+        write_chunks([processed_df], output_path)
+    else:
+        write_table(processed_df, output_path)
+
+
+def create_from_aact(dataset_creator, cred, args):
+    aact_params = cred['url'], cred['username'], cred['password']
+    watermark = read_watermark(args.watermark_path) if args.watermark_path is not None else None
+    if watermark is not None and args.previous_path is not None and os.path.exists(args.previous_path):
+        print(f"Syncing studies updated since {watermark} into {args.previous_path}")
+        processed_df, new_watermark = dataset_creator.create_incremental_dataset(
+            *aact_params, read_table(args.previous_path), watermark)
+        write_dataset(processed_df, args.output_path)
+        write_watermark(args.watermark_path, new_watermark)
+        return
+    # taken before the fetch, so studies updated meanwhile are fetched again by the next sync
+    new_watermark = dataset_creator.fetch_watermark(*aact_params) if args.watermark_path is not None else None
+    if args.chunk_size is not None:
+        processed_chunks = dataset_creator.create_updated_dataset_chunks(*aact_params, args.chunk_size)
+        write_chunks(processed_chunks, args.output_path)
+    else:
+        processed_df = dataset_creator.create_updated_dataset(*aact_params)
+        write_dataset(processed_df, args.output_path)
+    if new_watermark is not None:
+        write_watermark(args.watermark_path, new_watermark)
+
 
 def main(args):
-    dataset_creator = DatasetCreator()
-    if args.input_path is not None:
+    if args.save_trimmed_pipeline is not None:
+        save_trimmed_pipeline(args.save_trimmed_pipeline)
+        return
+    if args.output_path is None:
+        exit("You must provide an output path")
+    configure_language_model(args.spacy_model)
+    dataset_creator = DatasetCreator(ner_batch_size=args.ner_batch_size, ner_n_process=args.ner_processes,
+                                     ner_workers=args.ner_workers)
+    if args.input_path is not None and os.path.isdir(args.input_path):
+        # partitioned parquet written by aact_fetcher.py, processed one part at a time
+        processed_chunks = dataset_creator.process_chunks(read_parquet_parts(args.input_path))
+        write_chunks(processed_chunks, args.output_path)
+    elif args.input_path is not None and args.input_path.endswith('.parquet'):
+        processed_df = dataset_creator.process_df(read_parquet(args.input_path))
+        write_dataset(processed_df, args.output_path)
+    elif args.input_path is not None:
         input_file = pd.read_csv(args.input_path)[:100]
         processed_df = dataset_creator.process_df(input_file)
+        write_dataset(processed_df, args.output_path)
     else:
         try:
             path = args.aact_params_file_path
@@ -239,10 +506,9 @@ def main(args):
                 exit("You must provide aact credentials file or input file")
             credentials_file = open(path)
             cred = json.load(credentials_file)
-            processed_df = dataset_creator.create_updated_dataset(cred['url'], cred['username'], cred['password'])
+            create_from_aact(dataset_creator, cred, args)
         except IOError as e:
             print(f"Failed to open AACT credentials file: {e}")
-    processed_df.to_csv(args.output_path, index=False)
 
 
 if __name__ == '__main__':
@@ -253,10 +519,35 @@ if __name__ == '__main__':
     parser.add_argument("--qid-to-pubchem", help="path to the qid to pubchem_id mapping file")
     parser.add_argument("--quiet", default=False)
     parser.add_argument("--input_path", default=None, type=str,
-                        help="AACT raw dataframe path, if not provided then up to date snapshot is fetched")
+                        help="AACT raw dataframe path (csv, or a directory of parquet parts written by "
+                             "aact_fetcher.py), if not provided then up to date snapshot is fetched")
+    parser.add_argument("--chunk_size", default=None, type=int,
+                        help="stream the AACT snapshot and process it in chunks of this many rows")
+    parser.add_argument("--ner_batch_size", default=256, type=int,
+                        help="number of names the language model processes per batch")
+    parser.add_argument("--ner_processes", default=1, type=int,
+                        help="number of processes the language model uses for the names")
+    parser.add_argument("--ner_workers", default=1, type=int,
+                        help="number of forked workers recognizing names with the model loaded once by the parent")
+    parser.add_argument("--watermark_path", default=None, type=str,
+                        help="path to the json file that keeps the latest study update date that was synced")
+    parser.add_argument("--previous_path", default=None, type=str,
+                        help="processed output of the previous sync, if given along with an existing watermark only "
+                             "studies updated since the watermark are fetched and merged into it")
     parser.add_argument("--aact_params_file_path", type=str,
                         help="path to file contains the db url, name and password of AACT")
-    parser.add_argument("output_path", type=str, help="path to write the output csv")
+    parser.add_argument("--spacy_model", default=SPACY_MODEL, type=str,
+                        help="scispacy model name, or path to a pipeline saved with --save_trimmed_pipeline")
+    parser.add_argument("--save_trimmed_pipeline", default=None, type=str,
+                        help="save the model without the components NER doesn't need to this path and exit")
+    parser.add_argument("--metrics_path", default=None, type=str,
+                        help="path to write the run's per-stage metrics to (json)")
+    parser.add_argument("output_path", type=str, nargs="?",
+                        help="path to write the output to, csv or parquet (a directory of parts when processed in "
+                             "chunks), parquet keeps the list columns typed for the next stages")
     args = parser.parse_args()
-    main(args)
+    with get_metrics().stage('total'):
+        main(args)
+    if args.metrics_path is not None:
+        get_metrics().write(args.metrics_path)
     # usage example python clinical_trials_combinations.py --input_path aact_unaggregated_data.csv data/clinical_trials_comb.csv
@@ -0,0 +1,297 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from aiohttp import web
+import sys
+sys.path.insert(0, '../..')
+from src.drug_combs.combinations_index import CombinationsIndex, SOURCES, IDENTIFIERS_COLUMNS
+from src.drug_combs.tables_io import read_table, parse_list_cell
+from src.drug_identfiers_resolver.local_identifiers_index import normalize_name
+
+UNNORMALIZED_TABLE_NAMES = ['all_combs_unormalized.csv', 'parquet/all_combs_unormalized']
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+DEFAULT_RESPONSE_CACHE_SIZE = 10000
+DEFAULT_MAX_AGE = 3600
+# query parameter -> identifier type, every value of the parameter must be in the combination
+IDENTIFIERS_PARAMS = {'drugbank_id': 'drugbank', 'pubchem_id': 'pubchem'}
+RESPONSE_COLUMNS = ['drugs', 'drugbank_identifiers', 'pubchem_identifiers', 'source', 'source_id']
+EMPTY_ROWS = np.array([], dtype=np.int64)
+
+
+def _get_names(drugs):
+    """
+    :return: every name of a combination's drugs, AACT's drugs are [selected name, other names]
+    """
+    if isinstance(drugs, str):
+        return [drugs]
+    if isinstance(drugs, (list, tuple)):
+        return [name for drug in drugs for name in _get_names(drug)]
+    return []
+
+
+def _build_inverted_index(keys_per_row) -> dict:
+    """
+    :param keys_per_row: the keys of every row (e.g. its normalized drug names)
+    :return: key to the sorted distinct rows it appears in
+    """
+    pairs = pd.DataFrame([(key, row) for row, keys in enumerate(keys_per_row) for key in set(keys)],
+                         columns=['key', 'row'])
+    if pairs.empty:
+        return {}
+    return {key: np.sort(rows.values) for key, rows in pairs.groupby('key')['row']}
+
+
+class CombinationsRelease(object):
+    """
+    A released version loaded once into memory: the combinations index (drugbank / pubchem ids and sources), and
+    inverted indexes of the combinations' drug names, and of their trials' conditions and MeSH terms
+    """
+
+    def __init__(self, combs_df: pd.DataFrame, conditions_df: pd.DataFrame = None, mesh_terms_df: pd.DataFrame = None,
+                 etag=''):
+        """
+        :param etag: identifies the release's content, part of every response's ETag
+        """
+        if 'combination_id' in combs_df.columns:
+            # the partitioned parquet is read back grouped by source, the stored ids keep the csv / sqlite order
+            combs_df = combs_df.sort_values('combination_id', kind='stable')
+        combs_df = combs_df.reset_index(drop=True)
+        for column in ['drugs'] + list(IDENTIFIERS_COLUMNS.values()):
+            combs_df[column] = combs_df[column].map(lambda value: [] if isinstance(value, float) else
+                                                    parse_list_cell(value))
+        combs_df['source_id'] = combs_df['source_id'].astype(str)
+        combs_df['source'] = combs_df['source'].astype(str)
+        self.combs_df = combs_df
+        # the csv table has no ids, release_export.py numbers its rows in order
+        self.combination_ids = combs_df['combination_id'].values.astype(np.int64) \
+            if 'combination_id' in combs_df.columns else np.arange(len(combs_df), dtype=np.int64)
+        self.combination_rows = {int(combination_id): row for row, combination_id in enumerate(self.combination_ids)}
+        # rows are read from the columns' arrays, much faster than pandas' row access
+        self.columns = {column: combs_df[column].values for column in RESPONSE_COLUMNS}
+        self.combinations_index = CombinationsIndex(combs_df)
+        self.etag = etag
+        self.names_index = _build_inverted_index(
+            [[normalize_name(name) for name in _get_names(drugs)] for drugs in combs_df['drugs']])
+        # a trial's combinations are the clinicaltrials.gov rows of its nct_id
+        trial_rows = combs_df[combs_df['source'] == 'clinicaltrials.gov'].groupby('source_id').groups
+        self.conditions_index = self._get_trials_terms_index(conditions_df, 'condition_downcase', trial_rows)
+        self.mesh_terms_index = self._get_trials_terms_index(mesh_terms_df, 'mesh_terms_downcase', trial_rows)
+
+    @staticmethod
+    def _get_trials_terms_index(terms_df, term_col, trial_rows) -> dict:
+        if terms_df is None:
+            return {}
+        nct_ids_per_term = terms_df.dropna(subset=[term_col]).groupby(term_col)['nct_id'].unique()
+        return {term: np.unique(np.concatenate([trial_rows[nct_id] for nct_id in nct_ids if nct_id in trial_rows]
+                                               or [EMPTY_ROWS])).astype(np.int64)
+                for term, nct_ids in nct_ids_per_term.items()}
+
+    @classmethod
+    def load(cls, version_dir):
+        """
+        :param version_dir: directory of a version's tables (the unnormalized combinations, conditions and mesh terms)
+        """
+        combs_path = next((os.path.join(version_dir, name) for name in UNNORMALIZED_TABLE_NAMES
+                           if os.path.exists(os.path.join(version_dir, name))), None)
+        if combs_path is None:
+            raise FileNotFoundError(f"No unnormalized combinations table in {version_dir}")
+        # read_csv's default would parse the orange book's 'N/A' source ids as nan
+        combs_df = read_table(combs_path) if not combs_path.endswith('.csv') else \
+            pd.read_csv(combs_path, converters={'source_id': str})
+        tables = {}
+        for name in ['conditions_df', 'mesh_terms_df']:
+            path = os.path.join(version_dir, f'{name}.csv')
+            tables[name] = pd.read_csv(path, dtype=str) if os.path.exists(path) else None
+        # the release's content changes with its tables
+        digest = hashlib.sha1()
+        for path in [combs_path] + [os.path.join(version_dir, f'{name}.csv') for name in tables]:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                digest.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+        return cls(combs_df, tables['conditions_df'], tables['mesh_terms_df'], digest.hexdigest()[:16])
+
+    def __len__(self):
+        return len(self.combs_df)
+
+    def query(self, drug_names=(), condition=None, mesh_term=None, sources=None, exact=False, **identifiers):
+        """
+        Every given filter must match (e.g. drug names and a condition are the combinations of these drugs tested for
+        the condition)
+        :param identifiers: drugbank / pubchem (identifier type) to the identifiers of the drugs of the combinations
+        :param exact: the combinations of exactly the given identifiers
+        :return: sorted rows of the combinations
+        """
+        rows = None
+        for identifier_type, identifiers_values in identifiers.items():
+            if identifiers_values:
+                query = self.combinations_index.exact if exact else self.combinations_index.containing
+                rows = self._intersect(rows, query(identifiers_values, identifier_type).astype(np.int64))
+        for drug_name in drug_names:
+            rows = self._intersect(rows, self.names_index.get(normalize_name(drug_name), EMPTY_ROWS))
+        if condition is not None:
+            rows = self._intersect(rows, self.conditions_index.get(condition.lower(), EMPTY_ROWS))
+        if mesh_term is not None:
+            rows = self._intersect(rows, self.mesh_terms_index.get(mesh_term.lower(), EMPTY_ROWS))
+        if rows is None:
+            rows = np.arange(len(self.combs_df))
+        return self.combinations_index.filter_sources(rows, sources)
+
+    @staticmethod
+    def _intersect(rows, other_rows):
+        return other_rows if rows is None else np.intersect1d(rows, other_rows, assume_unique=True)
+
+    def get_row(self, combination_id):
+        """
+        :return: the row of a combination_id, None if there is no such combination
+        """
+        return self.combination_rows.get(combination_id)
+
+    def get_combination(self, row) -> dict:
+        combination = {'combination_id': int(self.combination_ids[row])}
+        for column, values in self.columns.items():
+            combination[column] = values[row]
+        return combination
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU of response bodies by their canonical request, only used from the server's event loop
+    """
+
+    def __init__(self, size=DEFAULT_RESPONSE_CACHE_SIZE):
+        self.size = size
+        self.responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        response = self.responses.get(key)
+        if response is None:
+            self.misses += 1
+            return None
+        self.responses.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def set(self, key, response):
+        self.responses[key] = response
+        self.responses.move_to_end(key)
+        if len(self.responses) > self.size:
+            self.responses.popitem(last=False)
+
+
+class CombinationsAPI(object):
+    """
+    Read-only HTTP API over a release:
+    GET /combinations?drugbank_id=DB00945&drug_name=...&pubchem_id=...&condition=...&mesh_term=...&source=...
+        &exact=true&offset=0&limit=50 - paginated combinations matching all the filters (repeated ids/names are all
+        required)
+    GET /combinations/{combination_id}
+    GET /stats - the release's size and the response cache's hits
+    Responses carry an ETag of the release and the request, and are answered with 304 on a matching If-None-Match
+    """
+
+    def __init__(self, release: CombinationsRelease, response_cache_size=DEFAULT_RESPONSE_CACHE_SIZE,
+                 max_age=DEFAULT_MAX_AGE):
+        self.release = release
+        self.response_cache = ResponseCache(response_cache_size)
+        self.max_age = max_age
+        self.started_at = time.time()
+
+    def get_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([web.get('/combinations', self.handle_query),
+                        web.get('/combinations/{combination_id}', self.handle_combination),
+                        web.get('/stats', self.handle_stats)])
+        return app
+
+    def _respond(self, request, cache_key, get_body):
+        """
+        :param get_body: returns the json serializable body, called on a response cache miss
+        """
+        cached = self.response_cache.get(cache_key)
+        if cached is None:
+            body = json.dumps(get_body()).encode('utf-8')
+            etag = '"{}"'.format(hashlib.sha1(f'{self.release.etag}:{cache_key}'.encode('utf-8')).hexdigest()[:20])
+            cached = (body, etag)
+            self.response_cache.set(cache_key, cached)
+        body, etag = cached
+        headers = {'ETag': etag, 'Cache-Control': f'public, max-age={self.max_age}'}
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type='application/json', headers=headers)
+
+    @staticmethod
+    def _get_int_param(request, name, default, max_value=None):
+        try:
+            value = int(request.query.get(name, default))
+        except ValueError:
+            raise web.HTTPBadRequest(text=f"{name} must be an integer")
+        if value < 0:
+            raise web.HTTPBadRequest(text=f"{name} must be non-negative")
+        if max_value is not None and value > max_value:
+            raise web.HTTPBadRequest(text=f"{name} must be between 0 and {max_value}")
+        return value
+
+    async def handle_query(self, request):
+        offset = self._get_int_param(request, 'offset', 0)
+        limit = self._get_int_param(request, 'limit', DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        sources = request.query.getall('source', []) or None
+        unknown_sources = set(sources or []) - set(SOURCES)
+        if unknown_sources:
+            raise web.HTTPBadRequest(text=f"Unknown sources {sorted(unknown_sources)}, expected one of {SOURCES}")
+        filters = {'drug_names': request.query.getall('drug_name', []),
+                   'condition': request.query.get('condition'), 'mesh_term': request.query.get('mesh_term'),
+                   'sources': sources, 'exact': request.query.get('exact', 'false').lower() == 'true',
+                   **{identifier_type: request.query.getall(param, [])
+                      for param, identifier_type in IDENTIFIERS_PARAMS.items()}}
+        # the same filters in any order are the same response, parameters that aren't filters don't change it
+        cache_key = json.dumps(sorted((name, sorted(value) if isinstance(value, list) else value)
+                                      for name, value in filters.items()) + [offset, limit])
+
+        def get_body():
+            rows = self.release.query(**filters)
+            return {'total': len(rows), 'offset': offset, 'limit': limit,
+                    'results': [self.release.get_combination(row) for row in rows[offset:offset + limit]]}
+
+        return self._respond(request, cache_key, get_body)
+
+    async def handle_combination(self, request):
+        combination_id = request.match_info['combination_id']
+        row = self.release.get_row(int(combination_id)) if combination_id.isdigit() else None
+        if row is None:
+            raise web.HTTPNotFound(text=f"No combination {combination_id}")
+        return self._respond(request, f'combination:{int(combination_id)}', lambda: self.release.get_combination(row))
+
+    async def handle_stats(self, request):
+        return web.json_response({'combinations': len(self.release), 'release_etag': self.release.etag,
+                                  'uptime_seconds': time.time() - self.started_at,
+                                  'response_cache_hits': self.response_cache.hits,
+                                  'response_cache_misses': self.response_cache.misses})
+
+
+def main(args):
+    start = time.perf_counter()
+    release = CombinationsRelease.load(args.version_dir)
+    print(f'Loaded {len(release)} combinations in {time.perf_counter() - start:.1f}s')
+    web.run_app(CombinationsAPI(release, args.response_cache_size, args.max_age).get_app(), host=args.host,
+                port=args.port)
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Serves the combinations of a version over HTTP")
+    argument_parser.add_argument("version_dir", type=str, help="directory of the version's tables")
+    argument_parser.add_argument("--host", default='127.0.0.1', type=str)
+    argument_parser.add_argument("--port", default=8080, type=int)
+    argument_parser.add_argument("--response_cache_size", default=DEFAULT_RESPONSE_CACHE_SIZE, type=int,
+                                 help="number of responses kept in memory")
+    argument_parser.add_argument("--max_age", default=DEFAULT_MAX_AGE, type=int,
+                                 help="seconds clients may cache a response (Cache-Control max-age)")
+    main(argument_parser.parse_args())
@@ -0,0 +1,245 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import sys
+sys.path.insert(0, '../..')
+from src.drug_combs.tables_io import read_table, parse_list_cell
+from src.drug_identfiers_resolver.identifiers_resolver import MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID
+
+# identifier type -> column of the unnormalized combinations table
+IDENTIFIERS_COLUMNS = {'drugbank': 'drugbank_identifiers', 'pubchem': 'pubchem_identifiers'}
+# missing identifiers as written by the resolvers, and by the web preview
+MISSING_IDENTIFIERS = frozenset([MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID, 'NA', '', 'nan', 'None'])
+SOURCES = ['clinicaltrials.gov', 'patents', 'orangebook']
+
+
+def _csr_slices(offsets, values, rows):
+    """
+    :return: the values of all the given rows of a CSR structure concatenated, and the row (position in rows) of each
+    """
+    starts, ends = offsets[rows], offsets[rows + 1]
+    lengths = ends - starts
+    owners = np.repeat(np.arange(len(rows)), lengths)
+    positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+    return values[positions], owners
+
+
+def _parse_identifiers(value):
+    # combinations without identifiers are empty cells (nan) in csv
+    if isinstance(value, float):
+        return []
+    return parse_list_cell(value)
+
+
+class IdentifiersIndex(object):
+    """
+    The combinations of a single identifier type, integer-encoded. Every combination is its sorted distinct
+    identifier codes (CSR: combination_offsets into combination_codes), and every code has its sorted combination rows
+    (CSR: postings_offsets into postings_rows).
+    """
+
+    def __init__(self, identifiers_lists):
+        """
+        :param identifiers_lists: the identifiers of every combination, missing identifiers are ignored
+        """
+        lengths = np.fromiter((len(identifiers) for identifiers in identifiers_lists), dtype=np.int64,
+                              count=len(identifiers_lists))
+        flat_identifiers = pd.Series([str(identifier) for identifiers in identifiers_lists
+                                      for identifier in identifiers], dtype=object)
+        flat_rows = np.repeat(np.arange(len(identifiers_lists), dtype=np.int64), lengths)
+        is_known = ~flat_identifiers.isin(MISSING_IDENTIFIERS).values
+        codes, self.identifiers = pd.factorize(flat_identifiers[is_known], sort=True)
+        self.identifiers = np.asarray(self.identifiers, dtype=object)
+        self.identifier_codes = {identifier: code for code, identifier in enumerate(self.identifiers)}
+        vocabulary_size = max(len(self.identifiers), 1)
+
+        # distinct (row, code) pairs, sorted by row and then code: the canonical combinations
+        pairs = np.unique(flat_rows[is_known] * vocabulary_size + codes)
+        pair_rows, pair_codes = pairs // vocabulary_size, (pairs % vocabulary_size).astype(np.int32)
+        self.combination_codes = pair_codes
+        self.combination_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(pair_rows, minlength=len(identifiers_lists)))])
+
+        # sorted by code, a stable sort keeps the rows of a code sorted
+        order = np.argsort(pair_codes, kind='stable')
+        self.postings_rows = pair_rows[order].astype(np.int32)
+        self.postings_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(pair_codes, minlength=len(self.identifiers)))])
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def get_codes(self, identifiers):
+        """
+        :return: sorted distinct codes of the identifiers, None if one of them is in no combination
+        """
+        codes = [self.identifier_codes.get(str(identifier)) for identifier in identifiers]
+        if any(code is None for code in codes):
+            return None
+        return np.unique(np.array(codes, dtype=np.int32))
+
+    def get_postings(self, code):
+        return self.postings_rows[self.postings_offsets[code]:self.postings_offsets[code + 1]]
+
+    def get_combination_sizes(self, rows):
+        return self.combination_offsets[rows + 1] - self.combination_offsets[rows]
+
+    def containing(self, identifiers):
+        """
+        :return: sorted rows of the combinations that contain all the identifiers
+        """
+        codes = self.get_codes(identifiers)
+        # no combination contains an unknown identifier, and none is queried without identifiers
+        if codes is None or len(codes) == 0:
+            return np.array([], dtype=np.int32)
+        # intersected from the rarest identifier, so the intermediate results are at most its postings
+        postings = sorted((self.get_postings(code) for code in codes), key=len)
+        rows = postings[0]
+        for code_rows in postings[1:]:
+            if len(rows) == 0:
+                break
+            rows = np.intersect1d(rows, code_rows, assume_unique=True)
+        return rows
+
+    def exact(self, identifiers):
+        """
+        :return: sorted rows of the combinations of exactly the (distinct) identifiers
+        """
+        codes = self.get_codes(identifiers)
+        if codes is None or len(codes) == 0:
+            return np.array([], dtype=np.int32)
+        rows = self.containing(identifiers)
+        return rows[self.get_combination_sizes(rows) == len(codes)]
+
+    def get_combination(self, row):
+        """
+        :return: the sorted distinct identifiers of a combination
+        """
+        codes = self.combination_codes[self.combination_offsets[row]:self.combination_offsets[row + 1]]
+        return tuple(self.identifiers[codes])
+
+    def get_partners(self, rows, excluded_codes):
+        """
+        :return: identifier to the number of the rows' combinations it is in, most common first
+        """
+        codes, _ = _csr_slices(self.combination_offsets, self.combination_codes, rows.astype(np.int64))
+        counts = np.bincount(codes, minlength=len(self.identifiers))
+        counts[excluded_codes] = 0
+        partner_codes = np.nonzero(counts)[0]
+        partner_codes = partner_codes[np.argsort(-counts[partner_codes], kind='stable')]
+        return {self.identifiers[code]: int(counts[code]) for code in partner_codes}
+
+
+class CombinationsIndex(object):
+    """
+    Query engine over the unnormalized combinations table (all_combs_unormalized, written by
+    create_unnormalized_combs_db.py): which combinations contain some drugs, are exactly some drugs, which drugs are
+    combined with a drug, and which sources support a combination. Drugs are DrugBank or PubChem identifiers, every
+    query can be limited to some sources (clinicaltrials.gov, patents, orangebook).
+    """
+
+    def __init__(self, combs_df: pd.DataFrame):
+        """
+        :param combs_df: the unnormalized combinations table, its identifiers columns as lists or serialized lists
+        """
+        self.combs_df = combs_df.reset_index(drop=True)
+        self.indexes = {identifier_type: IdentifiersIndex(self.combs_df[column].map(_parse_identifiers).tolist())
+                        for identifier_type, column in IDENTIFIERS_COLUMNS.items()}
+        source_codes, self.sources = pd.factorize(self.combs_df['source'].astype(str))
+        self.source_codes = source_codes.astype(np.int8)
+        self.sources = list(self.sources)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: csv/parquet unnormalized combinations table, or the release's partitioned parquet of it
+        """
+        return cls(read_table(path))
+
+    def __len__(self):
+        return len(self.combs_df)
+
+    def filter_sources(self, rows, sources):
+        if sources is None:
+            return rows
+        sources = [sources] if isinstance(sources, str) else sources
+        source_codes = [code for code, source in enumerate(self.sources) if source in sources]
+        return rows[np.isin(self.source_codes[rows], source_codes)]
+
+    def containing(self, identifiers, identifier_type='drugbank', sources=None) -> np.ndarray:
+        """
+        Combinations that contain all the identifiers (and possibly other drugs), e.g. containing(['DB00945'])
+        :param sources: a source or list of sources to limit the results to, None for all the sources
+        :return: sorted rows of the combinations
+        """
+        return self.filter_sources(self.indexes[identifier_type].containing(identifiers), sources)
+
+    def exact(self, identifiers, identifier_type='drugbank', sources=None) -> np.ndarray:
+        """
+        Combinations of exactly the identifiers (ignoring their order, repetitions and unresolved drugs)
+        :return: sorted rows of the combinations
+        """
+        return self.filter_sources(self.indexes[identifier_type].exact(identifiers), sources)
+
+    def get_partners(self, identifiers, identifier_type='drugbank', sources=None) -> dict:
+        """
+        The drugs combined with the identifiers, e.g. get_partners(['DB00945']) for the drugs combined with aspirin
+        :return: identifier to the number of combinations it is in with the identifiers, most common first
+        """
+        index = self.indexes[identifier_type]
+        rows = self.containing(identifiers, identifier_type, sources)
+        return index.get_partners(rows, index.get_codes(identifiers) if len(rows) else [])
+
+    def get_sources(self, identifiers, identifier_type='drugbank', exact=False) -> dict:
+        """
+        :param exact: only combinations of exactly the identifiers, otherwise every combination containing them
+        :return: source to the ids (nct ids, patent ids) of its combinations of the identifiers
+        """
+        query = self.exact if exact else self.containing
+        rows = query(identifiers, identifier_type)
+        sources = {}
+        for source_code, source_id in zip(self.source_codes[rows], self.combs_df['source_id'].values[rows]):
+            sources.setdefault(self.sources[source_code], []).append(source_id)
+        return sources
+
+    def get_combinations(self, rows) -> pd.DataFrame:
+        """
+        :return: the rows of the combinations table
+        """
+        return self.combs_df.iloc[rows]
+
+    def get_combination(self, row, identifier_type='drugbank'):
+        """
+        :return: the canonical combination of a row, its sorted distinct identifiers
+        """
+        return self.indexes[identifier_type].get_combination(row)
+
+
+def main(args):
+    start = time.perf_counter()
+    combinations_index = CombinationsIndex.load(args.combinations_path)
+    print(f'Indexed {len(combinations_index)} combinations in {time.perf_counter() - start:.2f}s')
+    start = time.perf_counter()
+    if args.partners:
+        result = combinations_index.get_partners(args.identifiers, args.identifier_type, args.sources)
+    else:
+        query = combinations_index.exact if args.exact else combinations_index.containing
+        result = combinations_index.get_combinations(query(args.identifiers, args.identifier_type, args.sources))
+    print(f'Query took {(time.perf_counter() - start) * 1e6:.0f}us')
+    print(result)
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Queries the combinations of drugs")
+    argument_parser.add_argument("combinations_path", type=str,
+                                 help="all_combs_unormalized table (csv/parquet) or its partitioned parquet release")
+    argument_parser.add_argument("identifiers", nargs='+', help="DrugBank (or PubChem) ids of the drugs")
+    argument_parser.add_argument("--identifier_type", default='drugbank', choices=list(IDENTIFIERS_COLUMNS))
+    argument_parser.add_argument("--sources", default=None, nargs='+', choices=SOURCES,
+                                 help="limit the results to these sources")
+    argument_parser.add_argument("--exact", action='store_true',
+                                 help="only combinations of exactly these drugs, otherwise all containing them")
+    argument_parser.add_argument("--partners", action='store_true',
+                                 help="print the drugs combined with these drugs instead of the combinations")
+    main(argument_parser.parse_args())
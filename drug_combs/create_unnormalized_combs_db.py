@@ -1,5 +1,11 @@
 import pandas as pd
 from os import sep
+import sys
+sys.path.insert(0, '../..')
+from src.drug_combs.tables_io import parse_list_cell
+from src.drug_combs.instrumentation import get_metrics
+
+DRUGBANK_DRUG_NAMES_PATH = 'input_data/drugbank_drug_names.csv'
 
 
 def main(args):
@@ -26,14 +32,14 @@ def main(args):
     all_combs = pd.concat([aact_df, patents_df, orangebook_df])
     all_combs.to_csv(f'{args.output_path}/all_combs_unormalized.csv', index=False)
 
-    create_web_preview_table(all_combs, f'{args.output_path}/web_preview.csv')
+    create_web_preview_table(all_combs, f'{args.output_path}/web_preview.csv', args.drug_names_path)
 
 
-def create_web_preview_table(all_combs, web_preview_path):
+def create_web_preview_table(all_combs, web_preview_path, drug_names_path=DRUGBANK_DRUG_NAMES_PATH):
     web_preview = all_combs
-    web_preview['drugbank_identifiers'] = web_preview['drugbank_identifiers'].apply(lambda x: eval(x))
-    web_preview['pubchem_identifiers'] = web_preview['pubchem_identifiers'].apply(lambda x: eval(x))
-    web_preview['drugs'] = web_preview['drugs'].apply(lambda x: eval(x))
+    web_preview['drugbank_identifiers'] = web_preview['drugbank_identifiers'].map(parse_list_cell)
+    web_preview['pubchem_identifiers'] = web_preview['pubchem_identifiers'].map(parse_list_cell)
+    web_preview['drugs'] = web_preview['drugs'].map(parse_list_cell)
 
     def add_best_match_name(row):
         result = []
@@ -48,7 +54,7 @@ def create_web_preview_table(all_combs, web_preview_path):
         return ','.join(result)
 
     # TODO: add drugbank name
-    drugbank_names_df = pd.read_csv('input_data/drugbank_drug_names.csv')
+    drugbank_names_df = pd.read_csv(drug_names_path)
     dbid_to_name = drugbank_names_df.set_index('drugBank_id').to_dict()['Drug name']
     web_preview['drugs'] = web_preview.apply(lambda row: add_best_match_name(row), axis=1)
 
@@ -70,5 +76,12 @@ if __name__ == '__main__':
     argument_parser = argparse.ArgumentParser()
     argument_parser.add_argument("input_dir", help="input dir")
     argument_parser.add_argument("output_path", help="output_file.csv")
+    argument_parser.add_argument("--drug_names_path", default=DRUGBANK_DRUG_NAMES_PATH,
+                                 help="csv of drugbank ids and names")
+    argument_parser.add_argument("--metrics_path", default=None, type=str,
+                                 help="path to write the run's per-stage metrics to (json)")
     args = argument_parser.parse_args()
-    main(args)
+    with get_metrics().stage('total'):
+        main(args)
+    if args.metrics_path is not None:
+        get_metrics().write(args.metrics_path)
@@ -0,0 +1,49 @@
+import re
+
+import pandas as pd
+
+WORDS_TO_REMOVE = frozenset(
+    ["single", "dose", "low", "slow", "soft tissue", "solid", "spray", "stable", "subarachnoid", "subconjunctival",
+     "subcutaneous", "sublingual", "submucosal", "suppositories", "sustained-release", "tablet", "tablets", "therapy",
+     "topical", "transdermal", "transmucosal", "transplacental", "transtracheal", "transtympanic", "treatment",
+     "troches", "ureteral", "urethral", "usual care", "vaginal", "%", "mg", "kg", "mg/day", "oral", "suspension",
+     "low dose", "fixed", "combination", "drops"])
+
+# (pattern, replacement) applied in order, the name is stripped after each one
+SUBSTITUTIONS = [
+    (re.compile('"|\'|mg/day|,|•|™|®|oral\\b|IV\\b', re.IGNORECASE), ''),
+    (re.compile('α'), 'alfa'),
+    (re.compile('[μμμµ]'), 'μ'),
+    (re.compile(r'[-+]?\d*\.?\d*%'), ''),
+    (re.compile(r'([-+]?\d*\.\d*)'), ''),
+]
+
+# each one keeps only its group of the name, when it matches
+EXTRACTIONS = [
+    re.compile('Comparator: (.*)'),
+    re.compile(r'^(.*?)(?:(?:\/\d)|(?: \d)|(?:,(?:.*)\d)).*?(?:mg|kg|μg|mcg)(?:.*?)$'),
+    re.compile(r'[-+]?\d*\.?\d*%(?: )?(.*?)$'),
+    re.compile(r'^\d.*(?:mg|kg|μg|mcg|µg)(.*?)$'),
+    re.compile(r'^(.*?)\(.*?\).*$'),
+    re.compile(r'^(.*?)\[.*?\].*$'),
+]
+
+
+def remove_special_words(name: str) -> str:
+    return ' '.join([word for word in name.split() if word.lower() not in WORDS_TO_REMOVE]).strip()
+
+
+def clean_drug_names(names: pd.Series) -> pd.Series:
+    """
+    Cleans each distinct name once, with vectorized string operations
+    :param names: drug names, may repeat
+    :return: the cleaned names, aligned with names
+    """
+    distinct_names = pd.Series(pd.unique(names.map(str)), dtype=object)
+    cleaned = distinct_names.map(remove_special_words)
+    for pattern, replacement in SUBSTITUTIONS:
+        cleaned = cleaned.str.replace(pattern, replacement, regex=True).str.strip()
+    for pattern in EXTRACTIONS:
+        cleaned = cleaned.str.extract(pattern, expand=False).fillna(cleaned)
+    cleaned = cleaned.str.strip()
+    return names.map(str).map(dict(zip(distinct_names, cleaned)))
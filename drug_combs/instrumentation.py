@@ -0,0 +1,132 @@
+import argparse
+import datetime
+import json
+import os
+import resource
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from glob import glob
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on linux, peak of this process and of its largest waited-for child
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def _cpu_seconds():
+    """
+    :return: CPU time of this process and of its waited-for children (e.g. forked NER workers)
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class StageRecord(object):
+    def __init__(self, rows_in=None):
+        self.rows_in = rows_in
+        self.rows_out = None
+
+
+class PipelineMetrics(object):
+    """
+    Per-stage wall time, CPU time, peak RSS and row counts, plus counters (e.g. cache hits) and sections (e.g. the
+    resolvers' cache stats) of a single script run. A stage run several times (e.g. once per chunk) is summed.
+    """
+
+    def __init__(self):
+        self.started_at = datetime.datetime.now().isoformat()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.sections = OrderedDict()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Usage: with metrics.stage('clean_drug_names', len(df)) as record: ... record.rows_out = len(result)
+        """
+        record = StageRecord(rows_in)
+        start_wall, start_cpu = time.perf_counter(), _cpu_seconds()
+        try:
+            yield record
+        finally:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                  'rows_in': None, 'rows_out': None,
+                                                  'process_peak_rss_mb_so_far': None})
+            stage['calls'] += 1
+            stage['wall_seconds'] += time.perf_counter() - start_wall
+            stage['cpu_seconds'] += _cpu_seconds() - start_cpu
+            for rows_key, rows in [('rows_in', record.rows_in), ('rows_out', record.rows_out)]:
+                if rows is not None:
+                    stage[rows_key] = (stage[rows_key] or 0) + rows
+            # the process' peak up to the stage's end, which may have been reached by an earlier stage
+            stage['process_peak_rss_mb_so_far'] = _peak_rss_mb()
+
+    def add_counts(self, group, **counts):
+        group_counters = self.counters.setdefault(group, OrderedDict())
+        for name, count in counts.items():
+            group_counters[name] = group_counters.get(name, 0) + count
+
+    def add_section(self, name, section: dict):
+        self.sections[name] = section
+
+    def to_dict(self) -> dict:
+        return {'started_at': self.started_at, 'finished_at': datetime.datetime.now().isoformat(),
+                'peak_rss_mb': _peak_rss_mb(), 'stages': self.stages, 'counters': self.counters,
+                **self.sections}
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2)
+
+
+_metrics = PipelineMetrics()
+
+
+def get_metrics() -> PipelineMetrics:
+    """
+    :return: the metrics of this process' run, written by the script's --metrics_path
+    """
+    return _metrics
+
+
+def merge_metrics(metrics_dir, output_path, started_at=None):
+    """
+    Merges the metrics of every script of a build (one json per script, named after it) into a single report
+    :param started_at: time.time() of the build's start, the total wall time is measured from it. Otherwise it is the
+    time from the first script's start to the last one's end (the scripts may run in parallel, so their wall times
+    don't add up)
+    """
+    scripts = OrderedDict()
+    for path in sorted(glob(os.path.join(metrics_dir, '*.json')), key=os.path.getmtime):
+        with open(path) as metrics_file:
+            scripts[os.path.splitext(os.path.basename(path))[0]] = json.load(metrics_file)
+    if started_at is not None:
+        total_wall_seconds = time.time() - started_at
+    elif scripts:
+        first_start = min(datetime.datetime.fromisoformat(script['started_at']) for script in scripts.values())
+        last_end = max(datetime.datetime.fromisoformat(script['finished_at']) for script in scripts.values())
+        total_wall_seconds = (last_end - first_start).total_seconds()
+    else:
+        total_wall_seconds = 0.0
+    report = {'scripts': scripts,
+              'total_wall_seconds': total_wall_seconds,
+              'peak_rss_mb': max([script['peak_rss_mb'] for script in scripts.values()], default=None)}
+    with open(output_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Merges the metrics written by the build's scripts")
+    argument_parser.add_argument("metrics_dir", type=str, help="directory of the scripts' metrics json files")
+    argument_parser.add_argument("output_path", type=str, help="path of the merged json report")
+    args = argument_parser.parse_args()
+    merged_report = merge_metrics(args.metrics_dir, args.output_path)
+    for script_name, script_metrics in merged_report['scripts'].items():
+        script_total = script_metrics['stages'].get('total', {'wall_seconds': 0.0})
+        print(f"{script_name}: {script_total['wall_seconds']:.1f}s")
@@ -1,137 +1,152 @@
+import csv
 import json
 import pandas as pd
-from tqdm import tqdm
 import sys
 sys.path.insert(0, '../..')
 
-from src.drug_combs.add_identifier_to_df import DataframeDrugIdentifiersAdder
+from src.drug_combs.add_identifier_to_df import DataframeDrugIdentifiersAdder, add_resolvers_metrics
+from src.drug_combs.instrumentation import get_metrics
 from src.drug_identfiers_resolver.identifiers_resolver import DrugIdentifiersResolver, APIBasedIdentifiersResolver, \
     WikiDataIdsResolver
+from src.drug_identfiers_resolver.local_identifiers_index import LocalIdentifiersIndex
+
+
+PRODUCTS_COLUMNS = ['Ingredient', 'DF_Route', 'Trade_Name', 'Applicant', 'Strength', 'Appl_Type', 'Appl_No',
+                    'Product_No', 'TE_Code', 'Approval_Date', 'RLD', 'RS', 'Type', 'Applicant_Full_Name']
+PATENT_COLUMNS = ['Appl_Type', 'Appl_No', 'Product_No', 'Patent_No', 'Patent_Expire_Date_Text', 'Drug_Substance_Flag',
+                  'Drug_Product_Flag', 'Patent_Use_Code', 'Delist_Flag', 'Submission_Date']
+EXCLUSIVITY_COLUMNS = ['Appl_Type', 'Appl_No', 'Product_No', 'Exclusivity_Code', 'Exclusivity_Date']
+PRODUCT_KEY = ['Appl_No', 'Product_No']
+# orange book column -> column in the combinations table, each one a list of all the patents of the product
+PATENT_INFO_COLUMNS = {'Patent_No': 'patent_no', 'Patent_Expire_Date_Text': 'patent_expire_date',
+                       'Drug_Substance_Flag': 'substance_flag', 'Drug_Product_Flag': 'product_flag',
+                       'Patent_Use_Code': 'patent_use_code', 'Delist_Flag': 'delist_flag',
+                       'Submission_Date': 'patent_submitted_date'}
+EXCLUSIVITY_INFO_COLUMNS = {'Exclusivity_Code': 'exclusivity_code', 'Exclusivity_Date': 'exclusivity_date'}
+COMBINATION_INGREDIENTS_SEP = "; "
+DEFAULT_PRODUCTS_CHUNK_SIZE = 100000
+
+
+def read_orange_book_file(path, columns, chunksize=None):
+    """
+    Orange book files are '~' separated with a header row and unquoted fields (a '"' is part of its field), every
+    field is read as a string (keeping the leading zeros of application and product numbers, and empty fields as '')
+    """
+    return pd.read_csv(path, sep='~', names=columns, header=0, dtype=str, keep_default_na=False, chunksize=chunksize,
+                       quoting=csv.QUOTE_NONE)
 
 
 class OrangeBookParser(object):
-    def __init__(self, orange_book_path):
+    def __init__(self, orange_book_path, products_chunk_size=DEFAULT_PRODUCTS_CHUNK_SIZE):
+        """
+        :param products_chunk_size: products are scanned in chunks of this many rows, only combinations are kept
+        """
         self.orange_book_path = orange_book_path
+        self.products_chunk_size = products_chunk_size
 
     def get_combs(self) -> pd.DataFrame:
-        results = []
-        appl_no_to_patent_info = self.get_appl_no_to_product()
-
-        with open(f'{str(self.orange_book_path)}/products.txt') as orange_book_file:
-            for orange_book_line in orange_book_file.readlines():
-                splitted = orange_book_line.split("~")
-                ingredients = splitted[0]
-                trade_name = splitted[2]
-                appl_type = splitted[5]
-                appl_no = splitted[6]
-                product_no = splitted[7]
-                te_code = splitted[8]
-                approval_date = splitted[9]
-                rld = splitted[10]
-                rs = splitted[11]
-                orangebook_type = splitted[12]
-                applicant_full_name = splitted[13].strip()
-
-                if ';' in ingredients:
-                    drugs = ingredients.split("; ")
-                    combs = {'all_drugs_in_combination': drugs,
-                             'Trade_Name': trade_name,
-                             'Appl_Type': appl_type,
-                             'Product_no': product_no,
-                             'TE_Code': te_code,
-                             'Approval_Date': approval_date,
-                             'RLD': rld,
-                             'RS': rs,
-                             'TYPE': orangebook_type,
-                             'Applicant_Full_Name': applicant_full_name,
-                             }
-                    patent_data = appl_no_to_patent_info.get(appl_no, None)
-                    if patent_data is not None:
-                        for k, v in patent_data.items():
-                            combs[k] = v
-                    for idx, drug in enumerate(drugs):
-                        combs[f'drug_{idx}'] = drug
-                    results.append(combs)
-        result_df = pd.DataFrame(results[1:])
-        result_df['all_drugs_in_combination'] = result_df['all_drugs_in_combination'].apply(json.dumps)
-        result_df = result_df.drop_duplicates(['all_drugs_in_combination'])
-        result_df['all_drugs_in_combination'] = result_df['all_drugs_in_combination'].apply(json.loads)
-        return result_df
-
-    def get_appl_no_to_product(self):
-        appl_no_to_patent_info = {}
-        with open(f'{str(self.orange_book_path)}/patent.txt') as orange_book_file:
-            for orange_book_line in orange_book_file.readlines():
-                splitted = orange_book_line.split("~")
-                appl_no = splitted[1]
-                product_no = splitted[2]
-                patent_no = splitted[3]
-                patent_expire_date = splitted[4]
-                drug_substance_flag = splitted[5]
-                drug_product_flag = splitted[6]
-                patent_use_code = splitted[7]
-                delist_flag = splitted[8]
-                patent_submitted_date = splitted[9]
-                appl_no_to_patent_info[appl_no] = {"product_no": product_no, 'patent_no': patent_no,
-                                                   'patent_expire_date': patent_expire_date,
-                                                   'substance_flag': drug_substance_flag,
-                                                   'product_flag': drug_product_flag,
-                                                   'patent_use_code': patent_use_code,
-                                                   'delist_flag': delist_flag,
-                                                   'patent_submitted_date': patent_submitted_date}
-        return appl_no_to_patent_info
-
-
-def get_drugs_identifiers_adder():
+        products_chunks = read_orange_book_file(f'{str(self.orange_book_path)}/products.txt', PRODUCTS_COLUMNS,
+                                                self.products_chunk_size)
+        products_df = pd.concat([chunk[chunk['Ingredient'].str.contains(';', regex=False)]
+                                 for chunk in products_chunks], ignore_index=True)
+        products_df = products_df.drop_duplicates('Ingredient')
+        products_df = products_df.merge(self.get_product_to_patents(), on=PRODUCT_KEY, how='left')
+        products_df = products_df.merge(self.get_product_to_exclusivities(), on=PRODUCT_KEY, how='left')
+        for column in list(PATENT_INFO_COLUMNS.values()) + list(EXCLUSIVITY_INFO_COLUMNS.values()):
+            # products without patents (or exclusivities)
+            products_df[column] = [value if isinstance(value, list) else [] for value in products_df[column]]
+
+        drugs = products_df['Ingredient'].str.split(COMBINATION_INGREDIENTS_SEP)
+        result_df = pd.DataFrame({'all_drugs_in_combination': drugs,
+                                  'Trade_Name': products_df['Trade_Name'],
+                                  'Appl_Type': products_df['Appl_Type'],
+                                  'Appl_No': products_df['Appl_No'],
+                                  'Product_no': products_df['Product_No'],
+                                  'TE_Code': products_df['TE_Code'],
+                                  'Approval_Date': products_df['Approval_Date'],
+                                  'RLD': products_df['RLD'],
+                                  'RS': products_df['RS'],
+                                  'TYPE': products_df['Type'],
+                                  'Applicant_Full_Name': products_df['Applicant_Full_Name'].str.strip()})
+        for column in list(PATENT_INFO_COLUMNS.values()) + list(EXCLUSIVITY_INFO_COLUMNS.values()):
+            result_df[column] = products_df[column]
+        drugs_df = pd.DataFrame(drugs.tolist(), index=result_df.index)
+        drugs_df.columns = [f'drug_{idx}' for idx in drugs_df.columns]
+        return pd.concat([result_df, drugs_df], axis=1)
+
+    def get_product_to_patents(self) -> pd.DataFrame:
+        """
+        :return: DataFrame of Appl_No, Product_No and the patents info columns, each as a list of all the patents of
+        the product
+        """
+        patent_df = read_orange_book_file(f'{str(self.orange_book_path)}/patent.txt', PATENT_COLUMNS)
+        return self._group_by_product(patent_df, PATENT_INFO_COLUMNS)
+
+    def get_product_to_exclusivities(self) -> pd.DataFrame:
+        """
+        :return: DataFrame of Appl_No, Product_No and the exclusivity columns, each as a list of all the exclusivities
+        of the product
+        """
+        exclusivity_df = read_orange_book_file(f'{str(self.orange_book_path)}/exclusivity.txt', EXCLUSIVITY_COLUMNS)
+        return self._group_by_product(exclusivity_df, EXCLUSIVITY_INFO_COLUMNS)
+
+    @staticmethod
+    def _group_by_product(df, info_columns):
+        return df.groupby(PRODUCT_KEY, sort=False)[list(info_columns)].agg(list).rename(
+            columns=info_columns).reset_index()
+
+
+def get_drugs_identifiers_adder(local_identifiers_index=None):
     wikidata_ids_resolver = WikiDataIdsResolver("../drug_combs/input_data/qid_to_drugbank.json",
                                                 "../drug_combs/input_data/qid_to_pubchem.json",
                                                 cache_file_path="wikidata_disk_cache")
-    resolver = DrugIdentifiersResolver(wikidata_ids_resolver, APIBasedIdentifiersResolver())
+    resolver = DrugIdentifiersResolver(wikidata_ids_resolver, APIBasedIdentifiersResolver(), local_identifiers_index)
     drug_identifiers_adder = DataframeDrugIdentifiersAdder(resolver, False)
     return drug_identifiers_adder
 
 
+def add_drugs_identifiers(combs_df: pd.DataFrame, drug_identifiers_adder) -> pd.DataFrame:
+    """
+    Replaces the drug_N columns with json lists of the combination's drugs names, drugbank ids and pubchem ids.
+    The drugs of all the combinations are resolved together, each distinct name once.
+    """
+    combs_df = combs_df.reset_index(drop=True)
+    drugs_columns = [column for column in combs_df.columns if column.startswith("drug_")]
+    drugs_df = combs_df[drugs_columns].reset_index().melt(id_vars='index', var_name='drug_column',
+                                                           value_name='drug_name')
+    drugs_df = drugs_df[drugs_df['drug_name'].notna() & (drugs_df['drug_name'] != '')]
+    drugs_df = drugs_df.assign(drug_idx=drugs_df['drug_column'].str[len("drug_"):].astype(int))
+    drugs_df = drugs_df.sort_values(['index', 'drug_idx'])
+    drugs_df = drug_identifiers_adder.add_identifiers_column(drugs_df, 'drug_name', 'identifiers')
+
+    drugs_df['drugs_names'] = drugs_df['drug_name'].map(lambda name: str(name).strip())
+    drugs_df['drugbank_ids'] = drugs_df['identifiers'].map(lambda identifiers: identifiers[0])
+    drugs_df['pubchem_ids'] = drugs_df['identifiers'].map(lambda identifiers: identifiers[1])
+    drugs_lists_df = drugs_df.groupby('index', sort=False)[['drugs_names', 'drugbank_ids', 'pubchem_ids']].agg(list)
+
+    combs_df = combs_df.drop(drugs_columns + ['all_drugs_in_combination'], axis=1)
+    for column in ['drugs_names', 'drugbank_ids', 'pubchem_ids']:
+        combs_df[column] = combs_df.index.map(drugs_lists_df[column]).map(
+            lambda values: json.dumps(values if isinstance(values, list) else []))
+    return combs_df
+
+
 def main(args):
     orange_book_parser = OrangeBookParser(args.orangebook_path)
-    combs_df = orange_book_parser.get_combs()
-    combs_df = combs_df.fillna("")
-    drug_identifiers_adder = get_drugs_identifiers_adder()
-    for column in combs_df.columns:
-        if column.startswith("drug_"):
-            combs_df = drug_identifiers_adder.add_identifiers_column(combs_df, column, f'identifiers_{column}')
-
-    columns = combs_df.columns
-    result_df = []
-    for row in tqdm(combs_df.iterrows(), desc="Removing empty identifiers: rows"):
-        row = row[1]
-        drugs_names = []
-        pbids = []
-        dbids = []
-        for column in columns:
-            if column.startswith("drug_"):
-                if row[column] == '':
-                    row[f"identifiers_{column}"] = ''
-                    continue
-                drug_i_name = str(row[column]).strip()
-                drugs_names.append(drug_i_name)
-            elif column.startswith("identifiers_"):
-                if row[column] == '':
-                    continue
-                dbids.append(row[column][0])
-                pbids.append(row[column][1])
-        row['drugs_names'] = json.dumps(drugs_names)
-        row['drugbank_ids'] = json.dumps(dbids)
-        row['pubchem_ids'] = json.dumps(pbids)
-        result_df.append(row)
-
-    result_df = pd.DataFrame(result_df)
-    cols_to_drop = [x for x in result_df.columns if x.startswith("drug_")] + [x for x in result_df.columns if
-                                                                              x.startswith("identifiers_")] + ['all_drugs_in_combination']
-    combs_df = result_df.drop(cols_to_drop, axis=1)
-
-    if args.parsed_df_path[-3:] == 'csv':
+    with get_metrics().stage('get_combs') as stage_record:
+        combs_df = orange_book_parser.get_combs()
+        stage_record.rows_out = len(combs_df)
+    with get_metrics().stage('add_drugs_identifiers', len(combs_df)) as stage_record:
+        local_identifiers_index = LocalIdentifiersIndex.load(args.local_index) if args.local_index else None
+        drug_identifiers_adder = get_drugs_identifiers_adder(local_identifiers_index)
+        combs_df = add_drugs_identifiers(combs_df, drug_identifiers_adder)
+        stage_record.rows_out = len(combs_df)
+    resolver = drug_identifiers_adder.identifiers_resolver
+    add_resolvers_metrics(resolver.wikidata_ids_resolver, resolver.api_identifiers_resolver)
+
+    if args.parsed_df_path.endswith('.csv'):
         combs_df.to_csv(f'{args.parsed_df_path}', index=False)
-    elif args.parsed_df_path[-3:] == 'xlsx':
+    elif args.parsed_df_path.endswith('.xlsx'):
         combs_df.to_excel(f'{args.parsed_df_path}', index=False)
     else:
         exit("Unsupported export format, only csv, xlsx allowed")
@@ -143,6 +158,14 @@ if __name__ == '__main__':
     argument_parser = argparse.ArgumentParser()
     argument_parser.add_argument("orangebook_path", type=str)
     argument_parser.add_argument("parsed_df_path", type=str, help="path to output the combs df [csv/xlsx]")
+    argument_parser.add_argument("--local_index", default=None, type=str,
+                                 help="local identifiers index (built by local_identifiers_index.py), names found in "
+                                      "it are resolved without network calls")
+    argument_parser.add_argument("--metrics_path", default=None, type=str,
+                                 help="path to write the run's per-stage metrics to (json)")
     args = argument_parser.parse_args()
-    main(args)
+    with get_metrics().stage('total'):
+        main(args)
+    if args.metrics_path is not None:
+        get_metrics().write(args.metrics_path)
 
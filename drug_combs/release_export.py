@@ -0,0 +1,185 @@
+import json
+import os
+import shutil
+import sqlite3
+import pandas as pd
+import sys
+sys.path.insert(0, '../..')
+from src.drug_combs.tables_io import parse_list_cell, write_parquet, write_partitioned_parquet
+from src.drug_combs.instrumentation import get_metrics
+
+NORMALIZED_TABLES = ['trials_df', 'design_group_df', 'conditions_df', 'mesh_terms_df', 'references_df']
+UNNORMALIZED_TABLE = 'all_combs_unormalized'
+# table -> (primary key, secondary indexes)
+TABLES_KEYS = {'trials_df': ('nct_id', []),
+               'design_group_df': ('design_group_id', ['nct_id']),
+               'conditions_df': (None, ['nct_id', 'condition_downcase']),
+               'mesh_terms_df': (None, ['nct_id', 'mesh_terms_downcase']),
+               'references_df': (None, ['nct_id']),
+               UNNORMALIZED_TABLE: ('combination_id', [['source', 'source_id']]),
+               'design_group_drugs': (None, ['design_group_id', 'drugbank_identifier', 'pubchem_identifier']),
+               'combination_drugs': (None, ['combination_id', 'drugbank_identifier', 'pubchem_identifier'])}
+DESIGN_GROUP_LIST_COLUMNS = ['interventions_names', 'selected_name', 'drugbank_identifier', 'pubchem_identifier']
+COMBINATION_LIST_COLUMNS = ['drugs', 'drugbank_identifiers', 'pubchem_identifiers']
+# table -> types of its non-text columns, every other column is TEXT. Declared rather than taken from the dtypes, which
+# change between releases (e.g. an all-nan column is float)
+TABLES_COLUMNS_TYPES = {'trials_df': {'enrollment': 'INTEGER', 'number_of_arms': 'INTEGER',
+                                      'number_of_groups': 'INTEGER'},
+                        'design_group_df': {},
+                        'conditions_df': {},
+                        'mesh_terms_df': {},
+                        'references_df': {},
+                        UNNORMALIZED_TABLE: {'combination_id': 'INTEGER'},
+                        'design_group_drugs': {'position': 'INTEGER'},
+                        'combination_drugs': {'combination_id': 'INTEGER', 'position': 'INTEGER'}}
+PARTITION_COLUMN = 'source'
+
+
+def read_release_tables(version_dir) -> dict:
+    """
+    Reads the csv tables of a version (written by schema_transforming.py and create_unnormalized_combs_db.py), with
+    their list columns parsed
+    :return: dictionary of table name to df
+    """
+    tables = {name: pd.read_csv(os.path.join(version_dir, f'{name}.csv')) for name in NORMALIZED_TABLES}
+    design_group_df = tables['design_group_df']
+    design_group_df[['nct_id', 'design_group_id']] = design_group_df[['nct_id', 'design_group_id']].astype(str)
+    for column in DESIGN_GROUP_LIST_COLUMNS:
+        design_group_df[column] = design_group_df[column].map(parse_list_cell)
+    # a row per trial, the trial columns don't change between the trial's rows
+    tables['trials_df'] = tables['trials_df'].drop_duplicates('nct_id')
+
+    # orange book's source ids are 'N/A', kept as is
+    combs_df = pd.read_csv(os.path.join(version_dir, f'{UNNORMALIZED_TABLE}.csv'), converters={'source_id': str})
+    for column in COMBINATION_LIST_COLUMNS:
+        combs_df[column] = combs_df[column].map(parse_list_cell)
+    combs_df.insert(0, 'combination_id', range(len(combs_df)))
+    tables[UNNORMALIZED_TABLE] = combs_df
+
+    tables['design_group_drugs'] = get_drugs_table(design_group_df, 'design_group_id', 'selected_name',
+                                                   'drugbank_identifier', 'pubchem_identifier')
+    tables['combination_drugs'] = get_drugs_table(combs_df, 'combination_id', 'drugs', 'drugbank_identifiers',
+                                                  'pubchem_identifiers')
+    return tables
+
+
+def _get_drug_name(name):
+    # AACT's drugs are [selected name, other names], the other sources' are names
+    if isinstance(name, (list, tuple)):
+        return name[0] if len(name) > 0 else None
+    return name
+
+
+def _to_identifier(identifier):
+    # missing identifiers stay None (NULL), resolved ones are stored as text
+    if identifier is None or (isinstance(identifier, float) and pd.isna(identifier)):
+        return None
+    return str(identifier)
+
+
+def get_drugs_table(df: pd.DataFrame, key_col, names_col, drugbank_col, pubchem_col) -> pd.DataFrame:
+    """
+    Junction table of the drugs of every row, so rows can be looked up by a drug's identifiers through an index
+    :return: df of key_col, position, drug, drugbank_identifier and pubchem_identifier, a row per drug of a row
+    """
+    rows = [(key, position, _get_drug_name(name), _to_identifier(drugbank_id),
+             _to_identifier(pubchem_id))
+            for key, names, drugbank_ids, pubchem_ids in zip(df[key_col], df[names_col], df[drugbank_col],
+                                                             df[pubchem_col])
+            if isinstance(drugbank_ids, (list, tuple))
+            for position, (name, drugbank_id, pubchem_id) in enumerate(zip(names, drugbank_ids, pubchem_ids))]
+    return pd.DataFrame(rows, columns=[key_col, 'position', 'drug', 'drugbank_identifier', 'pubchem_identifier'])
+
+
+def _to_sqlite_values(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    List columns are stored as json, missing values as NULL
+    """
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].map(lambda value: json.dumps(value) if isinstance(value, (list, tuple)) else value)
+    return df.astype(object).where(df.notna(), None)
+
+
+def write_sqlite_table(connection, name, df: pd.DataFrame, primary_key=None, indexes=(), columns_types=None):
+    """
+    :param indexes: columns to index, a list of columns for a composite index
+    :param columns_types: column to its sqlite type, TEXT for the columns not in it
+    """
+    columns_types = columns_types or {}
+    columns = []
+    for column in df.columns:
+        column_type = columns_types.get(column, 'TEXT')
+        columns.append(f'"{column}" {column_type}' + (' PRIMARY KEY' if column == primary_key else ''))
+    connection.execute(f'DROP TABLE IF EXISTS "{name}"')
+    connection.execute(f'CREATE TABLE "{name}" ({", ".join(columns)})')
+    connection.executemany(f'INSERT INTO "{name}" VALUES ({", ".join(["?"] * len(df.columns))})',
+                           _to_sqlite_values(df).itertuples(index=False, name=None))
+    for index_columns in indexes:
+        index_columns = [index_columns] if isinstance(index_columns, str) else index_columns
+        quoted_columns = ', '.join('"' + column + '"' for column in index_columns)
+        connection.execute(f'CREATE INDEX "{name}__{"__".join(index_columns)}" ON "{name}" ({quoted_columns})')
+
+
+def export_sqlite(tables: dict, sqlite_path):
+    """
+    Writes the tables into a single sqlite database, with primary keys on nct_id / design_group_id and indexes on the
+    drugs' identifiers (through the design_group_drugs and combination_drugs junction tables)
+    """
+    tmp_path = f'{sqlite_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        with connection:
+            for name, df in tables.items():
+                primary_key, indexes = TABLES_KEYS[name]
+                write_sqlite_table(connection, name, df, primary_key, indexes, TABLES_COLUMNS_TYPES[name])
+        connection.execute('ANALYZE')
+    finally:
+        connection.close()
+    os.replace(tmp_path, sqlite_path)
+
+
+def export_parquet(tables: dict, parquet_dir):
+    """
+    Writes a parquet file per table, the unnormalized combinations partitioned by their source
+    """
+    shutil.rmtree(parquet_dir, ignore_errors=True)
+    os.makedirs(parquet_dir)
+    for name, df in tables.items():
+        if name == UNNORMALIZED_TABLE:
+            write_partitioned_parquet(df, os.path.join(parquet_dir, name), [PARTITION_COLUMN])
+        else:
+            write_parquet(df, os.path.join(parquet_dir, f'{name}.parquet'))
+
+
+def main(args):
+    with get_metrics().stage('read_release_tables') as stage_record:
+        tables = read_release_tables(args.version_dir)
+        stage_record.rows_out = sum(len(df) for df in tables.values())
+    if args.sqlite_path is not None:
+        with get_metrics().stage('export_sqlite'):
+            export_sqlite(tables, args.sqlite_path)
+    if args.parquet_dir is not None:
+        with get_metrics().stage('export_parquet'):
+            export_parquet(tables, args.parquet_dir)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    argument_parser = argparse.ArgumentParser(description="Exports a version's tables as an indexed sqlite database "
+                                                          "and/or parquet files")
+    argument_parser.add_argument("version_dir", help="directory of the version's csv tables")
+    argument_parser.add_argument("--sqlite_path", default=None, type=str, help="path of the sqlite database to write")
+    argument_parser.add_argument("--parquet_dir", default=None, type=str,
+                                 help="directory to write a parquet file per table to")
+    argument_parser.add_argument("--metrics_path", default=None, type=str,
+                                 help="path to write the run's per-stage metrics to (json)")
+    args = argument_parser.parse_args()
+    with get_metrics().stage('total'):
+        main(args)
+    if args.metrics_path is not None:
+        get_metrics().write(args.metrics_path)
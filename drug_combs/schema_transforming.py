@@ -1,9 +1,11 @@
 import json
-from tqdm import tqdm
 import pandas as pd
-import math
+import sys
+sys.path.insert(0, '../..')
+from src.drug_combs.tables_io import read_table, parse_list_cell
+from src.drug_combs.instrumentation import get_metrics
 
-tqdm.pandas()
+DRUGBANK_NUTRACEUTICALS_PATH = "input_data/drugbank_nutraceuticals.xlsx"
 
 
 class ClinicalTrialsSchemaTransformer(object):
@@ -11,8 +13,8 @@ class ClinicalTrialsSchemaTransformer(object):
     Used to create normalized and unormalized version of the df
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, drugbank_nutraceuticals_path=DRUGBANK_NUTRACEUTICALS_PATH):
+        self.drugbank_nutraceuticals_path = drugbank_nutraceuticals_path
 
     def transform_normalized(self, df: pd.DataFrame, dbid_to_compound_size_df: pd.DataFrame) -> dict:
         """
@@ -35,107 +37,81 @@ class ClinicalTrialsSchemaTransformer(object):
                 'design_group_df': design_group_df}
 
     def extract_conditions_df(self, df: pd.DataFrame) -> pd.DataFrame:
-        relevant_cols_df = df[['nct_id', 'condition_names']].drop_duplicates()
-        relevant_cols_df['condition_names'] = relevant_cols_df['condition_names'].apply(
-            lambda x: [] if str(x) == 'nan' else eval(x))
-        res = []
-        for idx, row in tqdm(relevant_cols_df.iterrows()):
-            mesh_terms = row['condition_names']
-            nct_id = row['nct_id']
-            if mesh_terms:
-                for mesh_term in mesh_terms:
-                    res.append({'nct_id': nct_id, 'condition': mesh_term, 'condition_downcase': mesh_term.lower()})
-        return pd.DataFrame(res).drop_duplicates()
+        conditions = self._explode_list_column(df, 'condition_names', 'condition')
+        conditions['condition_downcase'] = conditions['condition'].str.lower()
+        return conditions.drop_duplicates()
 
     def extract_mesh_terms_df(self, df: pd.DataFrame) -> pd.DataFrame:
-        relevant_cols_df = df[['nct_id', 'mesh_terms']].drop_duplicates()
-        relevant_cols_df['mesh_terms'] = relevant_cols_df['mesh_terms'].apply(
-            lambda x: [] if str(x) == 'nan' else eval(x))
-        res = []
-        for idx, row in tqdm(relevant_cols_df.iterrows()):
-            mesh_terms = row['mesh_terms']
-            nct_id = row['nct_id']
-            if mesh_terms:
-                for mesh_term in mesh_terms:
-                    res.append({'nct_id': nct_id, 'mesh_term': mesh_term, 'mesh_terms_downcase': mesh_term.lower()})
-        return pd.DataFrame(res).drop_duplicates()
+        mesh_terms = self._explode_list_column(df, 'mesh_terms', 'mesh_term')
+        mesh_terms['mesh_terms_downcase'] = mesh_terms['mesh_term'].str.lower()
+        return mesh_terms.drop_duplicates()
 
     def extract_references_df(self, df: pd.DataFrame) -> pd.DataFrame:
-        relevant_cols_df = df[['nct_id', 'refs']].drop_duplicates()
-        relevant_cols_df['refs'] = relevant_cols_df['refs'].apply(lambda x: [] if str(x) == 'nan' else eval(x))
-        res = []
-        for idx, row in tqdm(relevant_cols_df.iterrows()):
-            references = row['refs']
-            nct_id = row['nct_id']
-            if references:
-                for reference in references:
-                    res.append({'nct_id': nct_id, 'reference_type': reference[0], 'reference': reference[1]})
-        return pd.DataFrame(res)
+        references = self._explode_list_column(df, 'refs', 'reference')
+        references['reference_type'] = references['reference'].str[0]
+        references['reference'] = references['reference'].str[1]
+        return references[['nct_id', 'reference_type', 'reference']]
+
+    @staticmethod
+    def _explode_list_column(df: pd.DataFrame, list_col, item_col) -> pd.DataFrame:
+        """
+        The list columns hold the same value for every row of a trial, so rows are deduplicated by nct_id before
+        parsing
+        :param list_col: column of lists, native or serialized as strings (nan for no items)
+        :param item_col: name of the column of the items
+        :return: df of nct_id and item_col, a row for every item in the lists
+        """
+        relevant_cols_df = df[['nct_id', list_col]].drop_duplicates('nct_id')
+        relevant_cols_df = relevant_cols_df[relevant_cols_df[list_col].notna()]
+        relevant_cols_df[list_col] = relevant_cols_df[list_col].map(parse_list_cell)
+        exploded = relevant_cols_df.explode(list_col)
+        exploded = exploded[exploded[list_col].notna()]
+        exploded = exploded.rename(columns={list_col: item_col}).reset_index(drop=True)
+        exploded[item_col] = exploded[item_col].astype(object)
+        return exploded
 
     def extract_trials_df(self, df: pd.DataFrame) -> pd.DataFrame:
         return df[['nct_id', 'study_start_date', 'overall_status', 'phase', 'completion_date',
                    'enrollment', 'enrollment_type', 'number_of_arms', 'number_of_groups',
                    'why_stopped']].drop_duplicates()
 
-    def eval_and_json_double(self, x):
-        return json.dumps([eval(y) for y in eval(x)])
-
-    def eval_and_json(self, x):
-        return json.dumps(eval(x))
-
     def extract_design_groups_df(self, df, dbid_to_compound_size_df):
-        df['drugbank_identifier'] = df['identifiers_entity'].apply(lambda x: eval(x)[0])
-        df['pubchem_identifier'] = df['identifiers_entity'].apply(lambda x: eval(x)[1])
+        group_keys = ['nct_id', 'design_group_id']
+        group_details_cols = group_keys + ['group_type', 'title']
+        identifiers = df['identifiers_entity'].map(parse_list_cell)
+        df = df[group_details_cols + ['interventions_names', 'selected_name']].assign(
+            drugbank_identifier=identifiers.str[0], pubchem_identifier=identifiers.str[1])
+        df['interventions_names'] = df['interventions_names'].map(parse_list_cell)
+        df['selected_name'] = df['selected_name'].map(parse_list_cell)
         df = df.merge(dbid_to_compound_size_df, left_on="drugbank_identifier", right_on="id", how='left')
-        df['is_complex_compound'] = df['compound_size'].apply(lambda x: math.isnan(x) or x > 2)
-        drugbank_nutraceuticals_df = pd.read_excel("input_data/drugbank_nutraceuticals.xlsx")
+        df['is_complex_compound'] = df['compound_size'].isna() | (df['compound_size'] > 2)
+        drugbank_nutraceuticals_df = pd.read_excel(self.drugbank_nutraceuticals_path)
         df = df.merge(drugbank_nutraceuticals_df[['Nutraceutical', 'DrugBank ID']], left_on="drugbank_identifier",
                       right_on="DrugBank ID", how='left')
-        df['notNutraceutical'] = df['Nutraceutical'].apply(lambda x: math.isnan(x) or x == False)
-
-        intervention_names_for_group = pd.DataFrame(
-            df.groupby(['nct_id', 'design_group_id'])['interventions_names'].progress_apply(list))
-
-        selected_name_group = pd.DataFrame(
-            df.groupby(['nct_id', 'design_group_id'])['selected_name'].progress_apply(list))
-
-        drugbank_identifiers_in_group = pd.DataFrame(
-            df.groupby(['nct_id', 'design_group_id'])['drugbank_identifier'].progress_apply(list))
-
-        pubchem_identifiers_in_group = pd.DataFrame(
-            df.groupby(['nct_id', 'design_group_id'])['pubchem_identifier'].progress_apply(list))
-
-        is_valid_compound_in_group = pd.DataFrame(
-            df.groupby(['nct_id', 'design_group_id'])['is_complex_compound'].progress_apply(list))
-
-        is_contain_nutraceuticals = pd.DataFrame(
-            df.groupby(['nct_id', 'design_group_id'])['notNutraceutical'].progress_apply(list))
-
-        result_df = df[['nct_id', 'design_group_id', 'group_type', 'title']].merge(intervention_names_for_group,
-                                                                                   on='design_group_id') \
-            .merge(is_valid_compound_in_group, on='design_group_id') \
-            .merge(is_contain_nutraceuticals, on='design_group_id') \
-            .merge(selected_name_group, on='design_group_id').merge(drugbank_identifiers_in_group,
-                                                                    on='design_group_id').merge(
-            pubchem_identifiers_in_group, on='design_group_id').astype(str).drop_duplicates()
-        result_df['drugbank_identifier'] = result_df['drugbank_identifier'].apply(self.eval_and_json)
-        result_df['pubchem_identifier'] = result_df['pubchem_identifier'].apply(self.eval_and_json)
-        result_df['interventions_names'] = result_df['interventions_names'].apply(self.eval_and_json_double)
-        result_df['selected_name'] = result_df['selected_name'].apply(
-            self.eval_and_json_double)
-        result_df = result_df[result_df['is_complex_compound'].apply(lambda x: all(eval(x)))]
-        result_df = result_df[result_df['notNutraceutical'].apply(lambda x: all(eval(x)))]
-        result_df = result_df.drop(['is_complex_compound', 'notNutraceutical'], axis=1)
-
-        def is_comb_contain_2_non_placebo(ids_arr):
-            is_placebo = list(map(lambda y: y == 'PLACEBO', eval(ids_arr)))
-            if len(is_placebo) - sum(is_placebo) >= 2:
-                return True
-            return False
-
-        result_df = result_df[result_df["drugbank_identifier"].apply(is_comb_contain_2_non_placebo)]
-        result_df = result_df[result_df['drugbank_identifier'].apply(
-            lambda x: True if len(eval(x)) > 2 else len(eval(x)) == len(set(eval(x))))]
+        df['notNutraceutical'] = df['Nutraceutical'].isna() | (df['Nutraceutical'] == False)
+        df['is_non_placebo'] = df['drugbank_identifier'] != 'PLACEBO'
+
+        groups_df = df.groupby(group_keys).agg(
+            interventions_names=('interventions_names', list),
+            selected_name=('selected_name', list),
+            drugbank_identifier=('drugbank_identifier', list),
+            pubchem_identifier=('pubchem_identifier', list),
+            all_complex_compounds=('is_complex_compound', 'all'),
+            no_nutraceuticals=('notNutraceutical', 'all'),
+            non_placebo_count=('is_non_placebo', 'sum'),
+            drugs_count=('drugbank_identifier', 'size'),
+            unique_drugs_count=('drugbank_identifier', 'nunique'))
+        is_valid_group = groups_df['all_complex_compounds'] & groups_df['no_nutraceuticals'] & \
+                         (groups_df['non_placebo_count'] >= 2) & \
+                         ((groups_df['drugs_count'] > 2) | (groups_df['drugs_count'] == groups_df['unique_drugs_count']))
+        groups_df = groups_df.loc[is_valid_group, ['interventions_names', 'selected_name', 'drugbank_identifier',
+                                                   'pubchem_identifier']]
+
+        result_df = df[group_details_cols].drop_duplicates().merge(groups_df.reset_index(), on=group_keys)
+        result_df[group_details_cols] = result_df[group_details_cols].astype(str)
+        result_df = result_df.drop_duplicates(group_details_cols)
+        for list_col in ['interventions_names', 'selected_name', 'drugbank_identifier', 'pubchem_identifier']:
+            result_df[list_col] = result_df[list_col].map(json.dumps)
         return result_df
 
 
@@ -143,14 +119,22 @@ if __name__ == '__main__':
     import argparse
 
     argument_parser = argparse.ArgumentParser()
-    argument_parser.add_argument("input_path", help="path_to_raw_df.csv")
+    argument_parser.add_argument("input_path", help="path_to_raw_df (csv/parquet)")
     argument_parser.add_argument("output_dir", help="output directory for the transformed tables")
     argument_parser.add_argument("dbid_to_compound_size_df", default="input_data/dbid_to_compound_size_df.csv",
                                  help="dbid to compound size df path")
+    argument_parser.add_argument("--metrics_path", default=None, type=str,
+                                 help="path to write the run's per-stage metrics to (json)")
     args = argument_parser.parse_args()
-    raw_df = pd.read_csv(args.input_path)
-    dbid_to_compound_size_df = pd.read_csv(args.dbid_to_compound_size_df)
-    clinical_trials_schema_transformer = ClinicalTrialsSchemaTransformer()
-    normalized_tables = clinical_trials_schema_transformer.transform_normalized(raw_df, dbid_to_compound_size_df)
-    for name, df in normalized_tables.items():
-        df.to_csv(f'{args.output_dir}/{name}.csv', index=False)
+    with get_metrics().stage('total'):
+        raw_df = read_table(args.input_path)
+        dbid_to_compound_size_df = pd.read_csv(args.dbid_to_compound_size_df)
+        clinical_trials_schema_transformer = ClinicalTrialsSchemaTransformer()
+        with get_metrics().stage('transform_normalized', len(raw_df)) as stage_record:
+            normalized_tables = clinical_trials_schema_transformer.transform_normalized(raw_df,
+                                                                                        dbid_to_compound_size_df)
+            stage_record.rows_out = len(normalized_tables['design_group_df'])
+        for name, df in normalized_tables.items():
+            df.to_csv(f'{args.output_dir}/{name}.csv', index=False)
+    if args.metrics_path is not None:
+        get_metrics().write(args.metrics_path)
@@ -0,0 +1,140 @@
+import ast
+import json
+import math
+import os
+from glob import glob
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+JSON_COLUMNS_METADATA_KEY = b'cdcdb.json_columns'
+PARQUET_PART_PATTERN = 'part-{:05d}.parquet'
+
+
+def _dump_json_cell(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return json.dumps(value)
+
+
+def _load_json_cell(value):
+    if value is None:
+        return None
+    return json.loads(value)
+
+
+def _to_arrow_table(df: pd.DataFrame) -> pa.Table:
+    """
+    Columns arrow can type natively (including list columns) are kept as is, columns of mixed nested values
+    (e.g. interventions_with_other_names: [name, [other names]]) are stored as json strings and listed in the
+    schema metadata so they are decoded back on read
+    """
+    arrays, json_columns = [], []
+    for column in df.columns:
+        try:
+            arrays.append(pa.array(df[column], from_pandas=True))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(pa.array(df[column].map(_dump_json_cell), type=pa.string()))
+            json_columns.append(column)
+    table = pa.Table.from_arrays(arrays, names=[str(column) for column in df.columns])
+    return table.replace_schema_metadata({JSON_COLUMNS_METADATA_KEY: json.dumps(json_columns)})
+
+
+def _from_arrow_table(table: pa.Table) -> pd.DataFrame:
+    metadata = table.schema.metadata or {}
+    json_columns = set(json.loads(metadata.get(JSON_COLUMNS_METADATA_KEY, b'[]')))
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        if name in json_columns:
+            columns[name] = pd.Series(column.to_pylist(), dtype=object).map(_load_json_cell)
+        elif pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+            # to_pandas would return numpy arrays, the pipeline works with python lists
+            columns[name] = pd.Series(column.to_pylist(), dtype=object)
+        else:
+            columns[name] = column.to_pandas()
+    return pd.DataFrame(columns, columns=table.column_names)
+
+
+def write_parquet(df: pd.DataFrame, path):
+    pq.write_table(_to_arrow_table(df), path)
+
+
+def read_parquet(path) -> pd.DataFrame:
+    return _from_arrow_table(pq.read_table(path))
+
+
+def write_partitioned_parquet(df: pd.DataFrame, output_dir, partition_cols):
+    """
+    Writes a hive-partitioned parquet dataset (a directory per value of the partition columns), so readers can load
+    only the partitions they filter on
+    """
+    pq.write_to_dataset(_to_arrow_table(df), output_dir, partition_cols=partition_cols)
+
+
+def read_partitioned_parquet(input_dir) -> pd.DataFrame:
+    """
+    Reads a dataset written by write_partitioned_parquet, the partition columns are read back as categoricals
+    """
+    return _from_arrow_table(pq.read_table(input_dir))
+
+
+def write_parquet_part(df: pd.DataFrame, output_dir, part_idx):
+    """
+    Writes a chunk as one part of a partitioned parquet directory
+    :return: path of the written part
+    """
+    path = os.path.join(output_dir, PARQUET_PART_PATTERN.format(part_idx))
+    write_parquet(df, path)
+    return path
+
+
+def read_parquet_parts(input_dir):
+    """
+    Reads a partitioned parquet directory one part at a time, so memory is bounded by the chunk size
+    :param input_dir: directory written by write_parquet_part
+    :return: generator of DataFrames, in part order
+    """
+    for path in sorted(glob(os.path.join(input_dir, 'part-*.parquet'))):
+        yield read_parquet(path)
+
+
+def read_table(path) -> pd.DataFrame:
+    """
+    Reads a table passed between the stages of the pipeline by its format
+    :param path: csv/xlsx/parquet file, or a directory of parquet parts (or a partitioned parquet dataset)
+    """
+    if os.path.isdir(path):
+        if not glob(os.path.join(path, 'part-*.parquet')):
+            return read_partitioned_parquet(path)
+        return pd.concat(read_parquet_parts(path), ignore_index=True)
+    if path.endswith('.parquet'):
+        return read_parquet(path)
+    if path.endswith('.xlsx'):
+        return pd.read_excel(path)
+    return pd.read_csv(path)
+
+
+def write_table(df: pd.DataFrame, path):
+    """
+    Writes a table by the format of its path (csv/xlsx/parquet), parquet keeps list columns as native lists
+    """
+    if path.endswith('.parquet'):
+        write_parquet(df, path)
+    elif path.endswith('.xlsx'):
+        df.to_excel(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def parse_list_cell(value):
+    """
+    List cells are native lists in parquet tables, and python/json literals in csv tables
+    :return: the cell's list (or tuple)
+    """
+    if isinstance(value, str):
+        return ast.literal_eval(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
@@ -0,0 +1,147 @@
+import asyncio
+import time
+
+import aiohttp
+from tqdm import tqdm
+
+from src.drug_identfiers_resolver.identifiers_resolver import WikiDataIdsResolver, APIBasedIdentifiersResolver, \
+    MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID, PLACEBO_CODE
+
+
+class AsyncDrugIdentifiersResolver(object):
+    """
+    Same API as DrugIdentifiersResolver, but resolves names with asyncio: wikidata and drugbank are queried
+    concurrently for every name, and many names are kept in flight over pooled keep-alive connections.
+    The caches of the given resolvers are used (and filled) exactly as by the blocking resolver.
+    """
+
+    def __init__(self, wikidata_ids_resolver: WikiDataIdsResolver,
+                 api_identifiers_resolver: APIBasedIdentifiersResolver, max_connections=64,
+                 max_connections_per_host=8, max_names_in_flight=256, request_timeout=60,
+                 local_identifiers_index=None):
+        """
+        :param max_connections: size of the shared connection pool
+        :param max_connections_per_host: concurrent connections allowed to a single host (wikidata, drugbank)
+        :param max_names_in_flight: number of names arrays resolved concurrently
+        :param request_timeout: total timeout in seconds of a single request
+        :param local_identifiers_index: LocalIdentifiersIndex consulted first, only names missing from it are fetched
+        """
+        self.api_identifiers_resolver = api_identifiers_resolver
+        self.wikidata_ids_resolver = wikidata_ids_resolver
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.max_names_in_flight = max_names_in_flight
+        self.request_timeout = request_timeout
+        self.local_identifiers_index = local_identifiers_index
+
+    def resolve_array(self, names) -> tuple:
+        """
+        :param names: possible names for the same drug
+        :return: tuple of the (drugbank_id, pubchem_id)  found for the drug in the list
+        """
+        return self.resolve_arrays([names])[0]
+
+    def resolve_arrays(self, names_arrays) -> list:
+        """
+        :param names_arrays: iterable of names arrays, each as accepted by resolve_array
+        :return: list of (drugbank_id, pubchem_id) tuples, in the order of names_arrays
+        """
+        return asyncio.run(self._resolve_arrays(list(names_arrays)))
+
+    async def _resolve_arrays(self, names_arrays):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections_per_host)
+        timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+        in_flight = asyncio.Semaphore(self.max_names_in_flight)
+        progress_bar = tqdm(total=len(names_arrays))
+
+        async def resolve_with_limit(session, names):
+            async with in_flight:
+                result = await self._resolve_array(session, names)
+            progress_bar.update()
+            return result
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            results = await asyncio.gather(*[resolve_with_limit(session, names) for names in names_arrays])
+        progress_bar.close()
+        return results
+
+    async def _resolve_array(self, session, names):
+        if names == '':
+            return '', ''
+        if names is None:
+            return MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID
+        assert isinstance(names, list), "should be list"
+        names = [str(name) for name in names]
+        # names after a placebo are never looked at by the blocking resolver, so they are not fetched here either
+        placebo_idx = next((idx for idx, name in enumerate(names) if "placebo" in name.lower()), len(names))
+        names_results = await asyncio.gather(*[self._resolve_name(session, name) for name in names[:placebo_idx]])
+
+        result_drugbank_id, result_pubchem_id = MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID
+        for idx in range(len(names)):
+            if idx == placebo_idx:
+                return PLACEBO_CODE, PLACEBO_CODE
+            (drugbank_id, pubchem_id), code_from_drugbank = names_results[idx]
+            if result_drugbank_id == MISSING_DRUGBANK_ID and drugbank_id != MISSING_DRUGBANK_ID:
+                result_drugbank_id = drugbank_id
+            if result_pubchem_id == MISSING_PUBCHEM_ID and pubchem_id != MISSING_PUBCHEM_ID:
+                result_pubchem_id = pubchem_id
+            if code_from_drugbank != 'drug not found' and code_from_drugbank is not None:
+                result_drugbank_id = code_from_drugbank
+            if drugbank_id != MISSING_DRUGBANK_ID and pubchem_id != MISSING_PUBCHEM_ID:
+                break
+
+        return result_drugbank_id, result_pubchem_id
+
+    async def _resolve_name(self, session, name):
+        if self.local_identifiers_index is not None:
+            local_ids = self.local_identifiers_index.get_ids(name)
+            if local_ids is not None:
+                return local_ids, None
+        return await asyncio.gather(self._get_wikidata_ids_by_name(session, name),
+                                    self._get_drug_bank_code_by_name(session, name))
+
+    async def _get_wikidata_ids_by_name(self, session, name):
+        exists, dbid, pbid = self.wikidata_ids_resolver.check_query_in_file(name)
+        if exists:
+            return dbid, pbid
+        qids = await self._get_qids_for(session, name)
+        if qids is None:
+            self.wikidata_ids_resolver.cache.set_negative(name)
+            return MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID
+        dbid, pubchem_id = self.wikidata_ids_resolver.get_ids_for_qids(qids)
+        self.wikidata_ids_resolver.add_query_to_file(name, dbid, pubchem_id)
+        return dbid, pubchem_id
+
+    async def _get_qids_for(self, session, search_query):
+        start_time = time.perf_counter()
+        try:
+            async with session.get(WikiDataIdsResolver.get_search_url(search_query)) as response:
+                if response.status != 200:
+                    return None
+                return WikiDataIdsResolver.qids_from_search_results(await response.json(content_type=None))
+        except Exception as e:
+            print(f"unexpected error {e} happened while searching for {search_query}")
+            return None
+        finally:
+            self.wikidata_ids_resolver.cache.stats.record_network_call(time.perf_counter() - start_time)
+
+    async def _get_drug_bank_code_by_name(self, session, drug_name):
+        api_resolver = self.api_identifiers_resolver
+        drug_name = api_resolver.process_query(drug_name)
+        exists, result = api_resolver.check_query_in_file(api_resolver.csvs_dir + 'drugbank_codes.csv', drug_name)
+        if exists:
+            return result
+        start_time = time.perf_counter()
+        try:
+            async with session.get(api_resolver.get_drug_bank_search_url(drug_name)) as response:
+                # the body is drained so the connection goes back to the pool
+                await response.read()
+                api_resolver.cache.stats.record_network_call(time.perf_counter() - start_time)
+                response.raise_for_status()
+                drug_code = api_resolver.drug_code_from_url(str(response.url))
+            return api_resolver.store_drug_bank_code(drug_name, drug_code)
+        except aiohttp.ClientError as e:
+            print(f"encounter {e} while trying to fetch {drug_name}")
+        except Exception as e:
+            print(f"Encountered unhandled exception {e} while fetching {drug_name}, ignoring error returning None")
+        api_resolver.cache.set_negative(drug_name)
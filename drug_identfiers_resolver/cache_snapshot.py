@@ -0,0 +1,180 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import threading
+from glob import glob
+
+import diskcache as dc
+import numpy as np
+
+SNAPSHOT_MAGIC = b'CDCSNAP1'
+HEADER = struct.Struct('<8sQ')
+KEY_LENGTH = struct.Struct('<I')
+DELTA_FILE_PATTERN = 'delta-{}.jsonl'
+
+
+def get_snapshot_paths(snapshot_dir, cache_path):
+    """
+    :return: (snapshot file, deltas directory) of the disk cache at cache_path
+    """
+    cache_name = os.path.basename(os.path.normpath(cache_path))
+    return os.path.join(snapshot_dir, f'{cache_name}.snapshot'), os.path.join(snapshot_dir, f'{cache_name}.deltas')
+
+
+def write_snapshot(items, path):
+    """
+    Layout: magic and number of records, the offset of every record (plus the end offset), and the records sorted by
+    key, each as the key length, the key and the value (utf-8)
+    :param items: iterable of (key, value) strings
+    """
+    records = sorted((key.encode('utf-8'), value.encode('utf-8')) for key, value in items)
+    offsets = np.zeros(len(records) + 1, dtype='<u8')
+    for idx, (key, value) in enumerate(records):
+        offsets[idx + 1] = offsets[idx] + KEY_LENGTH.size + len(key) + len(value)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(HEADER.pack(SNAPSHOT_MAGIC, len(records)))
+        snapshot_file.write(offsets.tobytes())
+        for key, value in records:
+            snapshot_file.write(KEY_LENGTH.pack(len(key)))
+            snapshot_file.write(key)
+            snapshot_file.write(value)
+    os.replace(tmp_path, path)
+
+
+def build_snapshot(cache_path, snapshot_dir):
+    """
+    Compacts a resolver's disk cache into an immutable snapshot, and clears the deltas of a previous snapshot
+    :return: number of entries in the snapshot
+    """
+    snapshot_path, delta_dir = get_snapshot_paths(snapshot_dir, cache_path)
+    os.makedirs(delta_dir, exist_ok=True)
+    for delta_path in glob(os.path.join(delta_dir, DELTA_FILE_PATTERN.format('*'))):
+        os.remove(delta_path)
+    cache = dc.Cache(cache_path)
+    items = []
+    for key in cache.iterkeys():
+        value = cache.get(key)
+        # expired entries are skipped
+        if isinstance(key, str) and value is not None:
+            items.append((key, str(value)))
+    write_snapshot(items, snapshot_path)
+    return len(items)
+
+
+def merge_deltas(cache_path, snapshot_dir):
+    """
+    Writes the results added during a run on top of a snapshot back to the disk cache
+    :return: number of merged entries
+    """
+    _, delta_dir = get_snapshot_paths(snapshot_dir, cache_path)
+    cache = dc.Cache(cache_path)
+    merged = 0
+    for delta_path in sorted(glob(os.path.join(delta_dir, DELTA_FILE_PATTERN.format('*')))):
+        with open(delta_path) as delta_file:
+            for line in delta_file:
+                # a worker killed mid-write leaves a partial last line
+                if not line.endswith('\n'):
+                    break
+                key, value, expire = json.loads(line)
+                cache.set(key, value, expire=expire)
+                merged += 1
+        os.remove(delta_path)
+    return merged
+
+
+class CacheSnapshot(object):
+    """
+    Read-only, memory-mapped snapshot of a disk cache. Lookups are a binary search over the sorted keys, and the
+    mapped pages are shared by all the processes reading the snapshot.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as snapshot_file:
+            self.mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.mmap, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{self.path} is not a cache snapshot")
+        self.offsets = np.frombuffer(self.mmap, dtype='<u8', count=self.count + 1, offset=HEADER.size)
+        self.records_start = HEADER.size + self.offsets.nbytes
+
+    def __getstate__(self):
+        # worker processes map the file again instead of receiving a copy of it
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
+
+    def __len__(self):
+        return self.count
+
+    def _key_at(self, idx):
+        start = self.records_start + int(self.offsets[idx])
+        key_length, = KEY_LENGTH.unpack_from(self.mmap, start)
+        key_start = start + KEY_LENGTH.size
+        return self.mmap[key_start:key_start + key_length], key_start + key_length
+
+    def get(self, key):
+        """
+        :return: the value of the key, None if it is not in the snapshot
+        """
+        key = key.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            middle_key, value_start = self._key_at(middle)
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                value_end = self.records_start + int(self.offsets[middle + 1])
+                return self.mmap[value_start:value_end].decode('utf-8')
+        return None
+
+
+class CacheDelta(object):
+    """
+    Append-only log of the results added on top of a snapshot, one file per process so workers never share a file
+    """
+
+    def __init__(self, delta_dir):
+        self.delta_dir = delta_dir
+        self.lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'delta_dir': self.delta_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['delta_dir'])
+
+    def append(self, key, value, expire=None):
+        with self.lock:
+            if self._pid != os.getpid():
+                # forked workers open their own file
+                self._pid = os.getpid()
+                self._file = open(os.path.join(self.delta_dir, DELTA_FILE_PATTERN.format(self._pid)), 'a')
+            self._file.write(json.dumps([key, value, expire]) + '\n')
+            self._file.flush()
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("command", choices=['build', 'merge'],
+                                 help="build a snapshot of the cache, or merge the snapshot's deltas into the cache")
+    argument_parser.add_argument("cache_path", type=str, help="resolver's disk cache directory")
+    argument_parser.add_argument("snapshot_dir", type=str, help="directory of the snapshots and their deltas")
+    args = argument_parser.parse_args()
+    if args.command == 'build':
+        print(f"Snapshot of {args.cache_path} has {build_snapshot(args.cache_path, args.snapshot_dir)} entries")
+    else:
+        print(f"Merged {merge_deltas(args.cache_path, args.snapshot_dir)} entries into {args.cache_path}")
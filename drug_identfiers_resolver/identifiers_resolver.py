@@ -1,4 +1,4 @@
-import diskcache as dc
+import time
 
 import pubchempy as pcp
 import pandas as pd
@@ -8,24 +8,32 @@ import urllib
 
 import requests
 
+from src.drug_identfiers_resolver.resolver_cache import TieredCache, NEGATIVE_ENTRY, DEFAULT_MEMORY_CACHE_SIZE, \
+    DEFAULT_NEGATIVE_TTL
+from src.drug_identfiers_resolver.pubchem_client import PubChemClient, get_drug_bank_id, DEFAULT_CIDS_BATCH_SIZE
+
 CACHE_SEP = "@@@@@@"
 
 MISSING_PUBCHEM_ID = '-1'
 PLACEBO_CODE = "PLACEBO"
 MISSING_DRUGBANK_ID = '-1'
+DRUGBANK_CACHE_PATH = 'dbid_disk_cache'
 
 DRUG_BANK_NAME_SEARCH_URL = f'https://www.drugbank.ca/unearth/q?utf8=%E2%9C%93&query=drug_name&searcher=drugs'
-PUBCHEM_SEARCH_BY_NAME_URL = \
-    f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/drug_name/xrefs/RegistryID,RN,PubMedID/JSONP'
-PUBCHEM_SEARCH_BY_CID_URL = \
-    f'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/cid_value/xrefs/RegistryID,RN,PubMedID/JSONP'
 
 
 class APIBasedIdentifiersResolver(object):
-    def __init__(self, path_to_cache=''):
+    def __init__(self, path_to_cache='', memory_cache_size=DEFAULT_MEMORY_CACHE_SIZE,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, snapshot_dir=None):
+        """
+        :param memory_cache_size: number of lookups kept in memory in front of the disk cache
+        :param negative_ttl: seconds a failed lookup is cached before it is retried
+        :param snapshot_dir: directory of a snapshot of the disk cache to read from instead of the disk cache
+        """
         self.csvs_dir = path_to_cache
-        csv_path = f'dbid_disk_cache'
-        self.cache = dc.Cache(csv_path)
+        csv_path = DRUGBANK_CACHE_PATH
+        self.cache = TieredCache(csv_path, memory_cache_size, negative_ttl, snapshot_dir)
+        self.pubchem_client = PubChemClient()
 
     def get_sids_by_name(self, drug_name):
         drug_name = self.process_query(drug_name)
@@ -77,35 +85,47 @@ class APIBasedIdentifiersResolver(object):
         :param drug_name: drug name
         :return: Dictionary that contains CID (key is 'CID') and DrugBank ID (key is 'DB_ID')
         """
-        drug_name = self.process_query(drug_name)
-        url = PUBCHEM_SEARCH_BY_NAME_URL.replace('drug_name', str(drug_name))
-        try:
-            response = urllib.request.urlopen(url)
-            json_string = response.read().decode()[9:-3]
-            data = json.loads(json_string)
-            registry_ids = data['InformationList']['Information'][0]['RegistryID']
-            cid = data['InformationList']['Information'][0]['CID']
-            for id in registry_ids:
-                if id[:2] == 'DB':
-                    return {'CID': cid, 'DB_ID': id}
-        except urllib.error.HTTPError as e:
-            print(f"HTTP error raised during handling of {drug_name}: {e}")
+        return self.get_cids_and_dbids_by_names([drug_name]).get(drug_name)
 
-    @staticmethod
-    def get_drug_bank_id_by_cid(cid):
+    def get_cids_and_dbids_by_names(self, drug_names):
+        """
+        Returns both CID and DrugBank ID of every drug. PubChem's name searches take a single name per request, so
+        every distinct name is a request (rate limited, and retried when PubChem is busy).
+        :param drug_names: drug names
+        :return: drug name to a dictionary of its CID (key is 'CID') and DrugBank ID (key is 'DB_ID'), names without a
+        DrugBank ID are left out
+        """
+        result = {}
+        for drug_name in dict.fromkeys(drug_names):
+            try:
+                registry_ids = self.pubchem_client.get_registry_ids_by_name(drug_name.strip().strip('\t'))
+            except requests.RequestException as e:
+                print(f"HTTP error raised during handling of {drug_name}: {e}")
+                continue
+            # the first compound matching the name
+            for cid, cid_registry_ids in list(registry_ids.items())[:1]:
+                dbid = get_drug_bank_id(cid_registry_ids)
+                if dbid is not None:
+                    result[drug_name] = {'CID': cid, 'DB_ID': dbid}
+        return result
+
+    def get_drug_bank_id_by_cid(self, cid):
         """
         Returns the DrugBank ID of a given CID
         :param cid: CID
         :return: DrugBank ID
         """
-        url = PUBCHEM_SEARCH_BY_CID_URL.replace('cid_value', str(cid))
-        response = urllib.request.urlopen(url)
-        json_string = response.read().decode()[9:-3]
-        data = json.loads(json_string)
-        registry_ids = data['InformationList']['Information'][0]['RegistryID']
-        for id in registry_ids:
-            if id[:2] == 'DB':
-                return id
+        return self.get_drug_bank_ids_by_cids([cid]).get(int(cid))
+
+    def get_drug_bank_ids_by_cids(self, cids, batch_size=DEFAULT_CIDS_BATCH_SIZE):
+        """
+        Returns the DrugBank IDs of CIDs, batch_size CIDs are looked up in a single PubChem request
+        :param cids: CIDs
+        :return: CID (int) to its DrugBank ID, CIDs without a DrugBank ID are left out
+        """
+        registry_ids = self.pubchem_client.get_registry_ids_by_cids(cids, batch_size)
+        return {cid: dbid for cid, dbid in ((cid, get_drug_bank_id(ids)) for cid, ids in registry_ids.items())
+                if dbid is not None}
 
     def get_drug_bank_code_by_name(self, drug_name):
         """
@@ -123,16 +143,25 @@ class APIBasedIdentifiersResolver(object):
         else:
             try:
                 drug_code = self._retrieve_from_drugbank(drug_name)
-                if drug_code[:2] == 'DB':
-                    self.add_query_to_file(drug_name, drug_code)
-                    return drug_code
-                else:
-                    self.add_query_to_file(drug_name, 'drug not found')
-                    return 'drug not found'
+                return self.store_drug_bank_code(drug_name, drug_code)
             except urllib.error.HTTPError as e:
                 print(f"encounter {e} while trying to fetch {drug_name}")
             except Exception as e:
                 print(f"Encountered unhandled exception {e} while fetching {drug_name}, ignoring error returning None")
+            self.cache.set_negative(drug_name)
+
+    def store_drug_bank_code(self, drug_name, drug_code):
+        """
+        Caches the drug code retrieved from drugbank for an already processed query
+        :param drug_name: processed drug name
+        :param drug_code: the code drugbank's search redirected to
+        :return: drugbank drug code or 'drug not found'
+        """
+        if drug_code[:2] == 'DB':
+            self.add_query_to_file(drug_name, drug_code)
+            return drug_code
+        self.add_query_to_file(drug_name, 'drug not found')
+        return 'drug not found'
 
     def _retrieve_from_drugbank(self, drug_name):
         """
@@ -140,11 +169,27 @@ class APIBasedIdentifiersResolver(object):
         :param drug_name: drug to be searched
         :return: drug code
         """
+        start_time = time.perf_counter()
+        try:
+            response = requests.get(self.get_drug_bank_search_url(drug_name))
+        finally:
+            self.cache.stats.record_network_call(time.perf_counter() - start_time)
+        # an error page is not a search result, it should not be cached as 'drug not found'
+        response.raise_for_status()
+        return self.drug_code_from_url(response.url)
+
+    def get_drug_bank_search_url(self, drug_name):
         drug_name = self.process_query(drug_name)
-        url = DRUG_BANK_NAME_SEARCH_URL.replace('drug_name', str(drug_name))
-        response = requests.get(url)
-        drug_code = response.url[response.url.rfind('/') + 1:]
-        return drug_code
+        return DRUG_BANK_NAME_SEARCH_URL.replace('drug_name', str(drug_name))
+
+    @staticmethod
+    def drug_code_from_url(url):
+        """
+        Drugbank's search redirects to the drug page when the query matches a drug
+        :param url: the url the search ended at
+        :return: the last part of the url, a drug code if the search matched
+        """
+        return url[url.rfind('/') + 1:]
 
     @staticmethod
     def process_query(query):
@@ -157,14 +202,18 @@ class APIBasedIdentifiersResolver(object):
         dbid_in_cache = self.cache.get(query)
         if dbid_in_cache is None:
             return False, None
+        if dbid_in_cache == NEGATIVE_ENTRY:
+            # same result as the failed lookup
+            return True, None
         return True, dbid_in_cache
 
     def add_query_to_file(self, query, result):
-        self.cache[query] = str(result)
+        self.cache.set(query, str(result))
 
 
 class WikiDataIdsResolver(object):
-    def __init__(self, qid_to_dbid_path, qid_to_pubchem_id_path, cache_file_path='default_wikicache'):
+    def __init__(self, qid_to_dbid_path, qid_to_pubchem_id_path, cache_file_path='default_wikicache',
+                 memory_cache_size=DEFAULT_MEMORY_CACHE_SIZE, negative_ttl=DEFAULT_NEGATIVE_TTL, snapshot_dir=None):
         """
         This object fetches identifiers for drugbank and pubchem from wikidata given a name by utilizing Wikidata's
         search engine's API
@@ -172,13 +221,16 @@ class WikiDataIdsResolver(object):
         (might be generated using the following sparql query: `SELECT * WHERE { SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". } OPTIONAL { ?item wdt:P715 ?_____Drugbank. } }` )
         :param qid_to_pubchem_id_path: a path to a CSV of mapping between QIDS (wikidata ids) to drugbank IDs
          (might be generated using the following sparql query: `SELECT * WHERE { SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". } OPTIONAL { ?item wdt:P662 ?__Pubchem. } }` )
+        :param memory_cache_size: number of lookups kept in memory in front of the disk cache
+        :param negative_ttl: seconds a failed search is cached before it is retried
+        :param snapshot_dir: directory of a snapshot of the disk cache to read from instead of the disk cache
         """
         print("creating wiki resolver")
         self.cache_file_path = cache_file_path
         # load qid to id mapping
         self.qid_to_dbid = self.get_qid_to_id_dict(qid_to_dbid_path)
         self.qid_to_pubchem_id = self.get_qid_to_id_dict(qid_to_pubchem_id_path)
-        self.cache = dc.Cache(self.cache_file_path)
+        self.cache = TieredCache(self.cache_file_path, memory_cache_size, negative_ttl, snapshot_dir)
 
     def get_ids_by_name(self, name):
         """
@@ -189,6 +241,18 @@ class WikiDataIdsResolver(object):
         if exists:
             return dbid, pbid
         qids = self.get_qids_for(name)
+        if qids is None:
+            self.cache.set_negative(name)
+            return MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID
+        dbid, pubchem_id = self.get_ids_for_qids(qids)
+        self.add_query_to_file(name, dbid, pubchem_id)
+        return dbid, pubchem_id
+
+    def get_ids_for_qids(self, qids):
+        """
+        :param qids: wikidata search results, most relevant first
+        :return: (drugbank_id, pubchem_id) of the first result
+        """
         dbids = [self.qid_to_dbid.get(qid, MISSING_DRUGBANK_ID) for qid in qids]
         pubchem_ids = [self.qid_to_pubchem_id.get(qid, MISSING_PUBCHEM_ID) for qid in qids]
         dbid, pubchem_id = MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID
@@ -200,38 +264,45 @@ class WikiDataIdsResolver(object):
             pubchem_id = pubchem_ids[0]
             if pubchem_id != MISSING_PUBCHEM_ID:
                 pubchem_id = "CID" + str(pubchem_id)
-        self.add_query_to_file(name, dbid, pubchem_id)
         return dbid, pubchem_id
 
     def check_query_in_file(self, query):
         cached_entry = self.cache.get(query)
         if cached_entry is None:
             return False, None, None
+        if cached_entry == NEGATIVE_ENTRY:
+            return True, MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID
         pbid, dbid = cached_entry.split(CACHE_SEP)
         return True, pbid, dbid
 
     def add_query_to_file(self, query, pubchem_id, dbid):
-        self.cache[query] = f"{pubchem_id}{CACHE_SEP}{dbid}"
+        self.cache.set(query, f"{pubchem_id}{CACHE_SEP}{dbid}")
 
     def get_qids_for(self, search_query):
         """
         Search for wikidata pages for this name
         :param search_query: search_query
-        :return: list of relevant QIDS
+        :return: list of relevant QIDS, None if the search failed
         """
+        start_time = time.perf_counter()
         try:
-            api_url = f"https://www.wikidata.org/w/api.php?action=wbsearchentities&search={search_query}&language=en&format=json&limit=50"
-            response = requests.get(api_url)
+            response = requests.get(self.get_search_url(search_query))
             if response.status_code != 200:
-                return '-1'
-            query_results = response.json().get('search', [])
-            qids = []
-            for query_result in query_results:
-                qids.append(query_result['id'])
-            return qids
+                return None
+            return self.qids_from_search_results(response.json())
         except Exception as e:
             print(f"unexpected error {e} happened while searching for {search_query}")
-            return []
+            return None
+        finally:
+            self.cache.stats.record_network_call(time.perf_counter() - start_time)
+
+    @staticmethod
+    def get_search_url(search_query):
+        return f"https://www.wikidata.org/w/api.php?action=wbsearchentities&search={search_query}&language=en&format=json&limit=50"
+
+    @staticmethod
+    def qids_from_search_results(search_results):
+        return [query_result['id'] for query_result in search_results.get('search', [])]
 
     def get_qid_to_id_dict(self, path):
         with open(path) as dict_file:
@@ -240,9 +311,14 @@ class WikiDataIdsResolver(object):
 
 class DrugIdentifiersResolver(object):
     def __init__(self, wikidata_ids_resolver: WikiDataIdsResolver,
-                 api_identifiers_resolver: APIBasedIdentifiersResolver):
+                 api_identifiers_resolver: APIBasedIdentifiersResolver, local_identifiers_index=None):
+        """
+        :param local_identifiers_index: LocalIdentifiersIndex consulted first, the network resolvers are only used
+        for names missing from it
+        """
         self.api_identifiers_resolver = api_identifiers_resolver
         self.wikidata_ids_resolver = wikidata_ids_resolver
+        self.local_identifiers_index = local_identifiers_index
 
     def resolve_array(self, names) -> tuple:
         """
@@ -259,12 +335,11 @@ class DrugIdentifiersResolver(object):
             name = str(name)
             if "placebo" in name.lower():
                 return PLACEBO_CODE, PLACEBO_CODE
-            drugbank_id, pubchem_id = self.wikidata_ids_resolver.get_ids_by_name(name)
+            (drugbank_id, pubchem_id), code_from_drugbank = self._resolve_name(name)
             if result_drugbank_id == MISSING_DRUGBANK_ID and drugbank_id != MISSING_DRUGBANK_ID:
                 result_drugbank_id = drugbank_id
             if result_pubchem_id == MISSING_PUBCHEM_ID and pubchem_id != MISSING_PUBCHEM_ID:
                 result_pubchem_id = pubchem_id
-            code_from_drugbank = self.api_identifiers_resolver.get_drug_bank_code_by_name(name)
             if code_from_drugbank != 'drug not found' and code_from_drugbank is not None:
                 result_drugbank_id = code_from_drugbank
             if drugbank_id != MISSING_DRUGBANK_ID and pubchem_id != MISSING_PUBCHEM_ID:
@@ -272,6 +347,18 @@ class DrugIdentifiersResolver(object):
 
         return result_drugbank_id, result_pubchem_id
 
+    def _resolve_name(self, name):
+        """
+        :return: ((drugbank_id, pubchem_id) from wikidata, code from drugbank's search), from the local index if the
+        name is in it
+        """
+        if self.local_identifiers_index is not None:
+            local_ids = self.local_identifiers_index.get_ids(name)
+            if local_ids is not None:
+                return local_ids, None
+        return self.wikidata_ids_resolver.get_ids_by_name(name), \
+            self.api_identifiers_resolver.get_drug_bank_code_by_name(name)
+
 
 if __name__ == '__main__':
     # Example:
@@ -0,0 +1,144 @@
+import argparse
+import gzip
+import json
+import re
+import sys
+
+import diskcache as dc
+import pandas as pd
+
+sys.path.insert(0, '../..')
+from src.drug_identfiers_resolver.identifiers_resolver import MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID, CACHE_SEP
+from src.drug_identfiers_resolver.resolver_cache import NEGATIVE_ENTRY
+from src.drug_combs.instrumentation import get_metrics
+
+NON_WORD_CHARACTERS = re.compile(r'[\W_]+')
+
+
+def normalize_name(name):
+    """
+    :return: the name case-folded, with every run of whitespace and punctuation collapsed to a single space
+    """
+    return NON_WORD_CHARACTERS.sub(' ', str(name).casefold()).strip()
+
+
+class LocalIdentifiersIndex(object):
+    """
+    Offline mapping of normalized drug names to (drugbank_id, pubchem_id), built from the shipped drugbank names and
+    wikidata mappings and from the contents of the resolvers' caches. Consulted before any network resolver.
+    """
+
+    def __init__(self, name_to_ids=None):
+        self.name_to_ids = name_to_ids if name_to_ids is not None else {}
+
+    def __len__(self):
+        return len(self.name_to_ids)
+
+    def get_ids(self, name):
+        """
+        :return: (drugbank_id, pubchem_id) of the name, None if the name is not in the index
+        """
+        return self.name_to_ids.get(normalize_name(name))
+
+    def add(self, name, drugbank_id, pubchem_id):
+        """
+        Adds the identifiers of a name, identifiers already in the index are kept
+        """
+        key = normalize_name(name)
+        if not key or (drugbank_id == MISSING_DRUGBANK_ID and pubchem_id == MISSING_PUBCHEM_ID):
+            return
+        current_drugbank_id, current_pubchem_id = self.name_to_ids.get(key, (MISSING_DRUGBANK_ID, MISSING_PUBCHEM_ID))
+        if current_drugbank_id == MISSING_DRUGBANK_ID:
+            current_drugbank_id = drugbank_id
+        if current_pubchem_id == MISSING_PUBCHEM_ID:
+            current_pubchem_id = pubchem_id
+        self.name_to_ids[key] = (current_drugbank_id, current_pubchem_id)
+
+    def save(self, path):
+        """
+        Saves the index as a gzipped tab separated file, sorted by name
+        """
+        with gzip.open(path, 'wt', encoding='utf-8') as index_file:
+            for key in sorted(self.name_to_ids):
+                drugbank_id, pubchem_id = self.name_to_ids[key]
+                index_file.write(f'{key}\t{drugbank_id}\t{pubchem_id}\n')
+
+    @classmethod
+    def load(cls, path):
+        name_to_ids = {}
+        with gzip.open(path, 'rt', encoding='utf-8') as index_file:
+            for line in index_file:
+                key, drugbank_id, pubchem_id = line.rstrip('\n').split('\t')
+                name_to_ids[key] = (drugbank_id, pubchem_id)
+        return cls(name_to_ids)
+
+    @classmethod
+    def build(cls, drug_names_path, qid_to_drugbank_path, qid_to_pubchem_path=None, wikidata_cache_path=None,
+              drugbank_cache_path=None):
+        """
+        Sources are added from the most to the least reliable: drugbank names, the drugbank search cache, and the
+        wikidata search cache. PubChem ids of drugbank ids are found through their wikidata items.
+        :param drug_names_path: csv of drugBank_id and Drug name
+        :param qid_to_drugbank_path: json of QID to drugbank id (without the DB prefix)
+        :param qid_to_pubchem_path: json of QID to pubchem id (without the CID prefix)
+        :param wikidata_cache_path: WikiDataIdsResolver's cache directory
+        :param drugbank_cache_path: APIBasedIdentifiersResolver's cache directory
+        """
+        dbid_to_pubchem_id = cls._get_dbid_to_pubchem_id(qid_to_drugbank_path, qid_to_pubchem_path)
+        index = cls()
+        drug_names_df = pd.read_csv(drug_names_path)
+        for drugbank_id, drug_name in zip(drug_names_df['drugBank_id'], drug_names_df['Drug name']):
+            index.add(drug_name, drugbank_id, dbid_to_pubchem_id.get(drugbank_id, MISSING_PUBCHEM_ID))
+        if drugbank_cache_path is not None:
+            drugbank_cache = dc.Cache(drugbank_cache_path)
+            for query in drugbank_cache.iterkeys():
+                drugbank_id = drugbank_cache.get(query)
+                if drugbank_id is not None and drugbank_id[:2] == 'DB':
+                    index.add(query, drugbank_id, dbid_to_pubchem_id.get(drugbank_id, MISSING_PUBCHEM_ID))
+        if wikidata_cache_path is not None:
+            wikidata_cache = dc.Cache(wikidata_cache_path)
+            for query in wikidata_cache.iterkeys():
+                cached_entry = wikidata_cache.get(query)
+                if cached_entry is not None and cached_entry != NEGATIVE_ENTRY:
+                    drugbank_id, pubchem_id = cached_entry.split(CACHE_SEP)
+                    index.add(query, drugbank_id, pubchem_id)
+        return index
+
+    @staticmethod
+    def _get_dbid_to_pubchem_id(qid_to_drugbank_path, qid_to_pubchem_path):
+        if qid_to_pubchem_path is None:
+            return {}
+        with open(qid_to_drugbank_path) as qid_to_drugbank_file:
+            qid_to_drugbank = json.load(qid_to_drugbank_file)
+        with open(qid_to_pubchem_path) as qid_to_pubchem_file:
+            qid_to_pubchem = json.load(qid_to_pubchem_file)
+        return {f'DB{dbid}': f'CID{qid_to_pubchem[qid]}' for qid, dbid in qid_to_drugbank.items()
+                if qid in qid_to_pubchem}
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("output_path", type=str, help="path to save the index to (.tsv.gz)")
+    argument_parser.add_argument("--drug_names", default="input_data/drugbank_drug_names.csv", type=str,
+                                 help="csv of drugbank ids and names")
+    argument_parser.add_argument("--qid_to_drugbank", default="input_data/qid_to_drugbank.json", type=str,
+                                 help="path to the qid to dbid mapping file")
+    argument_parser.add_argument("--qid_to_pubchem", default="input_data/qid_to_pubchem.json", type=str,
+                                 help="path to the qid to pubchem_id mapping file")
+    argument_parser.add_argument("--wikidata_cache", default=None, type=str,
+                                 help="wikidata resolver cache directory to add to the index")
+    argument_parser.add_argument("--drugbank_cache", default=None, type=str,
+                                 help="drugbank resolver cache directory to add to the index")
+    argument_parser.add_argument("--metrics_path", default=None, type=str,
+                                 help="path to write the run's per-stage metrics to (json)")
+    args = argument_parser.parse_args()
+    with get_metrics().stage('total'):
+        with get_metrics().stage('build_index') as stage_record:
+            local_index = LocalIdentifiersIndex.build(args.drug_names, args.qid_to_drugbank, args.qid_to_pubchem,
+                                                      args.wikidata_cache, args.drugbank_cache)
+            stage_record.rows_out = len(local_index)
+        with get_metrics().stage('save_index', len(local_index)):
+            local_index.save(args.output_path)
+    print(f"Saved {len(local_index)} names to {args.output_path}")
+    if args.metrics_path is not None:
+        get_metrics().write(args.metrics_path)
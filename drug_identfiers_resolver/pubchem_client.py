@@ -0,0 +1,158 @@
+import fcntl
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+PUBCHEM_REST_URL = 'https://pubchem.ncbi.nlm.nih.gov/rest/pug'
+PUBCHEM_XREFS_BY_CIDS_PATH = 'compound/cid/xrefs/RegistryID/JSON'
+PUBCHEM_XREFS_BY_NAME_PATH = 'compound/name/xrefs/RegistryID/JSON'
+# PubChem's usage policy: at most 5 requests per second (and 400 per minute) per user
+PUBCHEM_REQUESTS_PER_SECOND = 5
+DEFAULT_CIDS_BATCH_SIZE = 200
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_SECONDS = 1.0
+DEFAULT_REQUEST_TIMEOUT = 30
+# 503 is PubChem's response to a busy server or a throttled user
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+NOT_FOUND_STATUS_CODE = 404
+PUBCHEM_RATE_LIMIT_PATH = os.path.join(tempfile.gettempdir(), f'cdcdb_pubchem_rate_limit.{os.getuid()}')
+
+
+class TokenBucket(object):
+    """
+    Rate limiter of rate requests per second, with bursts of up to capacity requests. Thread safe, and shared between
+    processes when its state is kept in a file.
+    """
+
+    def __init__(self, rate, capacity=None, state_path=None):
+        """
+        :param state_path: file the bucket is kept in (under an exclusive lock), so all the processes using the same
+        file share the rate. None for a bucket of this process only.
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.state_path = state_path
+        self.tokens = self.capacity
+        self.updated_at = time.time() if state_path is not None else time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take_token(self, now):
+        """
+        :return: 0 if a token was taken, otherwise the seconds until one is available
+        """
+        self.tokens = min(self.capacity, self.tokens + max(now - self.updated_at, 0) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def _take_shared_token(self):
+        with open(self.state_path, 'a+') as state_file:
+            # released when the file is closed
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+            state = state_file.read().split()
+            if len(state) == 2:
+                self.tokens, self.updated_at = float(state[0]), float(state[1])
+            wait_seconds = self._take_token(time.time())
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(f'{self.tokens} {self.updated_at}')
+            return wait_seconds
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent
+        """
+        while True:
+            with self.lock:
+                if self.state_path is not None:
+                    wait_seconds = self._take_shared_token()
+                else:
+                    wait_seconds = self._take_token(time.monotonic())
+                if not wait_seconds:
+                    return
+            time.sleep(wait_seconds)
+
+
+# PubChem's limits are per user, so all the clients of the user's processes (e.g. the build's stages running in
+# parallel) share a bucket
+_pubchem_rate_limiter = TokenBucket(PUBCHEM_REQUESTS_PER_SECOND, state_path=PUBCHEM_RATE_LIMIT_PATH)
+
+
+def _get_registry_ids(information) -> dict:
+    """
+    :param information: InformationList.Information of a PubChem xrefs response
+    :return: CID to its registry ids (DrugBank ids among them), CIDs without any are left out
+    """
+    return {entry['CID']: entry['RegistryID'] for entry in information if 'CID' in entry and 'RegistryID' in entry}
+
+
+def get_drug_bank_id(registry_ids):
+    """
+    :return: the first DrugBank id of a compound's registry ids, None if it has none
+    """
+    return next((registry_id for registry_id in registry_ids if registry_id[:2] == 'DB'), None)
+
+
+class PubChemClient(object):
+    """
+    PubChem PUG REST requests, sent as POSTs (lists of CIDs in a single request, names without url encoding issues),
+    limited to PubChem's request rate and retried with exponential backoff when PubChem is busy or throttling
+    """
+
+    def __init__(self, rate_limiter=_pubchem_rate_limiter, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_seconds=DEFAULT_BACKOFF_SECONDS, timeout=DEFAULT_REQUEST_TIMEOUT):
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.requests_sent = 0
+
+    def post(self, path, data):
+        """
+        :return: the response's json, None if PubChem found nothing for the request
+        """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            # the client is shared by the resolving threads
+            with self.rate_limiter.lock:
+                self.requests_sent += 1
+            response = self.session.post(f'{PUBCHEM_REST_URL}/{path}', data=data, timeout=self.timeout)
+            if response.status_code == NOT_FOUND_STATUS_CODE:
+                return None
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                response.raise_for_status()
+                return response.json()
+            retry_after = response.headers.get('Retry-After')
+            time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else
+                       self.backoff_seconds * 2 ** attempt)
+
+    def get_registry_ids_by_cids(self, cids, batch_size=DEFAULT_CIDS_BATCH_SIZE) -> dict:
+        """
+        :param cids: CIDs, sent batch_size in a request
+        :return: CID (int) to its registry ids
+        """
+        cids = list(dict.fromkeys(int(cid) for cid in cids))
+        registry_ids = {}
+        for batch_start in range(0, len(cids), batch_size):
+            batch = cids[batch_start:batch_start + batch_size]
+            data = self.post(PUBCHEM_XREFS_BY_CIDS_PATH, {'cid': ','.join(map(str, batch))})
+            if data is not None:
+                registry_ids.update(_get_registry_ids(data['InformationList']['Information']))
+        return registry_ids
+
+    def get_registry_ids_by_name(self, name) -> dict:
+        """
+        PubChem's name searches take a single name per request
+        :return: CID to its registry ids, of the compounds matching the name
+        """
+        data = self.post(PUBCHEM_XREFS_BY_NAME_PATH, {'name': name})
+        if data is None:
+            return {}
+        return _get_registry_ids(data['InformationList']['Information'])
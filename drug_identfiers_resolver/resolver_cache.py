@@ -0,0 +1,134 @@
+import json
+import threading
+from collections import OrderedDict
+
+import diskcache as dc
+import numpy as np
+
+from src.drug_identfiers_resolver.cache_snapshot import CacheSnapshot, CacheDelta, get_snapshot_paths
+
+# stored for lookups that failed (HTTP errors, timeouts), expires after the negative ttl so the name is retried later
+NEGATIVE_ENTRY = '__failed_lookup__'
+DEFAULT_MEMORY_CACHE_SIZE = 100000
+DEFAULT_NEGATIVE_TTL = 7 * 24 * 60 * 60
+
+
+class CacheStats(object):
+    """
+    Hit/miss counters of a cache, and the latencies of the network calls made on its misses
+    """
+
+    def __init__(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.network_latencies = []
+
+    def record_network_call(self, seconds):
+        self.network_latencies.append(seconds)
+
+    def to_dict(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        stats = {'lookups': lookups, 'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits,
+                 'negative_hits': self.negative_hits, 'misses': self.misses,
+                 'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else None,
+                 'network_calls': len(self.network_latencies)}
+        if self.network_latencies:
+            p50, p95, p99 = np.percentile(self.network_latencies, [50, 95, 99])
+            stats.update({'network_latency_p50': p50, 'network_latency_p95': p95, 'network_latency_p99': p99,
+                          'network_latency_max': max(self.network_latencies),
+                          'network_time_total': sum(self.network_latencies)})
+        return stats
+
+
+class TieredCache(object):
+    """
+    A bounded in-memory LRU in front of a diskcache, so repeated lookups of the same names don't go to SQLite.
+    Failed lookups are stored as negative entries that expire after negative_ttl seconds.
+    With a snapshot_dir, lookups are read from a memory-mapped snapshot of the disk cache (built by cache_snapshot.py)
+    and new entries are appended to a delta to be merged back after the run, so worker processes don't contend on the
+    SQLite files.
+    """
+
+    def __init__(self, path, memory_cache_size=DEFAULT_MEMORY_CACHE_SIZE, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 snapshot_dir=None):
+        self.path = path
+        self.memory_cache_size = memory_cache_size
+        self.negative_ttl = negative_ttl
+        if snapshot_dir is None:
+            self.disk_cache, self.snapshot, self.delta = dc.Cache(path), None, None
+        else:
+            snapshot_path, delta_dir = get_snapshot_paths(snapshot_dir, path)
+            self.disk_cache, self.snapshot, self.delta = None, CacheSnapshot(snapshot_path), CacheDelta(delta_dir)
+        self.memory_cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def __getstate__(self):
+        # sent to worker processes without the lock, each worker counts its own stats
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: the cached value (NEGATIVE_ENTRY for failed lookups), None if the key is not cached
+        """
+        with self.lock:
+            if key in self.memory_cache:
+                self.memory_cache.move_to_end(key)
+                value = self.memory_cache[key]
+                self.stats.memory_hits += 1
+                self._count_negative(value)
+                return value
+        value = self.disk_cache.get(key) if self.snapshot is None else self.snapshot.get(key)
+        with self.lock:
+            if value is None:
+                self.stats.misses += 1
+                return None
+            self.stats.disk_hits += 1
+            self._count_negative(value)
+            self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        if self.delta is None:
+            self.disk_cache.set(key, value)
+        else:
+            self.delta.append(key, value)
+        with self.lock:
+            self._remember(key, value)
+
+    def set_negative(self, key):
+        """
+        Caches a failed lookup, on disk it expires so the lookup is retried by a later run once the ttl is over
+        """
+        if self.delta is None:
+            self.disk_cache.set(key, NEGATIVE_ENTRY, expire=self.negative_ttl)
+        else:
+            self.delta.append(key, NEGATIVE_ENTRY, self.negative_ttl)
+        with self.lock:
+            self._remember(key, NEGATIVE_ENTRY)
+
+    def _count_negative(self, value):
+        if value == NEGATIVE_ENTRY:
+            self.stats.negative_hits += 1
+
+    def _remember(self, key, value):
+        self.memory_cache[key] = value
+        self.memory_cache.move_to_end(key)
+        if len(self.memory_cache) > self.memory_cache_size:
+            self.memory_cache.popitem(last=False)
+
+
+def dump_cache_stats(path, caches: dict):
+    """
+    :param caches: source name (e.g. wikidata) to its TieredCache
+    """
+    with open(path, 'w') as stats_file:
+        json.dump({source: cache.stats.to_dict() for source, cache in caches.items()}, stats_file, indent=2)